@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+'''
+Benchmark of the bulk parsing of rupture mesh surfaces against a node by
+node parser, over a synthetic stochastic event set made of mesh ruptures
+(as those of complex faults). Parsed meshes are checked to be identical
+before timings are reported.
+
+To run just type: python benchmarks/eventset_mesh_benchmark.py
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from oq_output.eventset_converter import parse_mesh, iter_ruptures, NRML
+
+
+def parse_mesh_per_node(element):
+    """
+    Reference parser, filling the grids one node at a time
+    """
+    nrows = int(element.attrib['rows'])
+    ncols = int(element.attrib['cols'])
+
+    lons = numpy.ndarray((nrows, ncols))
+    lats = numpy.ndarray((nrows, ncols))
+    depths = numpy.ndarray((nrows, ncols))
+
+    for e in element.iterchildren():
+        row = int(e.attrib['row'])
+        col = int(e.attrib['col'])
+        lons[row, col] = float(e.attrib['lon'])
+        lats[row, col] = float(e.attrib['lat'])
+        depths[row, col] = float(e.attrib['depth'])
+
+    return lons, lats, depths
+
+
+def write_event_set(file_name, n_ruptures, n_rows, n_cols):
+    """
+    Write NRML file with a stochastic event set of `n_ruptures` ruptures,
+    each with a `n_rows` x `n_cols` mesh surface
+    """
+    numpy.random.seed(42)
+    with open(file_name, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<nrml xmlns:gml="http://www.opengis.net/gml" '
+                'xmlns="http://openquake.org/xmlns/nrml/0.4">\n'
+                '<stochasticEventSetCollection sourceModelTreePath="b1">\n'
+                '<stochasticEventSet id="1" investigationTime="50.0">\n')
+        for i in xrange(n_ruptures):
+            f.write('<rupture id="src=%d|i=%d" magnitude="7.0" '
+                    'strike="0.0" dip="30.0" rake="90.0" '
+                    'tectonicRegion="Subduction Interface">\n'
+                    '<mesh rows="%d" cols="%d">\n' %
+                    (i % 100, i, n_rows, n_cols))
+            lons = numpy.random.uniform(-180., 180., (n_rows, n_cols))
+            lats = numpy.random.uniform(-90., 90., (n_rows, n_cols))
+            depths = numpy.random.uniform(0., 50., (n_rows, n_cols))
+            for row in xrange(n_rows):
+                for col in xrange(n_cols):
+                    f.write('<node row="%d" col="%d" lon="%s" lat="%s" '
+                            'depth="%s"/>\n' % (row, col, lons[row, col],
+                                                lats[row, col],
+                                                depths[row, col]))
+            f.write('</mesh>\n</rupture>\n')
+        f.write('</stochasticEventSet>\n'
+                '</stochasticEventSetCollection>\n</nrml>\n')
+
+
+def run_benchmark(n_ruptures, n_rows, n_cols):
+    """
+    Time both mesh parsers over the meshes read incrementally from the
+    event set (as done by the converter), and the whole parsing of the
+    event set, and print the speedup
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(tmp_dir, 'ses.xml')
+        write_event_set(file_name, n_ruptures, n_rows, n_cols)
+
+        t_nodes = 0.
+        t_bulk = 0.
+        for i, (_, mesh) in enumerate(etree.iterparse(
+                file_name, tag='%smesh' % NRML)):
+            # parsers are called in turns first, not to favour one of them
+            # with the element already in cache
+            for parser in ((parse_mesh_per_node, parse_mesh) if i % 2 else
+                           (parse_mesh, parse_mesh_per_node)):
+                start = time.time()
+                if parser is parse_mesh:
+                    surf = parser(mesh)
+                    t_bulk += time.time() - start
+                else:
+                    grids = parser(mesh)
+                    t_nodes += time.time() - start
+            for grid, values in zip(grids, (surf.lons, surf.lats,
+                                            surf.depths)):
+                if not numpy.array_equal(grid, values):
+                    raise ValueError('Bulk and node by node parsing of the '
+                                     'meshes differ')
+            rupture = mesh.getparent()
+            rupture.clear()
+            while rupture.getprevious() is not None:
+                del rupture.getparent()[0]
+
+        start = time.time()
+        for _ in iter_ruptures(file_name):
+            pass
+        t_total = time.time() - start
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print '%10s %10s %12s %12s %8s %12s' % \
+        ('ruptures', 'nodes', 'nodes (s)', 'bulk (s)', 'speedup',
+         'parse (s)')
+    print '%10d %10d %12.3f %12.3f %7.1fx %12.3f' % \
+        (n_ruptures, n_rows * n_cols, t_nodes, t_bulk, t_nodes / t_bulk,
+         t_total)
+
+
+def set_up_arg_parser():
+    """
+    Can run as executable. To do so, set up the command line parser
+    """
+    parser = argparse.ArgumentParser(
+        description='Compare speed of the bulk and of the node by node '
+            'parsing of rupture mesh surfaces. '
+            'To run just type: python eventset_mesh_benchmark.py',
+            add_help=False)
+    flags = parser.add_argument_group('flag arguments')
+    flags.add_argument('-h', '--help', action='help')
+    flags.add_argument('--ruptures',
+        help='number of ruptures (default 500)',
+        type=int,
+        default=500)
+    flags.add_argument('--rows',
+        help='number of rows of each mesh (default 20)',
+        type=int,
+        default=20)
+    flags.add_argument('--cols',
+        help='number of columns of each mesh (default 100)',
+        type=int,
+        default=100)
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = set_up_arg_parser()
+    args = parser.parse_args()
+    run_benchmark(args.ruptures, args.rows, args.cols)
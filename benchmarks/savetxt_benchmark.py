@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+'''
+Benchmark of the block-wise savetxt writer against numpy.savetxt, using
+the layouts written by the converters (hazard curves/maps and GMFs).
+Outputs are checked to be identical before timings are reported.
+
+To run just type: python benchmarks/savetxt_benchmark.py
+'''
+import os
+import sys
+import time
+import argparse
+import numpy
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from oq_output.utils import savetxt
+
+# name, number of columns, format and delimiter of the tested layouts
+CASES = [
+    ('hazard curves', 21, '%g', ','),
+    ('hazard map', 3, '%g', ','),
+    ('gmf', 3, '%5.2f,%5.2f,%g', ' '),
+]
+
+
+def _time(writer, values, fmt, delimiter):
+    """
+    Write values to an in-memory file and return output and elapsed time.
+    """
+    f = StringIO()
+    start = time.time()
+    writer(f, values, fmt=fmt, delimiter=delimiter)
+    return f.getvalue(), time.time() - start
+
+
+def run_benchmark(n_rows):
+    """
+    Time both writers for each case and print the speedup.
+    """
+    numpy.random.seed(42)
+    print '%-15s %10s %12s %12s %8s' % \
+        ('case', 'rows', 'numpy (s)', 'blocks (s)', 'speedup')
+    for name, n_cols, fmt, delimiter in CASES:
+        values = numpy.random.uniform(-180., 180., (n_rows, n_cols))
+        values[:, 2:] = 10. ** numpy.random.uniform(-8., 0.,
+                                                    (n_rows, n_cols - 2))
+        expected, t_numpy = _time(numpy.savetxt, values, fmt, delimiter)
+        output, t_blocks = _time(savetxt, values, fmt, delimiter)
+        if output != expected:
+            raise ValueError('Output of savetxt differs from numpy.savetxt '
+                             'for case %s' % name)
+        print '%-15s %10d %12.3f %12.3f %7.1fx' % \
+            (name, n_rows, t_numpy, t_blocks, t_numpy / t_blocks)
+
+
+def set_up_arg_parser():
+    """
+    Can run as executable. To do so, set up the command line parser
+    """
+    parser = argparse.ArgumentParser(
+        description='Compare speed of numpy.savetxt and of the block-wise '
+            'savetxt used by the converters. '
+            'To run just type: python savetxt_benchmark.py', add_help=False)
+    flags = parser.add_argument_group('flag arguments')
+    flags.add_argument('-h', '--help', action='help')
+    flags.add_argument('--rows',
+        help='number of rows to write (default 200000)',
+        type=int,
+        default=200000)
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = set_up_arg_parser()
+    args = parser.parse_args()
+    run_benchmark(args.rows)
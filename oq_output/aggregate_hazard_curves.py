@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Compute weighted mean and quantile hazard curves from the hazard curves of
+a set of logic tree realizations.
+
+Realizations are first converted, in parallel worker processes, to binary
+files which are then memory mapped; statistics are computed over blocks of
+sites, so that the curves of all realizations for all sites are never held
+in memory at once.
+'''
+import os
+import shutil
+import argparse
+import tempfile
+import numpy
+from multiprocessing import Pool
+from hazard_curve_converter import save_hazard_curves_to_binary, _set_header
+from binary_io import read_binary, BINARY_FORMATS
+from utils import savetxt
+
+# maximum number of poes (realizations x sites x IMLs) processed at a time
+MAX_BLOCK_VALUES = 10 ** 7
+
+
+def weighted_quantile(curves, weights, quantile):
+    """
+    Compute weighted quantile of the curves of a block of sites. `curves`
+    is a (n_realizations, n_sites, n_imls) array and `weights` the
+    realizations weights (summing to 1). As in OpenQuake, for each poe the
+    quantile is interpolated on the cumulative weights of the sorted
+    realizations poes. Return (n_sites, n_imls) array.
+    """
+    n_real, n_sites, n_imls = curves.shape
+    sites = numpy.arange(n_sites)[:, None]
+    imls = numpy.arange(n_imls)
+    order = numpy.argsort(curves, axis=0)
+    sorted_curves = curves[order, sites, imls]
+    cum_weights = numpy.cumsum(numpy.asarray(weights)[order], axis=0)
+
+    # index of the first realization with cumulative weight >= quantile
+    upper = numpy.clip((cum_weights < quantile).sum(axis=0), 0, n_real - 1)
+    lower = numpy.maximum(upper - 1, 0)
+    w_low = cum_weights[lower, sites, imls]
+    w_up = cum_weights[upper, sites, imls]
+    dw = w_up - w_low
+    dw[dw == 0] = numpy.inf
+    frac = numpy.clip((quantile - w_low) / dw, 0., 1.)
+    frac[upper == 0] = 0.
+    c_low = sorted_curves[lower, sites, imls]
+    c_up = sorted_curves[upper, sites, imls]
+    return c_low + frac * (c_up - c_low)
+
+def _convert_realization(args):
+    """
+    Convert NRML hazard curves of a realization to a binary file in
+    `tmp_dir` (binary files are used as they are). Return file name.
+    """
+    hazard_curves_file, tmp_dir, rlz_index = args
+    if os.path.splitext(hazard_curves_file)[1][1:] in BINARY_FORMATS:
+        return hazard_curves_file
+    file_name_root = os.path.join(tmp_dir, 'rlz_%d' % rlz_index)
+    save_hazard_curves_to_binary(hazard_curves_file, file_name_root, 'npz')
+    return '%s.npz' % file_name_root
+
+def aggregate_hazard_curves(hazard_curves_files, weights, file_name_root,
+        quantiles=(), jobs=1, max_block_values=MAX_BLOCK_VALUES):
+    """
+    Compute weighted mean and quantile hazard curves of the realizations
+    `hazard_curves_files` (NRML or binary files, all with the same sites and
+    IMLs) with weights `weights` (summing to 1). Curves are saved
+    to .csv files (in the layout of
+    :func:`hazard_curve_converter.save_hazard_curves_to_csv`) with root name
+    `file_name_root` followed by '_mean' or '_quantile_' and the quantile.
+    Realizations are parsed using `jobs` worker processes.
+    """
+    weights = numpy.array(weights, dtype=float)
+    if len(weights) != len(hazard_curves_files) or numpy.any(weights < 0):
+        raise ValueError('A non-negative weight must be given for each '
+                         'realization')
+    if not numpy.allclose(weights.sum(), 1.):
+        raise ValueError('Realizations weights must sum to 1, got %s' %
+                         weights.sum())
+
+    output_files = ['%s_mean.csv' % file_name_root]
+    output_files.extend(['%s_quantile_%s.csv' % (file_name_root, q)
+                         for q in quantiles])
+    for output_file in output_files:
+        if os.path.isfile(output_file):
+            raise ValueError('Output file %s already exists. Please specify '
+                             'different name or remove old file' % output_file)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        tasks = [(fname, tmp_dir, i)
+                 for i, fname in enumerate(hazard_curves_files)]
+        if jobs > 1:
+            pool = Pool(jobs)
+            try:
+                binary_files = pool.map(_convert_realization, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            binary_files = map(_convert_realization, tasks)
+
+        realizations = [read_binary(fname) for fname in binary_files]
+        metadata, imls, lons, lats, _ = realizations[0]
+        for fname, (_, rlz_imls, rlz_lons, rlz_lats, _) in \
+                zip(hazard_curves_files, realizations):
+            if not (numpy.array_equal(rlz_imls, imls) and
+                    numpy.array_equal(rlz_lons, lons) and
+                    numpy.array_equal(rlz_lats, lats)):
+                raise ValueError('Hazard curves in %s are not defined on the '
+                                 'same sites and IMLs as %s' %
+                                 (fname, hazard_curves_files[0]))
+
+        header_metadata = dict((str(k), v) for k, v in metadata.items()
+                               if k not in ('smlt_path', 'gsimlt_path'))
+        header_metadata['imls'] = imls.tolist()
+        files = []
+        for i, output_file in enumerate(output_files):
+            header_metadata['statistics'] = 'mean' if i == 0 else 'quantile'
+            header_metadata['quantile_value'] = \
+                None if i == 0 else quantiles[i - 1]
+            f = open(output_file, 'w')
+            f.write(_set_header(header_metadata) + '\n')
+            files.append(f)
+
+        block_size = max(1, max_block_values // (len(weights) * len(imls)))
+        for start in range(0, len(lons), block_size):
+            stop = min(start + block_size, len(lons))
+            curves = numpy.array([rlz[4][start: stop]
+                                  for rlz in realizations])
+            coords = numpy.column_stack((lons[start: stop],
+                                         lats[start: stop]))
+            stats = [numpy.tensordot(weights, curves, axes=1)]
+            stats.extend([weighted_quantile(curves, weights, q)
+                          for q in quantiles])
+            for f, stat in zip(files, stats):
+                savetxt(f, numpy.hstack((coords, stat)), fmt='%g',
+                              delimiter=',')
+        for f in files:
+            f.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def read_realizations_file(file_name):
+    """
+    Read .csv file listing hazard curves files and weights (one
+    'path,weight' per line). Relative paths are taken with respect to the
+    directory of the file. Return lists of files and weights.
+    """
+    files = []
+    weights = []
+    base_dir = os.path.dirname(os.path.abspath(file_name))
+    with open(file_name) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fname, weight = line.rsplit(',', 1)
+            files.append(os.path.join(base_dir, fname.strip()))
+            weights.append(float(weight))
+    return files, weights
+
+
+def set_up_arg_parser():
+    """
+    Can run as executable. To do so, set up the command line parser
+    """
+    parser = argparse.ArgumentParser(
+        description='Compute weighted mean and quantile hazard curves from '
+            'the hazard curves files (NRML or binary) of a set of logic tree '
+            'realizations, listed with their weights in a .csv file '
+            '(path,weight on each line). '
+            'To run just type: python aggregate_hazard_curves.py '
+            '--realizations-file=/PATH/TO/REALIZATIONS_FILE '
+            '--output-file=/PATH/TO/OUTPUT_FILE --quantiles 0.16 0.84',
+            add_help=False)
+    flags = parser.add_argument_group('flag arguments')
+    flags.add_argument('-h', '--help', action='help')
+    flags.add_argument('--realizations-file',
+                        help='path to .csv file listing realizations files '
+                             'and weights (Required)',
+                        default=None,
+                        required=True)
+    flags.add_argument('--output-file',
+                        help='root of the output files, without file '
+                             'extension (Required)',
+                        default=None,
+                        required=True)
+    flags.add_argument('--quantiles',
+                        help='quantiles to compute (Optional)',
+                        nargs='*',
+                        type=float,
+                        default=[])
+    flags.add_argument('--jobs',
+                        help='number of processes used to parse the '
+                             'realizations (Optional, default is 1)',
+                        type=int,
+                        default=1)
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = set_up_arg_parser()
+    args = parser.parse_args()
+
+    if args.realizations_file:
+        files, weights = read_realizations_file(args.realizations_file)
+        aggregate_hazard_curves(files, weights, args.output_file,
+                                args.quantiles, args.jobs)
+    else:
+        parser.print_usage()
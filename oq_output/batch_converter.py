@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Convert all the NRML output files in a directory (or matching a glob
+pattern) in a single run. The type of each file is detected from the tag
+of the first element below the nrml root, and conversions are distributed
+over a pool of worker processes, so that the Python, lxml and matplotlib
+start-up cost is paid once per worker instead of once per file.
+'''
+import os
+import sys
+import glob
+import time
+import argparse
+from multiprocessing import Pool
+from lxml import etree
+from progress import PROGRESS, add_progress_arguments, configure
+
+NRML='{http://openquake.org/xmlns/nrml/0.4}'
+
+# output formats supported by hazard curves, hazard maps, UHS and GMF
+# collections (the other outputs are always written in their usual format)
+OUTPUT_FORMATS = ('csv', 'npz', 'hdf5')
+
+
+def detect_output_type(file_name):
+    """
+    Return the tag (without namespace) of the first element below the nrml
+    root, which identifies the output type, or None if the file is not a
+    NRML file.
+    """
+    try:
+        for depth, (_, element) in enumerate(
+                etree.iterparse(file_name, events=('start',))):
+            if depth == 0:
+                if element.tag != '%snrml' % NRML:
+                    return None
+                continue
+            return element.tag.replace(NRML, '')
+    except etree.XMLSyntaxError:
+        return None
+
+
+def _convert_hazard_curves(input_file, output_root, output_format):
+    from hazard_curve_converter import save_hazard_curves_to_csv, \
+        save_hazard_curves_to_binary
+    if output_format == 'csv':
+        save_hazard_curves_to_csv(input_file, output_root, streaming=True)
+    else:
+        save_hazard_curves_to_binary(input_file, output_root, output_format)
+
+
+def _convert_hazard_map(input_file, output_root, output_format):
+    from hazard_map_converter import save_hazard_map_to_csv, \
+        save_hazard_map_to_binary
+    if output_format == 'csv':
+        save_hazard_map_to_csv(input_file, output_root)
+    else:
+        save_hazard_map_to_binary(input_file, output_root, output_format)
+
+
+def _convert_uhs(input_file, output_root, output_format):
+    from uhs_converter import save_uhs_to_csv, save_uhs_to_binary
+    if output_format == 'csv':
+        save_uhs_to_csv(input_file, output_root)
+    else:
+        save_uhs_to_binary(input_file, output_root, output_format)
+
+
+def _convert_disaggregation(input_file, output_root, output_format):
+    from disaggregation_converter import save_disagg_to_csv
+    os.makedirs(output_root)
+    save_disagg_to_csv(input_file, output_root, False)
+
+
+def _convert_gmf_collection(input_file, output_root, output_format):
+    from gmfset_converter import parse_gmfc_file, iter_gmf_records, \
+        write_gmfs_to_csv, save_gmfs_to_binary
+    if output_format == 'csv':
+        os.makedirs(output_root)
+        metadata = {}
+        write_gmfs_to_csv(iter_gmf_records(input_file, metadata),
+                          output_root, metadata)
+    else:
+        save_gmfs_to_binary(parse_gmfc_file(input_file), output_root,
+                            output_format)
+
+
+def _convert_scenario_gmfs(input_file, output_root, output_format):
+    from scenario_gmf_converter import parse_gmfs_file, save_gmfs_to_csv
+    os.makedirs(output_root)
+    save_gmfs_to_csv(parse_gmfs_file(input_file), output_root)
+
+
+def _convert_event_set(input_file, output_root, output_format):
+    from eventset_converter import iter_ruptures, save_sess_to_txt
+    os.makedirs(output_root)
+    save_sess_to_txt(iter_ruptures(input_file), output_root)
+
+
+def _convert_loss_curves(input_file, output_root, output_format):
+    from parse_loss_curves import LossCurves2Csv
+    LossCurves2Csv(input_file, '%s.csv' % output_root)
+
+
+def _convert_loss_map(input_file, output_root, output_format):
+    from parse_loss_maps import LossMap2Csv
+    LossMap2Csv(input_file, False, '%s.csv' % output_root)
+
+
+# converter for each output type, identified by the tag of the first
+# element below the nrml root. Converters are imported by the workers
+# only when needed, so that missing optional dependencies of one
+# converter do not prevent the conversion of the other output types
+CONVERTERS = {
+    'hazardCurves': _convert_hazard_curves,
+    'hazardMap': _convert_hazard_map,
+    'uniformHazardSpectra': _convert_uhs,
+    'disaggMatrices': _convert_disaggregation,
+    'gmfCollection': _convert_gmf_collection,
+    'gmfSet': _convert_scenario_gmfs,
+    'stochasticEventSetCollection': _convert_event_set,
+    'lossCurves': _convert_loss_curves,
+    'lossMap': _convert_loss_map,
+}
+
+
+def find_input_files(inputs):
+    """
+    Return the sorted list of .xml files found in the given directories
+    (searched recursively) or matching the given glob patterns.
+    """
+    input_files = set()
+    for path in inputs:
+        if os.path.isdir(path):
+            for dir_name, _, file_names in os.walk(path):
+                input_files.update(os.path.join(dir_name, fname)
+                                   for fname in file_names
+                                   if fname.endswith('.xml'))
+        else:
+            input_files.update(fname for fname in glob.glob(path)
+                               if os.path.isfile(fname))
+    return sorted(input_files)
+
+
+def _convert_file(args):
+    """
+    Detect the type of a file and convert it. Return the file name, output
+    type, file size and error message (None if the conversion succeeded or
+    if the file is not a supported output and was skipped).
+    """
+    input_file, output_dir, output_format = args
+    size = os.path.getsize(input_file)
+    output_type = detect_output_type(input_file)
+    if output_type not in CONVERTERS:
+        return input_file, output_type, size, None
+
+    output_root = os.path.join(
+        output_dir, os.path.splitext(os.path.basename(input_file))[0])
+    try:
+        # the progress of a batch is measured by files
+        with PROGRESS.paused():
+            CONVERTERS[output_type](input_file, output_root, output_format)
+    except Exception as exc:
+        return input_file, output_type, size, '%s: %s' % \
+            (exc.__class__.__name__, exc)
+    return input_file, output_type, size, None
+
+
+def convert_files(input_files, output_dir, output_format='csv', jobs=1):
+    """
+    Convert the given NRML files, saving the outputs in output_dir, and
+    return the list of (file name, output type, size, error) tuples.
+    Files are distributed over `jobs` worker processes. Each converted
+    file is reported to the current PROGRESS stage.
+    """
+    roots = [os.path.splitext(os.path.basename(fname))[0]
+             for fname in input_files]
+    duplicates = sorted(set(r for r in roots if roots.count(r) > 1))
+    if duplicates:
+        raise ValueError('Input files with the same name would overwrite '
+                         'each other in the output directory: %s' %
+                         ', '.join(duplicates))
+
+    tasks = [(fname, output_dir, output_format) for fname in input_files]
+    results = []
+    if jobs > 1:
+        pool = Pool(jobs)
+        try:
+            for result in pool.imap_unordered(_convert_file, tasks):
+                results.append(result)
+                PROGRESS.update(nbytes=result[2])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            results.append(_convert_file(task))
+            PROGRESS.update(nbytes=results[-1][2])
+    return results
+
+
+def print_summary(results, elapsed, stream=sys.stdout):
+    """
+    Print number of converted files per type, skipped and failed files, and
+    throughput of the converted and failed files.
+    """
+    counts = {}
+    n_files = 0
+    n_bytes = 0
+    skipped = []
+    failures = []
+    for input_file, output_type, size, error in results:
+        if output_type not in CONVERTERS:
+            skipped.append(input_file)
+            continue
+        n_files += 1
+        n_bytes += size
+        if error is None:
+            counts[output_type] = counts.get(output_type, 0) + 1
+        else:
+            failures.append((input_file, output_type, error))
+
+    for output_type in sorted(counts):
+        stream.write('%s: %d file(s)\n' % (output_type, counts[output_type]))
+    for input_file in skipped:
+        stream.write('SKIPPED %s (not a supported output)\n' % input_file)
+    for input_file, output_type, error in failures:
+        stream.write('FAILED %s (%s): %s\n' % (input_file, output_type, error))
+
+    elapsed = max(elapsed, 1e-6)
+    stream.write('Converted %d file(s), %.1f MB in %.2f s (%d failed, '
+                 '%d skipped): %.2f files/s, %.2f MB/s\n' %
+                 (n_files - len(failures), n_bytes / 1e6, elapsed,
+                  len(failures), len(skipped), n_files / elapsed,
+                  n_bytes / 1e6 / elapsed))
+
+
+def set_up_arg_parser():
+    """
+    Can run as executable. To do so, set up the command line parser
+    """
+    parser = argparse.ArgumentParser(
+        description='Convert all NRML output files in a directory, or '
+            'matching a glob pattern, to .csv (or binary) files. The type '
+            'of each file (hazard curves, hazard map, UHS, disaggregation, '
+            'GMFs, event sets, loss curves, loss maps) is detected '
+            'automatically. To run just type: python batch_converter.py '
+            '--input=PATH_TO_DIRECTORY_OR_GLOB '
+            '--output-dir=PATH_TO_OUTPUT_DIRECTORY', add_help=False)
+    flags = parser.add_argument_group('flag arguments')
+    flags.add_argument('-h', '--help', action='help')
+    flags.add_argument('--input',
+        help='directories (searched recursively for .xml files) or glob '
+             'patterns (quoted) of NRML files (Required)',
+        nargs='+',
+        default=None,
+        required=True)
+    flags.add_argument('--output-dir',
+        help='path to output directory (Required, raise an error if it '
+             'already exists)',
+        default=None,
+        required=True)
+    flags.add_argument('--output-format',
+        help='output format of hazard curves, hazard maps, UHS and GMF '
+             'collections (%s, default csv)' % ', '.join(OUTPUT_FORMATS),
+        choices=OUTPUT_FORMATS,
+        default='csv')
+    flags.add_argument('--jobs',
+        help='number of worker processes (default 1)',
+        type=int,
+        default=1)
+    add_progress_arguments(flags)
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = set_up_arg_parser()
+    args = parser.parse_args()
+    configure(args)
+
+    if args.input:
+        input_files = find_input_files(args.input)
+        # create the output directory immediately. Raise an error if
+        # it already exists
+        os.makedirs(args.output_dir)
+
+        start = time.time()
+        total_bytes = sum(os.path.getsize(fname) for fname in input_files)
+        with PROGRESS.stage('convert', total_bytes):
+            results = convert_files(input_files, args.output_dir,
+                                    args.output_format, args.jobs)
+        print_summary(results, time.time() - start)
+    else:
+        parser.print_usage()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Binary (columnar) storage of hazard outputs (hazard curves, hazard maps and
+uniform hazard spectra), as an alternative to .csv files.
+
+Each file contains the site coordinates as float64 columns ('lon', 'lat'),
+the site values as a 2-D array ('values', one row per site), the labels of
+the value columns ('columns', e.g. IMLs or periods) and the metadata that
+.csv files store in the header. Two formats are supported:
+
+* npz: uncompressed numpy archive, metadata stored as a JSON string
+* hdf5: HDF5 file (requires h5py), metadata stored as attributes
+
+Arrays are read back as read-only memory maps, so that opening a file does
+not require reading it.
+'''
+import json
+import struct
+import zipfile
+import numpy
+from numpy.lib import format as npy_format
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+BINARY_FORMATS = ('npz', 'hdf5')
+
+# size of the fixed part of a zip local file header
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+def _check_format(output_format):
+    """
+    Check that the binary format is supported and available
+    """
+    if output_format not in BINARY_FORMATS:
+        raise ValueError('Binary format %s not supported (choose from %s)' %
+                         (output_format, ', '.join(BINARY_FORMATS)))
+    if output_format == 'hdf5' and h5py is None:
+        raise ImportError('h5py is required to write hdf5 files')
+
+def save_binary(file_name_root, metadata, columns, lons, lats, values,
+        output_format='npz'):
+    """
+    Save site coordinates and values to binary file `file_name_root` plus
+    extension (.npz or .hdf5, depending on `output_format`). `columns` are
+    the labels of the value columns. Metadata with value None are not
+    stored. Return the name of the file.
+    """
+    _check_format(output_format)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    values = numpy.asarray(values)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    columns = numpy.asarray(columns)
+    metadata = dict((k, v) for k, v in metadata.items() if v is not None)
+
+    output_file = '%s.%s' % (file_name_root, output_format)
+    if output_format == 'npz':
+        numpy.savez(output_file, lon=lons, lat=lats, values=values,
+                    columns=columns,
+                    metadata=numpy.array(json.dumps(metadata)))
+    else:
+        f = h5py.File(output_file, 'w')
+        f.create_dataset('lon', data=lons)
+        f.create_dataset('lat', data=lats)
+        f.create_dataset('values', data=values)
+        f.create_dataset('columns', data=columns)
+        for key, value in metadata.items():
+            f.attrs[key] = value
+        f.close()
+
+    return output_file
+
+def save_arrays(file_name_root, metadata, arrays, output_format='npz'):
+    """
+    Save dictionary of named arrays and metadata to binary file
+    `file_name_root` plus extension (.npz or .hdf5, depending on
+    `output_format`). Return the name of the file.
+    """
+    _check_format(output_format)
+    metadata = dict((k, v) for k, v in metadata.items() if v is not None)
+
+    output_file = '%s.%s' % (file_name_root, output_format)
+    if output_format == 'npz':
+        arrays = dict(arrays)
+        arrays['metadata'] = numpy.array(json.dumps(metadata))
+        numpy.savez(output_file, **arrays)
+    else:
+        f = h5py.File(output_file, 'w')
+        for name, array in arrays.items():
+            f.create_dataset(name, data=array)
+        for key, value in metadata.items():
+            f.attrs[key] = value
+        f.close()
+
+    return output_file
+
+def read_arrays(file_name):
+    """
+    Read binary file written by :func:`save_arrays`. Return metadata and
+    dictionary of the arrays (as read-only memory maps when possible).
+    """
+    if file_name.endswith('.hdf5'):
+        metadata, arrays = _memmap_hdf5(file_name)
+    else:
+        arrays = _memmap_npz(file_name)
+        metadata = json.loads(arrays.pop('metadata').item())
+
+    return metadata, arrays
+
+def _memmap_npz(file_name):
+    """
+    Return dictionary of the arrays stored in .npz file `file_name`, as
+    memory maps when possible (i.e. for uncompressed, non-object arrays)
+    """
+    arrays = {}
+    zf = zipfile.ZipFile(file_name)
+    f = open(file_name, 'rb')
+    try:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = npy_format.read_array(zf.open(info))
+                continue
+            f.seek(info.header_offset)
+            header = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+            name_length, extra_length = header[-2:]
+            f.seek(info.header_offset + ZIP_LOCAL_HEADER.size +
+                   name_length + extra_length)
+            version = npy_format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = npy_format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = npy_format.read_array_header_2_0(f)
+            if dtype.hasobject or not numpy.prod(shape):
+                arrays[name] = npy_format.read_array(zf.open(info))
+            else:
+                arrays[name] = numpy.memmap(
+                    file_name, dtype=dtype, mode='r', offset=f.tell(),
+                    shape=shape, order='F' if fortran else 'C')
+    finally:
+        f.close()
+        zf.close()
+
+    return arrays
+
+def _memmap_hdf5(file_name):
+    """
+    Return metadata and dictionary of the arrays stored in .hdf5 file
+    `file_name`, as memory maps when possible (i.e. for contiguous,
+    uncompressed datasets)
+    """
+    if h5py is None:
+        raise ImportError('h5py is required to read hdf5 files')
+    arrays = {}
+    f = h5py.File(file_name, 'r')
+    try:
+        metadata = dict(f.attrs.items())
+        for name, dset in f.items():
+            offset = dset.id.get_offset()
+            if offset is None or dset.chunks is not None or \
+                    not dset.size or dset.dtype.hasobject:
+                arrays[name] = dset[()]
+            else:
+                arrays[name] = numpy.memmap(file_name, dtype=dset.dtype,
+                                            mode='r', offset=offset,
+                                            shape=dset.shape)
+    finally:
+        f.close()
+
+    return metadata, arrays
+
+def read_binary(file_name):
+    """
+    Read binary file written by :func:`save_binary`. Return metadata,
+    column labels, and site longitudes, latitudes and values (as read-only
+    memory maps when possible).
+    """
+    if file_name.endswith('.hdf5'):
+        metadata, arrays = _memmap_hdf5(file_name)
+    else:
+        arrays = _memmap_npz(file_name)
+        metadata = json.loads(arrays.pop('metadata').item())
+
+    return metadata, numpy.array(arrays['columns']), arrays['lon'], \
+        arrays['lat'], arrays['values']
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Plot hazard curves and uniform hazard spectra to pdf files.
+
+A single figure is created by each worker process and reused for all the
+sites it has to plot: only the line data and the title are updated between
+sites. Sites can be plotted to one file per site, or to multi-page pdf
+"atlas" files (one per worker).
+'''
+import os
+import numpy
+from multiprocessing import Pool
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+
+
+def parse_sites(sites):
+    """
+    Parse a string of comma separated site indices and index ranges
+    (e.g. '0,5,10-20', ranges including both ends) into a list of indices
+    """
+    indices = []
+    for token in sites.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if '-' in token:
+            start, stop = map(int, token.split('-'))
+            indices.extend(range(start, stop + 1))
+        else:
+            indices.append(int(token))
+    return indices
+
+def parse_bbox(bbox):
+    """
+    Parse a bounding box string given as 'west/east/south/north' (as in
+    the GMT -R option) into a tuple of floats
+    """
+    values = tuple(map(float, bbox.split('/')))
+    if len(values) != 4:
+        raise ValueError('Bounding box must be given as west/east/south/north'
+                         ', found %s' % bbox)
+    return values
+
+def select_sites(coords, sites=None, bbox=None, offset=0):
+    """
+    Return the indices of the rows in `coords` ((n, 2) array of lon, lat)
+    to be plotted. `sites` is a list of site indices (counted from `offset`,
+    i.e. the index of the first row of `coords` in the complete set of
+    sites) and `bbox` a (west, east, south, north) tuple. If both are given
+    only sites satisfying both criteria are selected.
+    """
+    idx = numpy.ones(len(coords), dtype=bool)
+    if sites is not None:
+        site_idx = numpy.array(sites, dtype=int) - offset
+        site_idx = site_idx[(site_idx >= 0) & (site_idx < len(coords))]
+        in_sites = numpy.zeros(len(coords), dtype=bool)
+        in_sites[site_idx] = True
+        idx &= in_sites
+    if bbox is not None:
+        west, east, south, north = bbox
+        idx &= (coords[:, 0] >= west) & (coords[:, 0] <= east) & \
+            (coords[:, 1] >= south) & (coords[:, 1] <= north)
+    return numpy.where(idx)[0]
+
+def _location_labels(lon, lat):
+    """
+    Return the hemisphere labels of a location
+    """
+    long_ind = "W" if lon < 0.0 else "E"
+    lat_ind = "S" if lat < 0.0 else "N"
+    return long_ind, lat_ind
+
+
+class CurvePlotter(object):
+    """
+    Reusable figure for plotting a curve (hazard curve or UHS) for many
+    sites. `spec` is a dictionary with keys:
+
+    * x: abscissae of the curves (IMLs or periods)
+    * xlabel, ylabel: axes labels
+    * loglog: True for logarithmic axes
+    * grid: True to draw a grid
+    * title: first line(s) of the title, common to all sites
+    * location_format: format of the site location line of the title,
+      filled with abs(lon), lon hemisphere, abs(lat), lat hemisphere
+    * title_fontsize: font size of the title (None for default)
+    * prefix: prefix of the output file names
+    * dpi: resolution of the output files
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.fig = Figure(figsize=(7, 5))
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111)
+        self.line = None
+        if spec.get('loglog'):
+            self.ax.set_xscale('log')
+            self.ax.set_yscale('log')
+        if spec.get('grid'):
+            self.ax.grid(True, color='0.66', linestyle="--")
+        self.ax.set_xlabel(spec['xlabel'], fontsize=14)
+        self.ax.set_ylabel(spec['ylabel'], fontsize=14)
+        self.title = self.ax.set_title('', fontsize=spec.get('title_fontsize'))
+        self.laid_out = False
+
+    def draw(self, row):
+        """
+        Update the figure with the curve of a site, given as a row
+        (lon, lat, value_1, ..., value_n)
+        """
+        long_ind, lat_ind = _location_labels(row[0], row[1])
+        if self.line is None:
+            self.line, = self.ax.plot(self.spec['x'], row[2:], 'bo-',
+                                      linewidth=2.0)
+        else:
+            self.line.set_ydata(row[2:])
+            self.ax.relim()
+            self.ax.autoscale_view()
+        self.title.set_text(self.spec['title'] +
+                            self.spec['location_format'] %
+                            (numpy.abs(row[0]), long_ind,
+                             numpy.abs(row[1]), lat_ind))
+        if not self.laid_out:
+            # the layout does not change from one site to the other
+            self.fig.tight_layout()
+            self.laid_out = True
+
+    def site_file_name(self, row):
+        """
+        Return the name of the output file of a site
+        """
+        long_ind, lat_ind = _location_labels(row[0], row[1])
+        return "{:s}_{:.5f}{:s}_{:.5f}{:s}.pdf".format(
+            self.spec['prefix'], row[0], long_ind, row[1], lat_ind)
+
+    def save(self, output):
+        """
+        Save the figure to `output` (a file name or a PdfPages object)
+        """
+        if isinstance(output, PdfPages):
+            output.savefig(self.fig, dpi=self.spec.get('dpi', 300))
+        else:
+            self.fig.savefig(output, dpi=self.spec.get('dpi', 300),
+                             format="pdf")
+
+
+def _init_worker():
+    """
+    Initialise plotting worker process. Font objects cached by matplotlib in
+    the parent process cannot be used after fork, so the cache is emptied.
+    """
+    try:
+        from matplotlib.font_manager import _get_font
+        _get_font.cache_clear()
+    except (ImportError, AttributeError):
+        pass
+
+def _plot_block(args):
+    """
+    Plot a block of curves with a single figure. If `atlas` is True, all
+    curves are saved as pages of a single pdf file, named after the index
+    of the first site of the block.
+    """
+    spec, output_dir, rows, first_index, atlas = args
+    plotter = CurvePlotter(spec)
+    pdf = None
+    if atlas:
+        pdf = PdfPages(os.path.join(output_dir, '%s_atlas_%d.pdf' %
+                                    (spec['prefix'], first_index)))
+    for row in rows:
+        plotter.draw(row)
+        if pdf is None:
+            plotter.save(os.path.join(output_dir, plotter.site_file_name(row)))
+        else:
+            plotter.save(pdf)
+    if pdf is not None:
+        pdf.close()
+    return len(rows)
+
+def plot_curves(output_dir, curves, spec, jobs=1, atlas=False, sites=None,
+        bbox=None, offset=0):
+    """
+    Plot curves (array of rows lon, lat, value_1, ..., value_n) to pdf
+    files in `output_dir` (created if needed), distributing the sites over
+    `jobs` worker processes. Only sites selected by `sites` and `bbox`
+    (see :func:`select_sites`) are plotted. `offset` is the index of the
+    first row of `curves` in the complete set of sites. Return the number
+    of plotted curves.
+    """
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+    curves = numpy.asarray(curves)
+    idx = select_sites(curves[:, :2], sites, bbox, offset)
+    if not len(idx):
+        return 0
+
+    jobs = max(1, min(jobs, len(idx)))
+    tasks = [(spec, output_dir, curves[block], offset + block[0], atlas)
+             for block in numpy.array_split(idx, jobs)]
+    if jobs == 1:
+        return _plot_block(tasks[0])
+
+    pool = Pool(jobs, _init_worker)
+    try:
+        num_plotted = sum(pool.map(_plot_block, tasks))
+    finally:
+        pool.close()
+        pool.join()
+    return num_plotted
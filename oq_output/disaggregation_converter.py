@@ -50,6 +50,7 @@ import utils
 from lxml import etree
 from collections import OrderedDict
 from subprocess import call
+from progress import PROGRESS, add_progress_arguments, configure
 
 
 NRML='{http://openquake.org/xmlns/nrml/0.4}'
@@ -61,48 +62,51 @@ def parse_nrml_disaggregation_file(nrml_disaggregation):
     metadata = OrderedDict()
     matrices = {}
 
-    parse_args = dict(source=nrml_disaggregation)
-    for _, element in etree.iterparse(**parse_args):
-        if element.tag == '%sdisaggMatrices' % NRML:
-            a = element.attrib
-            metadata['smlt_path'] = a.get('sourceModelTreePath')
-            metadata['gsimlt_path'] = a.get('gsimTreePath')
-            metadata['imt'] = a['IMT']
-            metadata['investigation_time'] = a['investigationTime']
-            metadata['sa_period'] = a.get('saPeriod')
-            metadata['sa_damping'] = a.get('saDamping')
-            metadata['lon'] = a.get('lon')
-            metadata['lat'] = a.get('lat')
-            metadata['Mag'] = \
-                numpy.array(a.get('magBinEdges').split(','), dtype=float)
-            metadata['Dist'] = \
-                numpy.array(a.get('distBinEdges').split(','), dtype=float)
-            metadata['Lon'] = \
-                numpy.array(a.get('lonBinEdges').split(','), dtype=float)
-            metadata['Lat'] = \
-                numpy.array(a.get('latBinEdges').split(','), dtype=float)
-            metadata['Eps'] = \
-                numpy.array(a.get('epsBinEdges').split(','), dtype=float)
-            metadata['TRT'] = \
-                numpy.array(
-                    map(str.strip, a.get('tectonicRegionTypes').split(',')),
-                    dtype=object
-                )
-        elif element.tag == '%sdisaggMatrix' % NRML:
-            a = element.attrib
-            disag_type = a.get('type')
-            dims = tuple(map(int, a.get('dims').split(',')))
-            poe = float(a.get('poE'))
-            iml = float(a.get('iml'))
-
-            matrix = numpy.zeros(dims)
-            for e in element:
-                a = e.attrib
-                idx = tuple(map(int, a.get('index').split(',')))
-                value = float(a.get('value'))
-                matrix[idx] = value
-
-            matrices[disag_type] = (poe, iml, matrix)
+    with PROGRESS.open(nrml_disaggregation) as source:
+        parse_args = dict(source=source)
+        for _, element in etree.iterparse(**parse_args):
+            if element.tag == '%sdisaggMatrices' % NRML:
+                a = element.attrib
+                metadata['smlt_path'] = a.get('sourceModelTreePath')
+                metadata['gsimlt_path'] = a.get('gsimTreePath')
+                metadata['imt'] = a['IMT']
+                metadata['investigation_time'] = a['investigationTime']
+                metadata['sa_period'] = a.get('saPeriod')
+                metadata['sa_damping'] = a.get('saDamping')
+                metadata['lon'] = a.get('lon')
+                metadata['lat'] = a.get('lat')
+                metadata['Mag'] = \
+                    numpy.array(a.get('magBinEdges').split(','), dtype=float)
+                metadata['Dist'] = \
+                    numpy.array(a.get('distBinEdges').split(','), dtype=float)
+                metadata['Lon'] = \
+                    numpy.array(a.get('lonBinEdges').split(','), dtype=float)
+                metadata['Lat'] = \
+                    numpy.array(a.get('latBinEdges').split(','), dtype=float)
+                metadata['Eps'] = \
+                    numpy.array(a.get('epsBinEdges').split(','), dtype=float)
+                metadata['TRT'] = \
+                    numpy.array(
+                        map(str.strip,
+                            a.get('tectonicRegionTypes').split(',')),
+                        dtype=object
+                    )
+            elif element.tag == '%sdisaggMatrix' % NRML:
+                a = element.attrib
+                disag_type = a.get('type')
+                dims = tuple(map(int, a.get('dims').split(',')))
+                poe = float(a.get('poE'))
+                iml = float(a.get('iml'))
+
+                matrix = numpy.zeros(dims)
+                for e in element:
+                    a = e.attrib
+                    idx = tuple(map(int, a.get('index').split(',')))
+                    value = float(a.get('value'))
+                    matrix[idx] = value
+
+                matrices[disag_type] = (poe, iml, matrix)
+                PROGRESS.update()
 
     return metadata, matrices
 
@@ -153,7 +157,7 @@ def save_disagg_to_csv(nrml_disaggregation, output_dir, plot):
         output_file = '%s/%s.csv' % (output_dir, disag_type.replace(',', '_'))
         f = open(output_file, 'w')
         f.write(header+'\n')
-        numpy.savetxt(f, values, fmt='%s', delimiter=',')
+        utils.savetxt(f, values, fmt='%s', delimiter=',')
         f.close()
 
         if plot:
@@ -217,7 +221,7 @@ def plot_1d_hist(hist_file, xlabel, title, annotation_file=None):
         (xlabel, 2 * bin_width, numpy.round(numpy.max(y)/4, 4), title)
 
     if tail == 'TRT.csv':
-        numpy.savetxt('trt_hist.dat', numpy.array([x, y], dtype=float).T)
+        utils.savetxt('trt_hist.dat', numpy.array([x, y], dtype=float).T)
         annotation = '-B:%s:/:Probability:%s:.%s:WS' % \
             (xlabel, numpy.round(numpy.max(y)/4, 4), title)
         call(['psxy', 'trt_hist.dat', region, projection, annotation, '-Xc',
@@ -251,7 +255,7 @@ def plot_2d_hist(hist_file, xlabel, ylabel, title):
         (x[idx].reshape(-1, 1), y[idx].reshape(-1, 1), z[idx].reshape(-1, 1)),
         axis=1
     )
-    numpy.savetxt('new_hist.dat', new_hist)
+    utils.savetxt('new_hist.dat', new_hist)
 
     region = '-R%s/%s/%s/%s/%s/%s' % \
         (x[0] - bin_width1, x[-1] + bin_width1,
@@ -434,6 +438,7 @@ def set_up_arg_parser():
                              'error if it already exists)',
                         default=None,
                         required=True)
+    add_progress_arguments(flags)
     return parser
 
 
@@ -441,12 +446,14 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
         # create the output directory immediately. Raise an error if
         # it already exists
         os.makedirs(args.output_dir)
 
-        save_disagg_to_csv(args.input_file, args.output_dir, args.plot)
+        with PROGRESS.stage('convert'):
+            save_disagg_to_csv(args.input_file, args.output_dir, args.plot)
     else:
         parser.print_usage()
@@ -49,57 +49,84 @@ import abc
 import os
 import csv
 import argparse
+import itertools
 import numpy
+from StringIO import StringIO
+from collections import OrderedDict
 from lxml import etree
-
-from openquake.hazardlib.geo.mesh import RectangularMesh
+from utils import savetxt
+from site_index import geodetic_distance, EARTH_RADIUS
+from rupture_index import RuptureIndexBuilder, RUPTURE_INDEX_FILE
+from progress import PROGRESS, add_progress_arguments, configure
 
 NRML='{http://openquake.org/xmlns/nrml/0.4}'
 
 
-def parse_sesc_file(file_name):
-    """
-    Parse NRML 0.4 SES collection file.
-    """
-    parse_args = dict(source=file_name)
+# number of ruptures formatted at a time when writing the SES files
+CHUNK_SIZE = 10000
 
-    for _, element in etree.iterparse(**parse_args):
-        if element.tag == '%sstochasticEventSetCollection' % NRML:
-            sesc = parse_ses_collection(element)
+# selectors of the attributes of all the nodes of a mesh (as plain strings)
+MESH_COLUMNS = dict((name, etree.XPath('*/@%s' % name, smart_strings=False))
+                    for name in ('row', 'col', 'lon', 'lat', 'depth'))
 
-    return sesc
+# row and column attributes of the nodes of meshes written row by row,
+# keyed by mesh shape; only the most recently used shapes are kept
+ROW_MAJOR_INDICES = OrderedDict()
+MAX_CACHED_SHAPES = 16
 
-def parse_ses_collection(element):
+
+def iter_ruptures(file_name, metadata=None, investigation_times=None):
     """
-    Parse NRML 0.4 'stochasticEventSetCollection' and return
-    class StochasticEventSetCollection.
+    Parse NRML 0.4 SES collection file incrementally, yielding a
+    (ses_id, rupture) tuple for each rupture, with rupture an instance of
+    :class:`Rupture`. Elements are cleared as soon as they are consumed,
+    so memory use does not depend on the size of the file.
+
+    Dictionaries `metadata` and `investigation_times`, if given, are filled
+    as the file is read with the source model logic tree path of the
+    collection (key 'smtp') and with the investigation times of the sets.
     """
-    smtp = element.attrib['sourceModelTreePath']
-
-    sess = []
-    num_ses = 0
-    for e in element.iterchildren():
-        sess.append(parse_ses(e))
-
-    print 'number of stochastic event sets: %s' % len(sess)
+    ses_id = None
+    with PROGRESS.open(file_name) as source:
+        for event, element in etree.iterparse(
+                source, events=('start', 'end'),
+                tag=['%sstochasticEventSetCollection' % NRML,
+                     '%sstochasticEventSet' % NRML, '%srupture' % NRML]):
+            if element.tag == '%sstochasticEventSetCollection' % NRML:
+                if event == 'start' and metadata is not None:
+                    metadata['smtp'] = element.attrib['sourceModelTreePath']
+            elif element.tag == '%sstochasticEventSet' % NRML:
+                if event == 'start':
+                    ses_id = element.attrib['id']
+                    if investigation_times is not None:
+                        investigation_times[ses_id] = \
+                            element.attrib['investigationTime']
+                else:
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+            elif event == 'end':
+                rupture = parse_rup(element)
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                yield ses_id, rupture
 
-    return StochasticEventSetCollection(smtp, sess)
-
-def parse_ses(element):
+def parse_sesc_file(file_name):
     """
-    Parse NRML 0.4 'stochasticEventSet' and return
-    class StochasticEventSet.
+    Parse NRML 0.4 SES collection file and return class
+    StochasticEventSetCollection.
     """
-    ID = element.attrib['id']
-    time_span = element.attrib['investigationTime']
+    metadata = {}
+    investigation_times = {}
+    ruptures = OrderedDict()
+    for ses_id, rupture in iter_ruptures(file_name, metadata,
+                                         investigation_times):
+        ruptures.setdefault(ses_id, []).append(rupture)
 
-    print 'Processing ses %s' % ID
-
-    rups = []
-    for e in element.iterchildren():
-        rups.append(parse_rup(e))
-
-    return StochasticEventSet(ID, time_span, rups)
+    sess = [StochasticEventSet(ID, investigation_times[ID], rups)
+            for ID, rups in ruptures.items()]
+    return StochasticEventSetCollection(metadata.get('smtp'), sess)
 
 def parse_rup(element):
     """
@@ -112,7 +139,7 @@ def parse_rup(element):
     rake = float(element.attrib['rake'])
     tectonic_region = element.attrib['tectonicRegion']
 
-    print 'Processing rupture %s' % ID
+    PROGRESS.update()
 
     planar_surfs = element.findall('%splanarSurface' % NRML)
     mesh = element.find('%smesh' % NRML)
@@ -164,19 +191,42 @@ def parse_mesh(element):
     nrows = int(element.attrib['rows'])
     ncols = int(element.attrib['cols'])
 
-    lons = numpy.ndarray((nrows, ncols))
-    lats = numpy.ndarray((nrows, ncols))
-    depths = numpy.ndarray((nrows, ncols))
-
-    for e in element.iterchildren():
-        row = int(e.attrib['row'])
-        col = int(e.attrib['col'])
-        lons[row, col] = float(e.attrib['lon'])
-        lats[row, col] = float(e.attrib['lat'])
-        depths[row, col] = float(e.attrib['depth'])
+    # attributes of all the nodes are read as whole columns and converted
+    # with a single call each
+    rows = MESH_COLUMNS['row'](element)
+    cols = MESH_COLUMNS['col'](element)
+    values = [numpy.array(MESH_COLUMNS[name](element), dtype=float)
+              for name in ('lon', 'lat', 'depth')]
+
+    if (rows, cols) == get_row_major_indices(nrows, ncols):
+        # nodes written row by row (as usual), grids are just reshaped
+        lons, lats, depths = [column.reshape(nrows, ncols)
+                              for column in values]
+    else:
+        rows = numpy.array(rows, dtype=int)
+        cols = numpy.array(cols, dtype=int)
+        lons, lats, depths = [numpy.ndarray((nrows, ncols))
+                              for _ in range(3)]
+        for grid, column in zip((lons, lats, depths), values):
+            grid[rows, cols] = column
 
     return MeshSurface(lons, lats, depths)
 
+def get_row_major_indices(nrows, ncols):
+    """
+    Return the lists of the row and of the column attributes of the nodes
+    of a mesh written row by row (cached for the last MAX_CACHED_SHAPES
+    mesh shapes)
+    """
+    indices = ROW_MAJOR_INDICES.pop((nrows, ncols), None)
+    if indices is None:
+        indices = ([str(row) for row in xrange(nrows) for _ in xrange(ncols)],
+                   [str(col) for col in xrange(ncols)] * nrows)
+        if len(ROW_MAJOR_INDICES) >= MAX_CACHED_SHAPES:
+            ROW_MAJOR_INDICES.popitem(last=False)
+    ROW_MAJOR_INDICES[nrows, ncols] = indices
+    return indices
+
 class BaseSurface(object):
     """
     Class representing base surface.
@@ -210,17 +260,8 @@ class PlanarSurface(BaseSurface):
                [self.corners_lats.take([0, 1, 2, 3, 0])]
 
     def get_middle_point(self):
-        lons = numpy.array([self.corners_lons.take([0, 1]),
-                            self.corners_lons.take([3, 2])])
-        lats = numpy.array([self.corners_lats.take([0, 1]),
-                            self.corners_lats.take([3, 2])])
-        depths = numpy.array([self.corners_depths.take([0, 1]),
-                              self.corners_depths.take([3, 2])])                                  
-        mesh = RectangularMesh(lons, lats, depths)
-
-        middle_point = mesh.get_middle_point()
-
-        return (middle_point.longitude, middle_point.latitude, middle_point.depth)
+        return tuple(point[0] for point in
+                     get_middle_points(*get_planar_meshes([self])))
 
 class MultiPlanarSurface(BaseSurface):
     """
@@ -266,9 +307,109 @@ class MeshSurface(BaseSurface):
         return [lons], [lats]
 
     def get_middle_point(self):
-        mesh = RectangularMesh(self.lons, self.lats, self.depths)
-        middle_point = mesh.get_middle_point()
-        return (middle_point.longitude, middle_point.latitude, middle_point.depth)
+        return tuple(point[0] for point in get_middle_points(
+            self.lons[None], self.lats[None], self.depths[None]))
+
+def get_planar_meshes(surfaces):
+    """
+    Return longitudes, latitudes and depths of the corners of planar
+    surfaces as (n, 2, 2) arrays (top edge in the first row), that is as
+    the 2x2 meshes of the surfaces
+    """
+    order = [0, 1, 3, 2]
+    return [numpy.array([getattr(surf, name) for surf in surfaces])
+            [:, order].reshape(-1, 2, 2)
+            for name in ('corners_lons', 'corners_lats', 'corners_depths')]
+
+def get_great_circle_middle_points(lons1, lats1, lons2, lats2):
+    """
+    Return longitudes and latitudes of the points halfway between two
+    arrays of points along the great circle, as done by hazardlib
+    `geo.utils.get_middle_point` (coincident points are returned as they
+    are)
+    """
+    distances = geodetic_distance(lons1, lats1, lons2, lats2)
+    lons1, lats1, lons2, lats2 = map(numpy.radians,
+                                     (lons1, lats1, lons2, lats2))
+    # azimuth of the second point seen from the first one, with the
+    # direction (360 - azimuth) used by hazardlib to move along it
+    cos_lats2 = numpy.cos(lats2)
+    course = numpy.arctan2(
+        numpy.sin(lons1 - lons2) * cos_lats2,
+        numpy.cos(lats1) * numpy.sin(lats2) -
+        numpy.sin(lats1) * cos_lats2 * numpy.cos(lons1 - lons2))
+    tc = numpy.radians(360 - (360 - numpy.degrees(course)) % 360)
+    sin_dists = numpy.sin(distances / 2.0 / EARTH_RADIUS)
+    cos_dists = numpy.cos(distances / 2.0 / EARTH_RADIUS)
+    sin_lats1 = numpy.sin(lats1)
+    cos_lats1 = numpy.cos(lats1)
+    sin_lats = sin_lats1 * cos_dists + cos_lats1 * sin_dists * numpy.cos(tc)
+    dlons = numpy.arctan2(numpy.sin(tc) * sin_dists * cos_lats1,
+                          cos_dists - sin_lats1 * sin_lats)
+    lons = numpy.degrees(
+        numpy.mod(lons1 - dlons + numpy.pi, 2 * numpy.pi) - numpy.pi)
+    lats = numpy.degrees(numpy.arcsin(sin_lats))
+
+    same = (lons1 == lons2) & (lats1 == lats2)
+    return numpy.where(same, numpy.degrees(lons1), lons), \
+        numpy.where(same, numpy.degrees(lats1), lats)
+
+def get_middle_points(lons, lats, depths):
+    """
+    Return longitudes, latitudes and depths of the middle points of a
+    batch of meshes of the same shape, given as (n, rows, cols) arrays.
+    The middle node is taken if there are odd numbers of rows and columns,
+    otherwise the middle points of the two (or four) central nodes are
+    combined along the great circle, as hazardlib
+    `RectangularMesh.get_middle_point` does.
+    """
+    _, rows, cols = lons.shape
+
+    def get_row_middle_points(row):
+        col = cols // 2
+        if cols % 2 == 1:
+            return lons[:, row, col], lats[:, row, col], depths[:, row, col]
+        mid_lons, mid_lats = get_great_circle_middle_points(
+            lons[:, row, col - 1], lats[:, row, col - 1],
+            lons[:, row, col], lats[:, row, col])
+        return mid_lons, mid_lats, \
+            (depths[:, row, col - 1] + depths[:, row, col]) / 2.0
+
+    row = rows // 2
+    if rows % 2 == 1:
+        return get_row_middle_points(row)
+    lons1, lats1, depths1 = get_row_middle_points(row - 1)
+    lons2, lats2, depths2 = get_row_middle_points(row)
+    mid_lons, mid_lats = get_great_circle_middle_points(
+        lons1, lats1, lons2, lats2)
+    return mid_lons, mid_lats, (depths1 + depths2) / 2.0
+
+def get_centroids(surfaces):
+    """
+    Return (n, 3) array of longitude, latitude and depth of the middle
+    points of surfaces. Middle points are computed in batch: planar
+    surfaces (and the first plane of multi planar surfaces) together,
+    mesh surfaces grouped by mesh shape.
+    """
+    centroids = numpy.zeros((len(surfaces), 3))
+    planar = OrderedDict()
+    meshes = OrderedDict()
+    for i, surf in enumerate(surfaces):
+        if isinstance(surf, MultiPlanarSurface):
+            surf = surf.surfaces[0]
+        if isinstance(surf, PlanarSurface):
+            planar[i] = surf
+        else:
+            meshes.setdefault(surf.lons.shape, OrderedDict())[i] = surf
+
+    if planar:
+        centroids[list(planar)] = numpy.column_stack(
+            get_middle_points(*get_planar_meshes(planar.values())))
+    for group in meshes.values():
+        centroids[list(group)] = numpy.column_stack(get_middle_points(
+            *[numpy.array([getattr(surf, name) for surf in group.values()])
+              for name in ('lons', 'lats', 'depths')]))
+    return centroids
 
 class Rupture(object):
     """
@@ -296,44 +437,198 @@ class StochasticEventSet(object):
         self.time_span = time_span
         self.rups = rups
 
+class RuptureTable(object):
+    """
+    Table of ruptures stored as one array per column: set ids, rupture ids,
+    magnitudes, centroids (longitudes, latitudes and depths), tectonic
+    regions, strikes, dips and rakes.
+
+    Surface boundaries are stored as the flat arrays of the coordinates of
+    all the boundary rings, with `ring_offsets` (the index of the first
+    point of each ring, followed by the total number of points) and
+    `rupture_offsets` (the index of the first ring of each rupture,
+    followed by the total number of rings).
+    """
+    def __init__(self, ses_ids, ids, magnitudes, lons, lats, depths, trts,
+                 strikes, dips, rakes, boundary_lons, boundary_lats,
+                 ring_offsets, rupture_offsets):
+        self.ses_ids = ses_ids
+        self.ids = ids
+        self.magnitudes = magnitudes
+        self.lons = lons
+        self.lats = lats
+        self.depths = depths
+        self.trts = trts
+        self.strikes = strikes
+        self.dips = dips
+        self.rakes = rakes
+        self.boundary_lons = boundary_lons
+        self.boundary_lats = boundary_lats
+        self.ring_offsets = ring_offsets
+        self.rupture_offsets = rupture_offsets
+
+    @classmethod
+    def from_ruptures(cls, ses_ids, ruptures):
+        """
+        Build table from the list of the ids of the sets and the list of
+        the corresponding :class:`Rupture` instances. Centroids are
+        computed in batch.
+        """
+        centroids = get_centroids([rup.surf for rup in ruptures])
+        boundary_lons = []
+        boundary_lats = []
+        n_rings = []
+        for rup in ruptures:
+            multi_lons, multi_lats = rup.surf.get_surface_boundaries()
+            boundary_lons.extend(multi_lons)
+            boundary_lats.extend(multi_lats)
+            n_rings.append(len(multi_lons))
+        ring_sizes = [len(lons) for lons in boundary_lons]
+
+        def get_column(name):
+            return numpy.array([getattr(rup, name) for rup in ruptures])
+
+        def get_offsets(sizes):
+            return numpy.concatenate(([0], numpy.cumsum(sizes))).astype(int)
+
+        return cls(numpy.array(ses_ids), get_column('ID'),
+                   get_column('magnitude').astype(float),
+                   centroids[:, 0], centroids[:, 1], centroids[:, 2],
+                   get_column('tect_reg'),
+                   get_column('strike').astype(float),
+                   get_column('dip').astype(float),
+                   get_column('rake').astype(float),
+                   numpy.concatenate(boundary_lons + [numpy.zeros(0)]),
+                   numpy.concatenate(boundary_lats + [numpy.zeros(0)]),
+                   get_offsets(ring_sizes), get_offsets(n_rings))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_boundary_wkt(self, index):
+        """
+        Return the surface boundary of a rupture as WKT multipolygon
+        """
+        rings = []
+        for ring in xrange(self.rupture_offsets[index],
+                           self.rupture_offsets[index + 1]):
+            start, stop = self.ring_offsets[ring], self.ring_offsets[ring + 1]
+            rings.append('((%s))' % ','.join(
+                '%s %s' % point for point in zip(
+                    self.boundary_lons[start:stop],
+                    self.boundary_lats[start:stop])))
+        return 'MULTIPOLYGON(%s)' % ','.join(rings)
+
+    def get_rows(self, indices, boundaries=True):
+        """
+        Return object array with, for the ruptures of the given indices,
+        the values written to the SES files: ID, magnitude, centroid
+        coordinates, tectonic region, strike, dip, rake and (if
+        `boundaries` is True) boundary as WKT multipolygon
+        """
+        columns = [self.ids, self.magnitudes, self.lons, self.lats,
+                   self.depths, self.trts, self.strikes, self.dips,
+                   self.rakes]
+        rows = numpy.empty((len(indices), len(columns) + boundaries),
+                           dtype=object)
+        for i, column in enumerate(columns):
+            rows[:, i] = column[indices]
+        if boundaries:
+            rows[:, -1] = [self.get_boundary_wkt(index) for index in indices]
+        return rows
+
+    def group_by_ses(self):
+        """
+        Yield (ses_id, indices) for each set, with the indices of its
+        ruptures in the table order. Ruptures are grouped with a single
+        (stable) sort of the set ids.
+        """
+        order = numpy.argsort(self.ses_ids, kind='mergesort')
+        ses_ids = self.ses_ids[order]
+        starts = numpy.concatenate(
+            ([0], numpy.flatnonzero(ses_ids[1:] != ses_ids[:-1]) + 1))
+        for indices in numpy.split(order, starts[1:]):
+            if len(indices):
+                yield self.ses_ids[indices[0]], indices
+
 class StochasticEventSetCollection(object):
     """
     Class representing collection of SESs associated to
-    given source model and GSIM logic tree paths.
+    given source model and GSIM logic tree paths. Ruptures are
+    stored as a :class:`RuptureTable`.
     """
     def __init__(self, smtp, sess):
-        data = []
-        for ses in sess:
-            for rup in ses.rups:
-                lon, lat, depth = rup.surf.get_middle_point()
-                multi_lons, multi_lats = rup.surf.get_surface_boundaries()
-                boundary = 'MULTIPOLYGON(%s)' % \
-                    ','.join(
-                            '((%s))' % ','.join('%s %s' % \
-                                (lon, lat) for lon, lat in zip(lons, lats)) \
-                                for lons, lats in zip(multi_lons, multi_lats)
-                        )
-                data.append([smtp, ses.ID, rup.ID, rup.magnitude,
-                             lon, lat, depth, rup.tect_reg, rup.strike,
-                             rup.dip, rup.rake, boundary])
-
-        self.data = numpy.array(data, dtype=object)
-
-
-def save_sess_to_txt(sesc, output_dir):
-    """
-    Save stochastic event sets collection to .txt files.
-    """
-    ses_ids = numpy.unique(sesc.data[:, 1])
-    for ID in ses_ids:
-        idx = sesc.data[:, 1] == ID
-        fname = '%s/ses_%s.txt' % (output_dir, ID)
-        header = 'id\tmag\tcentroid_lon\tcentroid_lat\tcentroid_depth\ttrt\tstrike\tdip\trake\tboundary'
-        f = open(fname, 'w')
-        f.write(header+'\n')
-        numpy.savetxt(f, sesc.data[idx, 2 :],
-            fmt='%s\t%2.1f\t%5.2f\t%5.2f\t%5.2f\t%s\t%5.2f\t%5.2f\t%5.2f\t%s')
-        f.close()
+        self.smtp = smtp
+        self.table = RuptureTable.from_ruptures(
+            [ses.ID for ses in sess for _ in ses.rups],
+            [rup for ses in sess for rup in ses.rups])
+
+
+def iter_rupture_tables(ruptures, chunk_size=CHUNK_SIZE):
+    """
+    Yield a :class:`RuptureTable` for every `chunk_size` (ses_id, rupture)
+    tuples
+    """
+    ruptures = iter(ruptures)
+    while True:
+        chunk = list(itertools.islice(ruptures, chunk_size))
+        if not chunk:
+            break
+        ses_ids, rups = zip(*chunk)
+        yield RuptureTable.from_ruptures(ses_ids, rups)
+
+def save_sess_to_txt(ruptures, output_dir, chunk_size=CHUNK_SIZE,
+                     boundaries=True, index=False):
+    """
+    Save stochastic event sets to .txt files, one per set. `ruptures` is an
+    iterable of (ses_id, rupture) tuples (e.g. :func:`iter_ruptures`),
+    processed `chunk_size` ruptures at a time, or a
+    :class:`StochasticEventSetCollection`. Rupture boundaries are written
+    (as WKT multipolygons) only if `boundaries` is True. If `index` is True,
+    the index of the ruptures (see :mod:`rupture_index`) is saved in the
+    output directory.
+    """
+    if isinstance(ruptures, StochasticEventSetCollection):
+        tables = [ruptures.table]
+    else:
+        tables = iter_rupture_tables(ruptures, chunk_size)
+
+    header = 'id\tmag\tcentroid_lon\tcentroid_lat\tcentroid_depth\ttrt\tstrike\tdip\trake'
+    fmt = '%s\t%2.1f\t%5.2f\t%5.2f\t%5.2f\t%s\t%5.2f\t%5.2f\t%5.2f'
+    if boundaries:
+        header += '\tboundary'
+        fmt += '\t%s'
+    builder = RuptureIndexBuilder(header) if index else None
+    # a set found again in a later chunk is appended to its file
+    ses_ids = set()
+    for table in tables:
+        for ses_id, indices in table.group_by_ses():
+            fname = '%s/ses_%s.txt' % (output_dir, ses_id)
+            if ses_id in ses_ids:
+                f = open(fname, 'a')
+            else:
+                f = open(fname, 'w')
+                f.write(header+'\n')
+                ses_ids.add(ses_id)
+            with f:
+                for start in xrange(0, len(indices), chunk_size):
+                    chunk = indices[start: start + chunk_size]
+                    rows = table.get_rows(chunk, boundaries)
+                    if builder is None:
+                        savetxt(f, rows, fmt=fmt)
+                        continue
+                    # lines are formatted in memory, to get their positions
+                    f.seek(0, os.SEEK_END)
+                    offset = f.tell()
+                    block = StringIO()
+                    savetxt(block, rows, fmt=fmt)
+                    lines = block.getvalue()
+                    f.write(lines)
+                    builder.add(os.path.basename(fname), offset, lines,
+                                table.ids[chunk], table.magnitudes[chunk],
+                                table.lons[chunk], table.lats[chunk])
+    if builder is not None:
+        builder.build().save(os.path.join(output_dir, RUPTURE_INDEX_FILE))
 
 
 def set_up_arg_parser():
@@ -357,6 +652,14 @@ def set_up_arg_parser():
         help='path to output directory (Required, raise an error if it already exists)',
         default=None,
         required=True)
+    flags.add_argument('--no-boundaries',
+        help='do not write the rupture boundaries (WKT multipolygons)',
+        action='store_true')
+    flags.add_argument('--index',
+        help='save index of the ruptures in the output directory, to query '
+             'them with rupture_index.py',
+        action='store_true')
+    add_progress_arguments(flags)
 
     return parser
 
@@ -365,13 +668,16 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
         # create the output directory immediately. Raise an error if
         # it already exists
         os.makedirs(args.output_dir)
 
-        sesc = parse_sesc_file(args.input_file)
-        save_sess_to_txt(sesc, args.output_dir)
+        with PROGRESS.stage('convert'):
+            save_sess_to_txt(iter_ruptures(args.input_file), args.output_dir,
+                             boundaries=not args.no_boundaries,
+                             index=args.index)
     else:
         parser.print_usage()
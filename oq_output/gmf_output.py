@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Consolidated output of ground motion fields, as an alternative to writing
+a file per rupture (or realization). All the fields of an IMT go to a
+single long-format table with a row per field and site:
+
+* long-csv: .csv file per IMT with columns <event columns>, site_idx, gmv
+* long-hdf5: single HDF5 file (requires h5py) with a group per IMT holding
+  appendable, chunked datasets of the event columns (one row per field)
+  and of event_idx, site_idx and gmv (one row per field and site)
+
+The coordinates of the sites are written once, to a site table. Rows are
+buffered and written in large blocks.
+'''
+import abc
+import os
+import numpy
+from utils import SiteTable
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+LONG_FORMATS = ('long-csv', 'long-hdf5')
+
+# number of rows (field and site pairs) buffered before writing
+BUFFER_SIZE = 1000000
+
+
+class GmfWriter(object):
+    """
+    Base class of the consolidated GMF writers. A field is written with
+    :meth:`write`, giving its event (tuple of values of the event columns,
+    e.g. stochastic event set and rupture ids), its IMT and the indices in
+    the writer site table of the sites with ground motion values. Rows are
+    buffered by IMT until :meth:`flush` (called automatically when
+    `buffer_size` rows are pending, and by :meth:`close`).
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, event_columns, sites=None, buffer_size=BUFFER_SIZE):
+        self.event_columns = tuple(event_columns)
+        self.sites = sites if sites is not None else SiteTable()
+        self.buffer_size = buffer_size
+        self._pending = {}
+        self._n_pending = 0
+
+    def write(self, event, imt, site_indices, gmvs):
+        """
+        Add ground motion values `gmvs` of `event` for `imt` at the sites
+        of the given indices
+        """
+        self._pending.setdefault(imt, []).append(
+            (tuple(event), numpy.asarray(site_indices),
+             numpy.asarray(gmvs)))
+        self._n_pending += len(gmvs)
+        if self._n_pending >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered rows
+        """
+        for imt, fields in self._pending.items():
+            self._write_fields(imt, fields)
+        self._pending = {}
+        self._n_pending = 0
+
+    @abc.abstractmethod
+    def close(self):
+        """
+        Write the buffered rows and the site table and close the output.
+        Return the names of the files written.
+        """
+
+    @abc.abstractmethod
+    def _write_fields(self, imt, fields):
+        """
+        Write list of (event, site indices, gmvs) of an IMT
+        """
+
+
+class CsvGmfWriter(GmfWriter):
+    """
+    Write the fields of each IMT to `out_dir`/gmfs_<IMT>.csv, with a row
+    per field and site (columns <event columns>, site_idx, gmv), and the
+    site table to `out_dir`/sites.csv. Every file starts with the items of
+    `metadata`, if given, as comments. Metadata are read when each file is
+    opened, so they can be filled after the writer is created.
+    """
+    def __init__(self, out_dir, event_columns, metadata=None, sites=None,
+            buffer_size=BUFFER_SIZE):
+        super(CsvGmfWriter, self).__init__(event_columns, sites, buffer_size)
+        self.out_dir = out_dir
+        self.metadata = metadata if metadata is not None else {}
+        self._files = {}
+
+    def _open(self, file_name, columns):
+        """
+        Open file in the output directory and write its header
+        """
+        f = open(os.path.join(self.out_dir, file_name), 'w')
+        for item in sorted(self.metadata.items()):
+            f.write('# %s=%s\n' % item)
+        f.write(','.join(columns) + '\n')
+        return f
+
+    def _write_fields(self, imt, fields):
+        if imt not in self._files:
+            self._files[imt] = self._open(
+                'gmfs_%s.csv' % imt,
+                self.event_columns + ('site_idx', 'gmv'))
+        lines = []
+        for event, site_indices, gmvs in fields:
+            prefix = ''.join('%s,' % value for value in event)
+            items = [None] * (2 * len(gmvs))
+            items[::2] = site_indices.tolist()
+            items[1::2] = gmvs.tolist()
+            lines.append(((prefix.replace('%', '%%') + '%d,%g\n') *
+                          len(gmvs)) % tuple(items))
+        self._files[imt].write(''.join(lines))
+
+    def close(self):
+        self.flush()
+        file_names = [f.name for f in self._files.values()]
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+        f = self._open('sites.csv', ('site_idx', 'lon', 'lat'))
+        for i, (lon, lat) in enumerate(zip(self.sites.lons.tolist(),
+                                           self.sites.lats.tolist())):
+            f.write('%d,%s,%s\n' % (i, lon, lat))
+        f.close()
+
+        return sorted(file_names) + [f.name]
+
+
+class Hdf5GmfWriter(GmfWriter):
+    """
+    Write the fields to HDF5 file `file_name`, with a group per IMT holding
+    a dataset per event column (a row per field) and datasets event_idx,
+    site_idx and gmv (a row per field and site), extended at each flush.
+    The site coordinates are stored in datasets lon and lat, and
+    `metadata` as file attributes when the writer is closed.
+    """
+    def __init__(self, file_name, event_columns, metadata=None, sites=None,
+            buffer_size=BUFFER_SIZE):
+        if h5py is None:
+            raise ImportError('h5py is required to write hdf5 files')
+        super(Hdf5GmfWriter, self).__init__(event_columns, sites,
+                                            buffer_size)
+        self.file_name = file_name
+        self.metadata = metadata if metadata is not None else {}
+        self._file = h5py.File(file_name, 'w')
+
+    def _append(self, group, name, data, dtype):
+        """
+        Append data to the (possibly new) dataset of the group
+        """
+        if name not in group:
+            group.create_dataset(name, shape=(0,), maxshape=(None,),
+                                 dtype=dtype,
+                                 chunks=(min(self.buffer_size, 65536),))
+        dset = group[name]
+        start = len(dset)
+        dset.resize((start + len(data),))
+        dset[start:] = data
+
+    def _write_fields(self, imt, fields):
+        group = self._file.require_group(imt)
+        column = self.event_columns[0]
+        n_events = len(group[column]) if column in group else 0
+        str_type = h5py.special_dtype(vlen=str)
+        for i, column in enumerate(self.event_columns):
+            self._append(group, column,
+                         numpy.array([str(event[i]) for event, _, _ in fields],
+                                     dtype=object), str_type)
+        self._append(group, 'event_idx', numpy.repeat(
+            numpy.arange(n_events, n_events + len(fields)),
+            [len(gmvs) for _, _, gmvs in fields]), numpy.int64)
+        self._append(group, 'site_idx', numpy.concatenate(
+            [site_indices for _, site_indices, _ in fields]), numpy.int64)
+        self._append(group, 'gmv', numpy.concatenate(
+            [gmvs for _, _, gmvs in fields]), numpy.float32)
+
+    def close(self):
+        self.flush()
+        self._file.create_dataset('lon', data=self.sites.lons)
+        self._file.create_dataset('lat', data=self.sites.lats)
+        for key, value in self.metadata.items():
+            self._file.attrs[key] = value
+        self._file.close()
+        return [self.file_name]
+
+
+def get_gmf_writer(output_format, out_dir, event_columns, metadata=None,
+        sites=None):
+    """
+    Return writer of the fields in format `output_format` (see
+    LONG_FORMATS) to directory `out_dir`. Metadata are written as header
+    comments (csv) or attributes (hdf5).
+    """
+    if output_format == 'long-csv':
+        return CsvGmfWriter(out_dir, event_columns, metadata, sites)
+    elif output_format == 'long-hdf5':
+        return Hdf5GmfWriter(os.path.join(out_dir, 'gmfs.hdf5'),
+                             event_columns, metadata, sites)
+    raise ValueError('GMF output format %s not supported (choose from %s)' %
+                     (output_format, ', '.join(LONG_FORMATS)))
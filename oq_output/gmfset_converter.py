@@ -49,9 +49,16 @@ Convert GMF NRML file to .csv files.
 import os
 import csv
 import argparse
+import itertools
 import numpy
+from collections import OrderedDict
 from lxml import etree
-from hazard_map_converter import atkinson_kaka_2007_rsa2mmi, AK2007
+from gmice import GMICE_MODELS, supports_imt, convert_gmv_columns
+from utils import savetxt, SiteTable, SAVETXT_CHUNK_SIZE
+from gridding import Grid, save_rasters, RASTER_FORMATS, BATCH_SIZE
+from binary_io import BINARY_FORMATS, save_arrays, read_arrays
+from gmf_output import LONG_FORMATS, get_gmf_writer
+from progress import PROGRESS, add_progress_arguments, configure
 
 NRML='{http://openquake.org/xmlns/nrml/0.4}'
 
@@ -68,9 +75,63 @@ class GMF(object):
         self.saPeriod = saPeriod
 
 
+class GmfMatrix(object):
+    """
+    Ground motion fields of one IMT in one stochastic event set, stored as
+    the list of the rupture ids and a (n_ruptures, n_sites) float32 matrix
+    of ground motion values. Columns are the sites of the collection
+    site table, NaN for the sites not in a field.
+
+    Rows are preallocated and doubled every time they are exhausted, as for
+    :class:`utils.CurveMatrix`.
+    """
+    def __init__(self, n_sites, size=1):
+        self.rupture_ids = []
+        self._gmvs = numpy.empty((size, n_sites), dtype=numpy.float32)
+
+    def __len__(self):
+        return len(self.rupture_ids)
+
+    @property
+    def gmvs(self):
+        """
+        (n_ruptures, n_sites) array of ground motion values
+        """
+        return self._gmvs[:len(self)]
+
+    def append(self, rupture_id, site_indices, gmvs):
+        """
+        Add the ground motion values of rupture `rupture_id` at the sites
+        of the given indices
+        """
+        n_ruptures = len(self)
+        n_rows, n_sites = self._gmvs.shape
+        if len(site_indices):
+            n_sites = max(n_sites, site_indices.max() + 1)
+        if n_ruptures == n_rows or n_sites > self._gmvs.shape[1]:
+            if n_ruptures == n_rows:
+                n_rows = 2 * max(n_rows, 1)
+            matrix = numpy.empty((n_rows, n_sites), dtype=numpy.float32)
+            matrix[:n_ruptures] = numpy.nan
+            matrix[:n_ruptures, :self._gmvs.shape[1]] = self.gmvs
+            self._gmvs = matrix
+
+        row = self._gmvs[n_ruptures]
+        row.fill(numpy.nan)
+        row[site_indices] = gmvs
+        self.rupture_ids.append(rupture_id)
+
+    def compact(self):
+        """
+        Release the rows preallocated but not used
+        """
+        self._gmvs = self.gmvs.copy()
+
+
 class GmfSet(object):
     """
-    GMF Set.
+    GMF Set. `gmfs` is a dictionary of :class:`GmfMatrix` instances keyed
+    by IMT.
     """
     def __init__(self, stochasticEventSetId, investigationTime, gmfs):
         self.stochasticEventSetId = stochasticEventSetId
@@ -80,62 +141,128 @@ class GmfSet(object):
 
 class GmfCollection(object):
     """
-    GMF collection.
+    GMF collection. `sites` is the :class:`utils.SiteTable` shared by the
+    ground motion fields of all the sets.
     """
-    def __init__(self, sm_tp, gsim_tp, gmfss):
+    def __init__(self, sm_tp, gsim_tp, gmfss, sites=None):
         self.sm_tp = sm_tp
         self.gsim_tp = gsim_tp
         self.gmfss = gmfss
-
-
-def parse_gmfc_file(file_name):
+        self.sites = sites if sites is not None else SiteTable()
+
+    def get_gmvs(self, gmf_set, imt):
+        """
+        Return (n_ruptures, n_sites) matrix of the ground motion values of
+        an IMT in a set, with a column for each site in the table
+        """
+        gmvs = gmf_set.gmfs[imt].gmvs
+        if gmvs.shape[1] < len(self.sites):
+            # sites added after the last field of the set
+            padded = numpy.empty((len(gmvs), len(self.sites)),
+                                 dtype=numpy.float32)
+            padded.fill(numpy.nan)
+            padded[:, :gmvs.shape[1]] = gmvs
+            gmvs = padded
+        return gmvs
+
+
+def iter_gmf_records(file_name, metadata=None, investigation_times=None,
+        set_callback=None):
     """
-    Parse NRML 0.4 GMF collection file.
+    Parse NRML 0.4 GMF collection file incrementally, yielding a
+    (ses_id, imt, rupture_id, values) record for each ground motion field,
+    where values is a (n, 3) array of longitude, latitude and ground motion
+    value. Elements are cleared as soon as they are consumed, so memory use
+    does not depend on the size of the file.
+
+    Dictionaries `metadata` and `investigation_times`, if given, are filled
+    as the file is read with the logic tree paths of the collection (keys
+    'smltp' and 'gsimltp') and with the investigation times of the sets.
+    `set_callback`, if given, is called as set_callback(event, ses_id) with
+    event 'start' and 'end' at the boundaries of each set, including sets
+    without fields.
     """
-    parse_args = dict(source=file_name)
-
-    for _, element in etree.iterparse(**parse_args):
-        if element.tag == '%sgmfCollection' % NRML:
-            gmfc = parse_gmfc_collection(element)
-            element.clear()
-
-    return gmfc
-
-def parse_gmfc_collection(element):
+    ses_id = None
+    with PROGRESS.open(file_name) as source:
+        for event, element in etree.iterparse(
+                source, events=('start', 'end'),
+                tag=['%sgmfCollection' % NRML, '%sgmfSet' % NRML,
+                     '%sgmf' % NRML]):
+            if element.tag == '%sgmfCollection' % NRML:
+                if event == 'start' and metadata is not None:
+                    metadata['smltp'] = element.attrib['sourceModelTreePath']
+                    metadata['gsimltp'] = element.attrib['gsimTreePath']
+            elif element.tag == '%sgmfSet' % NRML:
+                if event == 'start':
+                    ses_id = element.attrib['stochasticEventSetId']
+                    if investigation_times is not None:
+                        investigation_times[ses_id] = \
+                            element.attrib['investigationTime']
+                    if set_callback is not None:
+                        set_callback('start', ses_id)
+                else:
+                    if set_callback is not None:
+                        set_callback('end', ses_id)
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+            elif event == 'end':
+                gmf = parse_gmf(element)
+                IMT = gmf.IMT if gmf.IMT != 'SA' else \
+                    '%s(%s)' % (gmf.IMT, gmf.saPeriod)
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                PROGRESS.update()
+                yield ses_id, IMT, gmf.ruptureId, gmf.values
+
+def iter_collection_records(gmf_collection):
     """
-    Parse NRML 0.4 GMF collection element.
+    Yield the (ses_id, imt, rupture_id, values) records of the ground
+    motion fields of a collection, as :func:`iter_gmf_records`
     """
-    sm_tp = element.attrib['sourceModelTreePath']
-    gsim_tp = element.attrib['gsimTreePath']
-
-    gmfss = []
-    for e in element.iterchildren():
-        gmfss.append(parse_gmf_set(e))
-        e.clear()
-
-    return GmfCollection(sm_tp, gsim_tp, gmfss)
+    sites = gmf_collection.sites
+    for gmf_set in gmf_collection.gmfss:
+        for imt in gmf_set.gmfs.keys():
+            gmvs = gmf_collection.get_gmvs(gmf_set, imt)
+            for rup_id, row in zip(gmf_set.gmfs[imt].rupture_ids, gmvs):
+                valid = ~numpy.isnan(row)
+                yield gmf_set.stochasticEventSetId, imt, rup_id, \
+                    numpy.column_stack((sites.lons[valid], sites.lats[valid],
+                                        row[valid]))
 
-def parse_gmf_set(element):
+def parse_gmfc_file(file_name):
     """
-    Parse NRML 0.4 GMF set element.
+    Parse NRML 0.4 GMF collection file. The ground motion values are
+    stored in one :class:`GmfMatrix` per set and IMT, with the site
+    coordinates stored only once.
     """
-    stochasticEventSetId = element.attrib['stochasticEventSetId']
-    investigationTime = element.attrib['investigationTime']
-    print 'Processing gmf set %s' % stochasticEventSetId
-
-    gmfs = {}
-    for e in element.iterchildren():
-        gmf = parse_gmf(e)
-        IMT = gmf.IMT if gmf.IMT != 'SA' else '%s(%s)' % (gmf.IMT, gmf.saPeriod)
-
-        if IMT in gmfs.keys():
-            gmfs[IMT].append((gmf.ruptureId, gmf.values))
+    metadata = {}
+    investigation_times = {}
+    sites = SiteTable()
+    gmfss = OrderedDict()
+
+    def set_callback(event, ses_id):
+        if event == 'start':
+            if ses_id not in gmfss:
+                gmfss[ses_id] = GmfSet(ses_id, investigation_times[ses_id],
+                                       OrderedDict())
         else:
-            gmfs[IMT] = [(gmf.ruptureId, gmf.values)]
-
-        e.clear()
-
-    return GmfSet(stochasticEventSetId, investigationTime, gmfs)
+            # the matrices of a set are complete when the set ends
+            for matrix in gmfss[ses_id].gmfs.values():
+                matrix.compact()
+
+    for ses_id, imt, rup_id, values in iter_gmf_records(
+            file_name, metadata, investigation_times, set_callback):
+        gmfs = gmfss[ses_id].gmfs
+        if imt not in gmfs:
+            gmfs[imt] = GmfMatrix(len(sites))
+        gmfs[imt].append(rup_id, sites.get_indices(values[:, 0],
+                                                   values[:, 1]),
+                         values[:, 2])
+
+    return GmfCollection(metadata.get('smltp'), metadata.get('gsimltp'),
+                         list(gmfss.values()), sites)
 
 def parse_gmf(element):
     """
@@ -149,97 +276,354 @@ def parse_gmf(element):
         saDamping = element.attrib['saDamping']
         saPeriod = element.attrib['saPeriod']
 
-    print 'Processing gmf %s' % ruptureId
-    lons = []
-    lats = []
-    values = []
-    for e in element.iterchildren():
-        lons.append(float(e.attrib['lon']))
-        lats.append(float(e.attrib['lat']))
-        values.append(float(e.attrib['gmv']))
-        e.clear()
-    values = numpy.array([lons, lats, values]).T
+    values = numpy.array(
+        [(e.attrib['lon'], e.attrib['lat'], e.attrib['gmv'])
+         for e in element.iterchildren()], dtype=numpy.float64)
+    values = values.reshape(-1, 3)
 
     return GMF(IMT, ruptureId, values, saDamping, saPeriod)
 
+def write_gmfs_to_csv(records, out_dir, metadata):
+    """
+    Write (ses_id, imt, rupture_id, values) records to a .csv file per
+    rupture, in a directory per set and IMT created when its first record
+    arrives. `metadata` holds the logic tree paths of the header.
+    """
+    dir_names = {}
+    for ses_id, imt, rup_id, values in records:
+        dir_name = dir_names.get((ses_id, imt))
+        if dir_name is None:
+            dir_name = dir_names[ses_id, imt] = \
+                '%s/StochasticEventSet_%s_%s' % (out_dir, ses_id, imt)
+            os.makedirs(dir_name)
+        header = '# smltp=%s, gsimltp=%s' % \
+            (metadata['smltp'], metadata['gsimltp'])
+        header += '\n# IMT=%s' % imt
+        header += '\nlon,lat,gmf_value'
+        fname = '%s/%s.csv' % (dir_name, rup_id)
+        f = open(fname, 'w')
+        f.write(header+'\n')
+        savetxt(f, values, fmt='%5.2f,%5.2f,%g')
+        f.close()
+
 def save_gmfs_to_csv(gmf_collection, out_dir):
     """
-    Save GMFs to .csv files
+    Save GMFs to .csv files. Values come from the float32 matrices of the
+    collection and rows follow the order of the site table; to reproduce
+    the node order and full precision of the NRML file write the records
+    of :func:`iter_gmf_records` with :func:`write_gmfs_to_csv` instead.
+    """
+    write_gmfs_to_csv(iter_collection_records(gmf_collection), out_dir,
+                      dict(smltp=gmf_collection.sm_tp,
+                           gsimltp=gmf_collection.gsim_tp))
+
+def write_gmfs_to_long_format(records, out_dir, metadata,
+        output_format='long-csv'):
+    """
+    Write (ses_id, imt, rupture_id, values) records to consolidated
+    long-format output (see :mod:`gmf_output`) in `out_dir`, with a row
+    per rupture and site. `metadata` is read when the output is written,
+    so it can be filled while the records are produced. Return the names
+    of the files written.
+    """
+    writer = get_gmf_writer(output_format, out_dir, ('ses_id', 'rupture_id'),
+                            metadata)
+    for ses_id, imt, rup_id, values in records:
+        site_indices = writer.sites.get_indices(values[:, 0], values[:, 1])
+        writer.write((ses_id, rup_id), imt, site_indices, values[:, 2])
+    return writer.close()
+
+def save_gmfs_to_long_format(gmf_collection, out_dir,
+        output_format='long-csv'):
+    """
+    Save GMFs to consolidated long-format output (see :mod:`gmf_output`)
+    in `out_dir`, with a row per rupture and site. Return the names of the
+    files written.
     """
+    writer = get_gmf_writer(output_format, out_dir, ('ses_id', 'rupture_id'),
+                            dict(smltp=gmf_collection.sm_tp,
+                                 gsimltp=gmf_collection.gsim_tp),
+                            gmf_collection.sites)
     for gmf_set in gmf_collection.gmfss:
         for imt in gmf_set.gmfs.keys():
-            dir_name = '%s/StochasticEventSet_%s_%s' % \
-                (out_dir, gmf_set.stochasticEventSetId, imt)
-            os.makedirs(dir_name)
+            gmvs = gmf_collection.get_gmvs(gmf_set, imt)
+            for rup_id, row in zip(gmf_set.gmfs[imt].rupture_ids, gmvs):
+                site_indices = numpy.flatnonzero(~numpy.isnan(row))
+                writer.write((gmf_set.stochasticEventSetId, rup_id), imt,
+                             site_indices, row[site_indices])
+    return writer.close()
+
+def save_sites_to_csv(gmf_collection, file_name):
+    """
+    Save the site table of a GMF collection to .csv file, one row per site
+    index
+    """
+    sites = gmf_collection.sites
+    f = open(file_name, 'w')
+    f.write('site_idx,lon,lat\n')
+    savetxt(f, numpy.column_stack((numpy.arange(len(sites)), sites.lons,
+                                   sites.lats)), fmt='%d,%s,%s')
+    f.close()
+
+def save_gmfs_to_wide_csv(gmf_collection, file_name_root,
+        chunk_size=SAVETXT_CHUNK_SIZE):
+    """
+    Save GMFs to the single .csv file `file_name_root`.csv, with a row per
+    set, IMT and rupture and a column per site (empty for the sites not in
+    a field). The site coordinates are saved to `file_name_root`_sites.csv.
+    Return the names of the two files.
+    """
+    sites_file = '%s_sites.csv' % file_name_root
+    save_sites_to_csv(gmf_collection, sites_file)
+
+    n_sites = len(gmf_collection.sites)
+    row_format = '%s,%s,%s' + ',%g' * n_sites + '\n'
+    output_file = '%s.csv' % file_name_root
+    f = open(output_file, 'w')
+    f.write('# smltp=%s, gsimltp=%s\n' %
+            (gmf_collection.sm_tp, gmf_collection.gsim_tp))
+    f.write('ses_id,imt,rupture_id,%s\n' %
+            ','.join('site_%d' % i for i in range(n_sites)))
+    for gmf_set in gmf_collection.gmfss:
+        for imt, matrix in gmf_set.gmfs.items():
+            gmvs = gmf_collection.get_gmvs(gmf_set, imt)
+            for start in range(0, len(matrix), chunk_size):
+                items = []
+                block = gmvs[start:start + chunk_size].tolist()
+                rup_ids = matrix.rupture_ids[start:start + chunk_size]
+                for rup_id, row in zip(rup_ids, block):
+                    items.extend((gmf_set.stochasticEventSetId, imt, rup_id))
+                    items.extend(row)
+                f.write(((row_format * len(block)) % tuple(items)).replace(
+                    ',nan', ','))
+    f.close()
+
+    return output_file, sites_file
+
+def save_gmfs_to_binary(gmf_collection, file_name_root, output_format='npz'):
+    """
+    Save GMFs to binary file `file_name_root` plus extension (.npz or
+    .hdf5). Site coordinates are stored once, in arrays 'lon' and 'lat'.
+    The fields of the i-th set and IMT (listed in arrays 'ses_ids',
+    'investigation_times' and 'imts') are stored in arrays 'gmvs_i'
+    (n_ruptures, n_sites) and 'rupture_ids_i'. Return the name of the file.
+    """
+    arrays = dict(lon=gmf_collection.sites.lons,
+                  lat=gmf_collection.sites.lats)
+    ses_ids = []
+    investigation_times = []
+    imts = []
+    for gmf_set in gmf_collection.gmfss:
+        for imt, matrix in gmf_set.gmfs.items():
+            i = len(imts)
+            arrays['gmvs_%d' % i] = gmf_collection.get_gmvs(gmf_set, imt)
+            arrays['rupture_ids_%d' % i] = numpy.array(matrix.rupture_ids,
+                                                       dtype=str)
+            ses_ids.append(gmf_set.stochasticEventSetId)
+            investigation_times.append(gmf_set.investigationTime)
+            imts.append(imt)
+    arrays['ses_ids'] = numpy.array(ses_ids, dtype=str)
+    arrays['investigation_times'] = numpy.array(investigation_times,
+                                                dtype=str)
+    arrays['imts'] = numpy.array(imts, dtype=str)
+
+    metadata = dict(sm_tp=gmf_collection.sm_tp,
+                    gsim_tp=gmf_collection.gsim_tp)
+    return save_arrays(file_name_root, metadata, arrays, output_format)
+
+def read_gmfs_binary(file_name):
+    """
+    Read GMF collection from binary file written by
+    :func:`save_gmfs_to_binary`. Ground motion values are read-only memory
+    maps when possible.
+    """
+    metadata, arrays = read_arrays(file_name)
+    sites = SiteTable()
+    sites.get_indices(arrays['lon'], arrays['lat'])
 
-            map_values = []
-            for rup_id, values in gmf_set.gmfs[imt]:
-                print 'saving file for rupture %s' % rup_id
-                header = '# smltp=%s, gsimltp=%s' % \
-                    (gmf_collection.sm_tp, gmf_collection.gsim_tp)
-                header += '\n# IMT=%s' % imt
-                header += '\nlon,lat,gmf_value'
-                fname = '%s/%s.csv' % (dir_name, rup_id)
-                f = open(fname, 'w')
-                f.write(header+'\n')
-                numpy.savetxt(f, values, fmt='%5.2f,%5.2f,%g')
-                f.close()
+    gmfss = []
+    gmf_set = None
+    for i, (ses_id, investigation_time, imt) in enumerate(zip(
+            arrays['ses_ids'], arrays['investigation_times'],
+            arrays['imts'])):
+        if gmf_set is None or gmf_set.stochasticEventSetId != ses_id:
+            gmf_set = GmfSet(str(ses_id), str(investigation_time),
+                             OrderedDict())
+            gmfss.append(gmf_set)
+        matrix = GmfMatrix(len(sites), size=0)
+        matrix.rupture_ids = [str(rup_id)
+                              for rup_id in arrays['rupture_ids_%d' % i]]
+        matrix._gmvs = arrays['gmvs_%d' % i]
+        gmf_set.gmfs[str(imt)] = matrix
+
+    return GmfCollection(str(metadata['sm_tp']), str(metadata['gsim_tp']),
+                         gmfss, sites)
+
+class ExceedanceCounter(object):
+    """
+    Per-site counts of the ground motion values greater than or equal to
+    each of `imls`, accumulated one field at a time. A field only adds one
+    to a bin of a per-site histogram (found by binary search among the
+    IMLs), and the counts are the reverse cumulative sums of the histograms,
+    so that memory use is O(n_sites x n_imls) whatever the number of
+    ruptures.
+    """
+    def __init__(self, imls):
+        self.imls = numpy.sort(numpy.asarray(imls, dtype=numpy.float64))
+        self._hist = numpy.zeros((0, len(self.imls) + 1), dtype=numpy.int64)
+
+    def add(self, site_indices, gmvs):
+        """
+        Count the ground motion values of a field at the sites of the given
+        (distinct) indices
+        """
+        if not len(site_indices):
+            return
+        n_sites = site_indices.max() + 1
+        if n_sites > len(self._hist):
+            hist = numpy.zeros((max(n_sites, 2 * len(self._hist)),
+                                len(self.imls) + 1), dtype=numpy.int64)
+            hist[:len(self._hist)] = self._hist
+            self._hist = hist
+        bins = numpy.searchsorted(self.imls, gmvs, side='right')
+        self._hist.ravel()[site_indices * (len(self.imls) + 1) + bins] += 1
+
+    def get_counts(self, n_sites):
+        """
+        Return (n_sites, n_imls) array of the exceedance counts
+        """
+        hist = numpy.zeros((n_sites, len(self.imls) + 1), dtype=numpy.int64)
+        n_counted = min(n_sites, len(self._hist))
+        hist[:n_counted] = self._hist[:n_counted]
+        return numpy.cumsum(hist[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+
+def compute_hazard_curves(file_name, imls):
+    """
+    Compute event-based hazard curves from the GMF collection in NRML file
+    `file_name`, streaming the fields. The exceedance counts of `imls` at
+    each site are converted to poes in the investigation time T of the
+    sets with poe = 1 - exp(-counts / total_time * T), where total_time
+    is the sum of the investigation times of the sets.
+
+    Return dictionary of (metadata, poes) tuples keyed by IMT, with poes
+    a (n_sites, n_imls) array, and (n_sites, 2) array of site coordinates.
+    """
+    metadata = {}
+    investigation_times = {}
+    sites = SiteTable()
+    counters = OrderedDict()
+    for _, imt, _, values in iter_gmf_records(file_name, metadata,
+                                              investigation_times):
+        if imt not in counters:
+            counters[imt] = ExceedanceCounter(imls)
+        counters[imt].add(sites.get_indices(values[:, 0], values[:, 1]),
+                          values[:, 2])
+
+    times = set(investigation_times.values())
+    if not times:
+        raise ValueError('No stochastic event set found in GMF collection '
+                         'file %s' % file_name)
+    if len(times) > 1:
+        raise ValueError('Stochastic event sets with different investigation '
+                         'times: %s' % ', '.join(sorted(times)))
+    investigation_time = times.pop()
+    total_time = float(investigation_time) * len(investigation_times)
+
+    curves = OrderedDict()
+    for imt, counter in counters.items():
+        counts = counter.get_counts(len(sites))
+        poes = 1. - numpy.exp(-counts / total_time *
+                              float(investigation_time))
+        imt_metadata = dict(smlt_path=metadata['smltp'],
+                            gsimlt_path=metadata['gsimltp'], imt=imt,
+                            investigation_time=investigation_time,
+                            imls=counter.imls.tolist())
+        if imt.startswith('SA('):
+            imt_metadata['imt'] = 'SA'
+            imt_metadata['sa_period'] = imt[3:-1]
+        curves[imt] = (imt_metadata, poes)
+
+    return curves, numpy.column_stack((sites.lons, sites.lats))
+
+def save_hazard_curves_from_gmfs(file_name, out_dir, imls):
+    """
+    Compute event-based hazard curves (see :func:`compute_hazard_curves`)
+    and save them to `out_dir`/hazard_curves_<IMT>.csv, in the layout of
+    :func:`hazard_curve_converter.save_hazard_curves_to_csv`. Return the
+    names of the files.
+    """
+    # imported here, as it needs matplotlib for the plots
+    from hazard_curve_converter import write_hazard_curves_csv
+
+    curves, coords = compute_hazard_curves(file_name, imls)
+    file_names = []
+    for imt, (metadata, poes) in curves.items():
+        file_names.append('%s/hazard_curves_%s.csv' % (out_dir, imt))
+        write_hazard_curves_csv(file_names[-1], metadata,
+                                numpy.hstack((coords, poes)))
+    return file_names
 
 def save_gmfs_to_netcdf(gmf_collection, out_dir, to_mmi=False, spacing="10k",
-        cleanup=False):
+        cleanup=False, output_format='netcdf', jobs=1, gmice='AK2007'):
     """
-    Exports the ground motion fields to NetCDF format
+    Exports the ground motion fields to NetCDF (or GeoTIFF) format. Rasters
+    are written by `jobs` worker processes. `cleanup` is ignored (no .xyz
+    files are created any more) and kept for backward compatibility.
     """
-    for gmf_set in gmf_collection.gmfss:
-        for imt in gmf_set.gmfs.keys():
-            dir_name = '%s/StochasticEventSet_%s_%s' % \
-                (out_dir, gmf_set.stochasticEventSetId, imt)
-            os.makedirs(dir_name)
-            if to_mmi:
-                if imt in AK2007.keys():
-                    get_mmi = True
-                else:
-                    print "Cannot convert %s to MMI" % imt
-                    get_mmi = False
-            else:
-                get_mmi = False
-
-            map_values = []
-            for rup_id, values in gmf_set.gmfs[imt]:
-                rup_id = rup_id.replace("|","_")
-                rup_id = rup_id.replace("=","")
-
-                print 'saving file for rupture %s' % rup_id
-                if get_mmi:
-                    values[:, 2], sigma = atkinson_kaka_2007_rsa2mmi(
-                        imt, 
-                        values[:, 2])
-                f_stem = '%s/%s' % (dir_name, rup_id)
-
-                f = open(f_stem + ".xyz", 'w')
-                numpy.savetxt(f, values, fmt='%5.2f %5.2f %g')
-                f.close()
-                # Generate GMT xyz2grd string
-                values = numpy.array(values)
-                llon = numpy.min(values[:, 0])
-                ulon = numpy.max(values[:, 0])
-                llat = numpy.min(values[:, 1])
-                ulat = numpy.max(values[:, 1])
-                istring = " -I%s/%s" % (spacing, spacing)
-                rstring = " -R" + "{:.5f}/".format(llon) + \
-                    "{:.5f}/".format(ulon) + "{:.5f}/".format(llat) +\
-                    "{:.5f}".format(ulat)
-                if "SA" in imt:
-                    mod1 = f_stem.replace("(", "\(")
-                    f_stem = mod1.replace(")", "\)")
-                
-                command_string = ("xyz2grd %s -G%s" % (f_stem + ".xyz",
-                                  f_stem + ".NC")) + istring + rstring
-                os.system(command_string)
-    if cleanup:
-        os.system("find . -name '*.xyz' -type f -delete")
+    write_gmfs_to_rasters(iter_collection_records(gmf_collection), out_dir,
+                          to_mmi, spacing, output_format, jobs, gmice)
 
+def write_gmfs_to_rasters(records, out_dir, to_mmi=False, spacing="10k",
+        output_format='netcdf', jobs=1, gmice='AK2007'):
+    """
+    Write (ses_id, imt, rupture_id, values) records to NetCDF (or GeoTIFF)
+    rasters, in a directory per set and IMT created when its first record
+    arrives. Rasters are written by `jobs` worker processes.
+    """
+    save_rasters(_gmf_rasters(records, out_dir, to_mmi, spacing, gmice),
+                 output_format, jobs)
 
+def _gmf_rasters(records, out_dir, to_mmi, spacing, gmice,
+        batch_size=BATCH_SIZE):
+    """
+    Yield (file name root, grid, values, name) of the ground motion fields.
+    The grid is only rebuilt when the sites change. Records are read in
+    batches of `batch_size`, and the values of each IMT in a batch are
+    converted to MMI with a single vectorized call.
+    """
+    grid = None
+    dir_names = {}
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        if to_mmi:
+            gmfs = OrderedDict()
+            for _, imt, _, values in batch:
+                gmfs.setdefault(imt, []).append(values)
+            for imt, imt_gmfs in gmfs.items():
+                if supports_imt(imt, gmice):
+                    convert_gmv_columns(imt_gmfs, imt, gmice)
+
+        for ses_id, imt, rup_id, values in batch:
+            get_mmi = to_mmi and supports_imt(imt, gmice)
+            dir_name = dir_names.get((ses_id, imt))
+            if dir_name is None:
+                dir_name = dir_names[ses_id, imt] = \
+                    '%s/StochasticEventSet_%s_%s' % (out_dir, ses_id, imt)
+                os.makedirs(dir_name)
+                if to_mmi and not get_mmi:
+                    print "Cannot convert %s to MMI" % imt
+
+            if grid is None or not grid.has_sites(values[:, 0],
+                                                  values[:, 1]):
+                grid = Grid.from_sites(values[:, 0], values[:, 1], spacing)
+            rup_id = rup_id.replace("|","_")
+            rup_id = rup_id.replace("=","")
+            yield ('%s/%s' % (dir_name, rup_id), grid, values[:, 2],
+                   'mmi' if get_mmi else imt)
 
 def set_up_arg_parser():
     """
@@ -263,24 +647,55 @@ def set_up_arg_parser():
         help='path to output directory (Required, raise an error if it already exists)',
         default=None,
         required=True)
+    flags.add_argument('--output-format',
+        help="Format of the ground motion fields: csv (one file per "
+             "rupture, default), wide-csv (a single file with a column per "
+             "site), npz or hdf5 (a matrix per set and IMT), long-csv (a "
+             "file per IMT with a row per rupture and site) or long-hdf5 "
+             "(appendable version of long-csv)",
+        choices=('csv', 'wide-csv') + BINARY_FORMATS + LONG_FORMATS,
+        default='csv')
+    flags.add_argument('--hazard-curves',
+        help="Instead of the fields, save event-based hazard curves of "
+             "these comma separated IMLs, computed from the exceedance "
+             "counts of the ground motion values at each site",
+        default=None)
     flags.add_argument('--to-netcdf',
-        help='Converts files to netcdf format for use with GMT/QGis',
+        help='Converts files to netcdf (or geotiff, see --raster-format) '
+             'format for use with GMT/QGis',
         default=False,
         required=False)
     flags.add_argument('--spacing',
-        help="Approximate spacing (km) of interpolated mesh",
+        help="Approximate spacing of the raster when sites are not on a "
+             "regular grid: ##k (km), ##m (arc minutes) or ## (degrees)",
         default="10k",
         required=False)
+    flags.add_argument('--raster-format',
+        help="Format of the rasters written with --to-netcdf (default "
+             "netcdf)",
+        choices=sorted(RASTER_FORMATS),
+        default='netcdf')
+    flags.add_argument('--jobs',
+        help="Number of processes writing the rasters (default 1)",
+        type=int,
+        default=1)
     flags.add_argument('--to-mmi',
-        help="Convert the ground motion values to MMI using the model of "
-             "Atkinson & Kaka (2007) - Note this will only apply to PGA, PGV "
-             "SA(0.3), SA(1.0), SA(2.0)",
+        help="Convert the ground motion values to MMI using the model "
+             "selected with --gmice, by default Atkinson & Kaka (2007) - "
+             "Note this will only apply to PGA, PGV SA(0.3), SA(1.0), "
+             "SA(2.0)",
         default=False,
         required=False)
+    flags.add_argument('--gmice',
+        help="Ground motion to intensity conversion model used with "
+             "--to-mmi (default AK2007)",
+        choices=sorted(GMICE_MODELS),
+        default='AK2007')
     flags.add_argument('--cleanup',
-        help="Removes .xyz files after creation of NetCDF",
+        help="Deprecated and ignored: no .xyz files are created any more",
         default=False,
         required=False)
+    add_progress_arguments(flags)
     return parser
 
 
@@ -288,17 +703,43 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
         # create the output directory immediately. Raise an error if
         # it already exists
         os.makedirs(args.output_dir)
 
-        gmfc = parse_gmfc_file(args.input_file)
-        if args.to_netcdf:
-            save_gmfs_to_netcdf(gmfc, args.output_dir, args.to_mmi,
-                args.spacing, args.cleanup)
+        # the per-rupture and long-format outputs are written while the
+        # file is parsed, the other outputs need the whole collection
+        metadata = {}
+        records = iter_gmf_records(args.input_file, metadata)
+        if args.hazard_curves:
+            with PROGRESS.stage('hazard curves'):
+                save_hazard_curves_from_gmfs(
+                    args.input_file, args.output_dir,
+                    [float(iml) for iml in args.hazard_curves.split(',')])
+        elif args.to_netcdf:
+            with PROGRESS.stage('convert'):
+                write_gmfs_to_rasters(records, args.output_dir, args.to_mmi,
+                    args.spacing, args.raster_format, args.jobs, args.gmice)
+        elif args.output_format == 'csv':
+            with PROGRESS.stage('convert'):
+                write_gmfs_to_csv(records, args.output_dir, metadata)
+        elif args.output_format in LONG_FORMATS:
+            with PROGRESS.stage('convert'):
+                write_gmfs_to_long_format(records, args.output_dir, metadata,
+                                          args.output_format)
         else:
-            save_gmfs_to_csv(gmfc, args.output_dir)
+            with PROGRESS.stage('parse'):
+                gmfc = parse_gmfc_file(args.input_file)
+            with PROGRESS.stage('write'):
+                if args.output_format == 'wide-csv':
+                    save_gmfs_to_wide_csv(
+                        gmfc, os.path.join(args.output_dir, 'gmf_collection'))
+                else:
+                    save_gmfs_to_binary(
+                        gmfc, os.path.join(args.output_dir, 'gmf_collection'),
+                        args.output_format)
     else:
         parser.print_usage()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Ground motion to intensity conversion equations (GMICE).
+
+Each model is defined by a table of coefficients per IMT, for a bilinear
+relation between MMI and the logarithm of the ground motion Y:
+
+    MMI = C1 + C2 * log10(Y)    for log10(Y) <= logy15
+    MMI = C3 + C4 * log10(Y)    for log10(Y) > logy15
+
+where Y is in the units of the model, obtained multiplying the ground
+motion (g for PGA and SA, cm/s for PGV) by `cfact`, and sigma1 is the
+standard deviation of MMI. New models are added by registering their
+table in `GMICE_MODELS`.
+'''
+import numpy
+
+# Atkinson & Kaka (2007), without magnitude and distance terms
+AK2007 = {"PGA": {"C1": 2.65, "C2": 1.39, "C3": -1.91, "C4": 4.09, 
+                  "logy15": 1.69, "sigma1": 1.01, "cfact": 980.665},
+          "SA(0.3)": {"C1": 2.40, "C2": 1.36, "C3": -1.83, "C4": 3.56,
+                      "logy15" :1.92, "sigma1": 0.88, "cfact": 980.665},
+          "SA(1.0)": {"C1": 3.23, "C2": 1.18, "C3": 0.57, "C4": 2.95,
+                      "logy15": 1.50, "sigma1": 0.84, "cfact": 980.665},
+          "SA(2.0)": {"C1": 3.72, "C2": 1.29, "C3": 1.99, "C4": 3.00,
+                      "logy15": 1.00, "sigma1": 0.86, "cfact": 980.665},
+          "PGV": {"C1": 4.37, "C2": 1.32, "C3": 3.54, "C4": 3.03, 
+                  "logy15": 0.48, "sigma1": 0.8, "cfact": 1.}}
+
+# Worden, Gerstenberger, Rhoades & Wald (2012), without magnitude and
+# distance terms
+WGRW12 = {"PGA": {"C1": 1.78, "C2": 1.55, "C3": -1.60, "C4": 3.70,
+                  "logy15": 1.57, "sigma1": 0.73, "cfact": 980.665},
+          "PGV": {"C1": 3.78, "C2": 1.47, "C3": 2.89, "C4": 3.16,
+                  "logy15": 0.53, "sigma1": 0.65, "cfact": 1.},
+          "SA(0.3)": {"C1": 1.26, "C2": 1.69, "C3": -4.15, "C4": 4.14,
+                      "logy15": 2.21, "sigma1": 0.84, "cfact": 980.665},
+          "SA(1.0)": {"C1": 2.50, "C2": 1.51, "C3": 0.20, "C4": 2.90,
+                      "logy15": 1.65, "sigma1": 0.80, "cfact": 980.665},
+          "SA(3.0)": {"C1": 3.81, "C2": 1.17, "C3": 1.99, "C4": 3.01,
+                      "logy15": 0.99, "sigma1": 0.95, "cfact": 980.665}}
+
+# Wald, Quitoriano, Heaton & Kanamori (1999)
+WALD99 = {"PGA": {"C1": 1.00, "C2": 2.20, "C3": -1.66, "C4": 3.66,
+                  "logy15": 1.82, "sigma1": 1.08, "cfact": 980.665},
+          "PGV": {"C1": 3.40, "C2": 2.10, "C3": 2.35, "C4": 3.47,
+                  "logy15": 0.76, "sigma1": 0.98, "cfact": 1.}}
+
+GMICE_MODELS = {'AK2007': AK2007, 'WGRW12': WGRW12, 'Wald99': WALD99}
+
+# maximum value of the MMI scale
+MAX_MMI = 10.0
+
+
+def get_gmice(model):
+    """
+    Return the coefficients table of a GMICE model
+    """
+    if model not in GMICE_MODELS:
+        raise ValueError('Unknown GMICE model %s, must be one of %s' %
+                         (model, ', '.join(sorted(GMICE_MODELS))))
+    return GMICE_MODELS[model]
+
+
+def _table_key(imt):
+    """
+    Return the key of an IMT in the coefficients tables, with the SA
+    period written as a float (e.g. 'SA(1)' -> 'SA(1.0)')
+    """
+    if imt.startswith('SA(') and imt.endswith(')'):
+        try:
+            return 'SA(%s)' % float(imt[3:-1])
+        except ValueError:
+            pass
+    return imt
+
+
+def supports_imt(imt, model='AK2007'):
+    """
+    True if the model converts the IMT to MMI
+    """
+    return _table_key(imt) in get_gmice(model)
+
+
+def _coefficients(imts, model):
+    """
+    Return dictionary of (n_imts,) arrays of coefficients
+    """
+    table = get_gmice(model)
+    unsupported = [imt for imt in imts if _table_key(imt) not in table]
+    if unsupported:
+        raise ValueError('IMT(s) %s not convertible to MMI with %s' %
+                         (', '.join(unsupported), model))
+    return dict((key, numpy.array([table[_table_key(imt)][key]
+                                   for imt in imts]))
+                for key in ('C1', 'C2', 'C3', 'C4', 'logy15', 'sigma1',
+                            'cfact'))
+
+
+def gm_to_mmi(values, imts, model='AK2007', return_sigma=False):
+    """
+    Convert ground motion values to MMI.
+
+    :param values:
+        array of ground motion values, of shape (n_sites,) for a single IMT
+        or (n_sites, n_imts), one column per IMT
+    :param imts:
+        IMT (e.g. 'PGA', 'SA(1.0)') or list of IMTs of the columns
+    :returns:
+        MMI array of the same shape as values, and also sigma array of the
+        same shape if `return_sigma` is True
+    """
+    values = numpy.asarray(values, dtype=float)
+    if isinstance(imts, basestring):
+        coeffs = dict((key, value[0]) for key, value in
+                      _coefficients([imts], model).items())
+    else:
+        coeffs = _coefficients(list(imts), model)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        logy = numpy.log10(values * coeffs['cfact'])
+        # NaN values (e.g. sites without ground motion) stay NaN
+        mmi = numpy.where(logy > coeffs['logy15'],
+                          coeffs['C3'] + coeffs['C4'] * logy,
+                          coeffs['C1'] + coeffs['C2'] * logy)
+    numpy.minimum(mmi, MAX_MMI, out=mmi)
+    if return_sigma:
+        return mmi, numpy.zeros_like(mmi) + coeffs['sigma1']
+    return mmi
+
+
+def convert_gmv_columns(gmfs, imt, model='AK2007'):
+    """
+    Convert to MMI, in place and with a single vectorized evaluation, the
+    ground motion values in the last column of each of the (n_sites, 3)
+    lon, lat, gmv arrays in `gmfs`
+    """
+    if not len(gmfs):
+        return
+    mmi = gm_to_mmi(numpy.concatenate([gmf[:, -1] for gmf in gmfs]), imt,
+                    model)
+    start = 0
+    for gmf in gmfs:
+        gmf[:, -1] = mmi[start: start + len(gmf)]
+        start += len(gmf)
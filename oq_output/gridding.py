@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Rasterize values given at sites onto a regular lon/lat grid and save them
+as NetCDF (CF conventions, NetCDF-3 classic format) or GeoTIFF files,
+without external tools or libraries.
+
+If the sites already form a regular grid this is used as it is, otherwise
+sites are binned onto a grid with the requested spacing (mean of the values
+falling in each node). Grid nodes without sites are set to NaN.
+'''
+import struct
+import numpy
+from multiprocessing import Pool
+from site_index import RegularGridIndex, EARTH_RADIUS
+
+# length (km) of one degree along a great circle
+KM_PER_DEGREE = numpy.pi * EARTH_RADIUS / 180.
+
+# spacing units (GMT increment suffixes) and their length in degrees (km
+# and meters are converted at the middle latitude of the grid for lons)
+SPACING_UNITS = {'d': 1., 'm': 1. / 60., 's': 1. / 3600.,
+                 'k': 1. / KM_PER_DEGREE, 'e': 1e-3 / KM_PER_DEGREE}
+
+# file extension of each raster format
+RASTER_FORMATS = {'netcdf': '.NC', 'geotiff': '.tif'}
+
+# number of rasters kept in memory while being written by the workers
+BATCH_SIZE = 256
+
+
+def parse_spacing(spacing, mid_lat=0.):
+    """
+    Return grid spacing (dlon, dlat) in degrees from a GMT style increment
+    (e.g. '10k' for 10 km, '0.1' or '0.1d' for 0.1 degrees, '5m' for 5 arc
+    minutes)
+    """
+    spacing = str(spacing).strip()
+    unit = spacing[-1] if spacing[-1] in SPACING_UNITS else 'd'
+    value = float(spacing.rstrip(''.join(SPACING_UNITS)))
+    if value <= 0:
+        raise ValueError('Grid spacing must be positive: %s' % spacing)
+    dlat = value * SPACING_UNITS[unit]
+    dlon = dlat
+    if unit in 'ke':
+        dlon /= numpy.cos(numpy.radians(mid_lat))
+    return dlon, dlat
+
+
+class Grid(object):
+    """
+    Regular lon/lat grid (node coordinates in ascending order) and index of
+    the node assigned to each site
+    """
+    def __init__(self, lons, lats, dlon, dlat, site_lons, site_lats):
+        self.lons = lons
+        self.lats = lats
+        self.dlon = dlon
+        self.dlat = dlat
+        self.site_lons = site_lons
+        self.site_lats = site_lats
+        cols = numpy.clip(numpy.rint((site_lons - lons[0]) / dlon).astype(int),
+                          0, len(lons) - 1)
+        rows = numpy.clip(numpy.rint((site_lats - lats[0]) / dlat).astype(int),
+                          0, len(lats) - 1)
+        self.nodes = rows * len(lons) + cols
+        self.counts = numpy.bincount(self.nodes,
+                                     minlength=len(lons) * len(lats))
+
+    @classmethod
+    def from_sites(cls, site_lons, site_lats, spacing='10k'):
+        """
+        Build grid from the sites, if they form a regular grid, or with the
+        given spacing over their bounding box
+        """
+        site_lons = numpy.asarray(site_lons, dtype=float)
+        site_lats = numpy.asarray(site_lats, dtype=float)
+        index = RegularGridIndex.from_sites(site_lons, site_lats)
+        if index is not None:
+            n_lats, n_lons = index.grid.shape
+            dlon, dlat = index.dlon, index.dlat
+            lon0, lat0 = index.lon0, index.lat0
+        else:
+            lon0, lat0 = site_lons.min(), site_lats.min()
+            dlon, dlat = parse_spacing(
+                spacing, (site_lats.min() + site_lats.max()) / 2.)
+            n_lons = int(round((site_lons.max() - lon0) / dlon)) + 1
+            n_lats = int(round((site_lats.max() - lat0) / dlat)) + 1
+        return cls(lon0 + dlon * numpy.arange(n_lons),
+                   lat0 + dlat * numpy.arange(n_lats),
+                   dlon, dlat, site_lons, site_lats)
+
+    def has_sites(self, site_lons, site_lats):
+        """
+        True if the grid was built for the given sites
+        """
+        return numpy.array_equal(self.site_lons, site_lons) and \
+            numpy.array_equal(self.site_lats, site_lats)
+
+    def rasterize(self, values):
+        """
+        Return (n_lats, n_lons) float32 array with the mean of the values
+        assigned to each node (NaN for nodes without finite values)
+        """
+        values = numpy.asarray(values, dtype=float)
+        finite = numpy.isfinite(values)
+        if finite.all():
+            sums = numpy.bincount(self.nodes, weights=values,
+                                  minlength=len(self.counts))
+            counts = self.counts
+        else:
+            sums = numpy.bincount(self.nodes[finite], weights=values[finite],
+                                  minlength=len(self.counts))
+            counts = numpy.bincount(self.nodes[finite],
+                                    minlength=len(self.counts))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            raster = sums / counts
+        return raster.reshape(len(self.lats), len(self.lons)).astype(
+            numpy.float32)
+
+
+# NetCDF-3 classic format tags and types
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+NC_TYPES = {'S': (2, None), 'i': (4, '>i4'), 'f': (5, '>f4'), 'd': (6, '>f8')}
+
+
+def _nc_pad(data):
+    """
+    Pad data with zero bytes to a multiple of 4 bytes
+    """
+    return data + '\x00' * (-len(data) % 4)
+
+
+def _nc_name(name):
+    return struct.pack('>i', len(name)) + _nc_pad(name)
+
+
+def _nc_attributes(attributes):
+    """
+    Encode list of (name, value) attributes; values are strings or numpy
+    arrays/scalars
+    """
+    if not attributes:
+        return struct.pack('>ii', 0, 0)
+    data = struct.pack('>ii', NC_ATTRIBUTE, len(attributes))
+    for name, value in attributes:
+        if isinstance(value, basestring):
+            nc_type, values = NC_TYPES['S'][0], value
+            n_values = len(value)
+        else:
+            value = numpy.atleast_1d(value)
+            nc_type, dtype = NC_TYPES[value.dtype.char]
+            values = value.astype(dtype).tostring()
+            n_values = len(value)
+        data += _nc_name(name) + struct.pack('>ii', nc_type, n_values) + \
+            _nc_pad(values)
+    return data
+
+
+def write_netcdf(file_name, lons, lats, raster, long_name='z'):
+    """
+    Write raster (n_lats, n_lons) to NetCDF-3 classic file following the
+    CF conventions
+    """
+    z_range = numpy.array([numpy.nanmin(raster), numpy.nanmax(raster)]) \
+        if numpy.isfinite(raster).any() else numpy.array([numpy.nan] * 2)
+    variables = [
+        ('lat', [0], [('long_name', 'latitude'),
+                      ('standard_name', 'latitude'),
+                      ('units', 'degrees_north'),
+                      ('actual_range', numpy.array([lats[0], lats[-1]]))],
+         numpy.asarray(lats, dtype=numpy.float64)),
+        ('lon', [1], [('long_name', 'longitude'),
+                      ('standard_name', 'longitude'),
+                      ('units', 'degrees_east'),
+                      ('actual_range', numpy.array([lons[0], lons[-1]]))],
+         numpy.asarray(lons, dtype=numpy.float64)),
+        ('z', [0, 1], [('long_name', long_name),
+                       ('_FillValue', numpy.float32(numpy.nan)),
+                       ('actual_range', z_range)],
+         numpy.asarray(raster, dtype=numpy.float32))]
+
+    header = 'CDF\x01' + struct.pack('>i', 0)
+    header += struct.pack('>ii', NC_DIMENSION, 2)
+    header += _nc_name('lat') + struct.pack('>i', len(lats))
+    header += _nc_name('lon') + struct.pack('>i', len(lons))
+    header += _nc_attributes([('Conventions', 'CF-1.6'),
+                              ('title', long_name),
+                              ('node_offset', numpy.int32(0))])
+
+    # the header length does not depend on the data offsets, so compute
+    # it first with dummy offsets
+    def var_list(offsets):
+        data = struct.pack('>ii', NC_VARIABLE, len(variables))
+        for (name, dims, attributes, values), offset in \
+                zip(variables, offsets):
+            data += _nc_name(name) + struct.pack('>i', len(dims))
+            data += struct.pack('>%di' % len(dims), *dims)
+            data += _nc_attributes(attributes)
+            data += struct.pack('>iii', NC_TYPES[values.dtype.char][0],
+                                values.nbytes + (-values.nbytes % 4), offset)
+        return data
+
+    offsets = []
+    offset = len(header) + len(var_list([0] * len(variables)))
+    for _, _, _, values in variables:
+        offsets.append(offset)
+        offset += values.nbytes + (-values.nbytes % 4)
+
+    f = open(file_name, 'wb')
+    try:
+        f.write(header + var_list(offsets))
+        for _, _, _, values in variables:
+            f.write(_nc_pad(
+                values.astype(NC_TYPES[values.dtype.char][1]).tostring()))
+    finally:
+        f.close()
+
+
+# TIFF field types: (code, struct format)
+TIFF_SHORT = (3, 'H')
+TIFF_LONG = (4, 'I')
+TIFF_DOUBLE = (12, 'd')
+TIFF_ASCII = (2, 's')
+
+
+def write_geotiff(file_name, lons, lats, raster, long_name='z'):
+    """
+    Write raster (n_lats, n_lons) to single band float32 GeoTIFF in
+    geographic WGS84 coordinates. Grid nodes are the centres of the pixels.
+    """
+    n_lats, n_lons = raster.shape
+    dlon = lons[1] - lons[0] if n_lons > 1 else 1.
+    dlat = lats[1] - lats[0] if n_lats > 1 else 1.
+    # first row of the image is the northernmost
+    image = numpy.ascontiguousarray(raster[::-1], dtype='<f4').tostring()
+
+    tags = [
+        (256, TIFF_LONG, [n_lons]),
+        (257, TIFF_LONG, [n_lats]),
+        (258, TIFF_SHORT, [32]),
+        (259, TIFF_SHORT, [1]),
+        (262, TIFF_SHORT, [1]),
+        (270, TIFF_ASCII, long_name + '\x00'),
+        (273, TIFF_LONG, None),
+        (277, TIFF_SHORT, [1]),
+        (278, TIFF_LONG, [n_lats]),
+        (279, TIFF_LONG, [len(image)]),
+        (284, TIFF_SHORT, [1]),
+        (339, TIFF_SHORT, [3]),
+        (33550, TIFF_DOUBLE, [dlon, dlat, 0.]),
+        (33922, TIFF_DOUBLE, [0., 0., 0., lons[0] - dlon / 2.,
+                              lats[-1] + dlat / 2., 0.]),
+        # geographic model, pixel is area, WGS84
+        (34735, TIFF_SHORT, [1, 1, 0, 3, 1024, 0, 1, 2, 1025, 0, 1, 1,
+                             2048, 0, 1, 4326]),
+        (42113, TIFF_ASCII, 'nan\x00')]
+
+    ifd_size = 2 + 12 * len(tags) + 4
+    extra = ''
+    entries = []
+    for tag, (code, fmt), values in tags:
+        if values is None:
+            entries.append((tag, code, fmt, None))
+            continue
+        if fmt == 's':
+            data, count = values, len(values)
+        else:
+            data, count = struct.pack('<%d%s' % (len(values), fmt), *values), \
+                len(values)
+        if len(data) <= 4:
+            entries.append((tag, code, count, data.ljust(4, '\x00')))
+        else:
+            entries.append((tag, code, count,
+                            struct.pack('<I', 8 + ifd_size + len(extra))))
+            extra += data + '\x00' * (len(data) % 2)
+    image_offset = 8 + ifd_size + len(extra)
+
+    ifd = struct.pack('<H', len(tags))
+    for tag, code, count, data in entries:
+        if data is None:
+            # strip offset
+            count, data = 1, struct.pack('<I', image_offset)
+        ifd += struct.pack('<HHI', tag, code, count) + data
+    ifd += struct.pack('<I', 0)
+
+    f = open(file_name, 'wb')
+    try:
+        f.write('II*\x00' + struct.pack('<I', 8) + ifd + extra + image)
+    finally:
+        f.close()
+
+
+RASTER_WRITERS = {'netcdf': write_netcdf, 'geotiff': write_geotiff}
+
+
+def _write_rasters(args):
+    """
+    Rasterize and write a list of (file_name, values, long_name) sharing
+    the same grid
+    """
+    grid, output_format, rasters = args
+    writer = RASTER_WRITERS[output_format]
+    for file_name, values, long_name in rasters:
+        writer(file_name, grid.lons, grid.lats, grid.rasterize(values),
+               long_name)
+
+
+def _raster_batches(tasks, output_format, batch_size, chunk_size):
+    """
+    Group the tasks in batches of at most `batch_size` rasters. Each batch
+    is a list of (grid, output_format, rasters) chunks of at most
+    `chunk_size` consecutive rasters on the same grid, so that each grid
+    is sent once per chunk to the worker processes.
+    """
+    batch = []
+    chunk = None
+    n_rasters = 0
+    for file_name_root, grid, values, long_name in tasks:
+        if chunk is None or chunk[0] is not grid or \
+                len(chunk[2]) == chunk_size:
+            chunk = (grid, output_format, [])
+            batch.append(chunk)
+        chunk[2].append(('%s%s' % (file_name_root,
+                                   RASTER_FORMATS[output_format]),
+                         values, long_name))
+        n_rasters += 1
+        if n_rasters == batch_size:
+            yield batch
+            batch = []
+            chunk = None
+            n_rasters = 0
+    if batch:
+        yield batch
+
+
+def save_raster(file_name_root, grid, values, output_format='netcdf',
+        long_name='z'):
+    """
+    Rasterize values at the grid sites and save them to
+    <file_name_root>.NC (netcdf) or <file_name_root>.tif (geotiff)
+    """
+    save_rasters([(file_name_root, grid, values, long_name)], output_format)
+
+
+def save_rasters(tasks, output_format='netcdf', jobs=1,
+        batch_size=BATCH_SIZE):
+    """
+    Save rasters from an iterable of (file_name_root, grid, values,
+    long_name) tuples. Values are rasterized and files written by `jobs`
+    worker processes, consuming the tasks in batches so that at most
+    `batch_size` fields are held in memory.
+    """
+    if output_format not in RASTER_FORMATS:
+        raise ValueError('Raster format must be one of %s' %
+                         ', '.join(sorted(RASTER_FORMATS)))
+    if jobs <= 1:
+        for batch in _raster_batches(tasks, output_format, batch_size,
+                                     batch_size):
+            for chunk in batch:
+                _write_rasters(chunk)
+        return
+
+    pool = Pool(jobs)
+    try:
+        for batch in _raster_batches(tasks, output_format, batch_size,
+                                     max(1, batch_size // jobs)):
+            pool.map(_write_rasters, batch)
+    finally:
+        pool.close()
+        pool.join()
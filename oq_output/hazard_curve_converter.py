@@ -45,98 +45,229 @@ import os
 import argparse
 import numpy
 from lxml import etree
-import matplotlib.pyplot as plt
+from utils import decode_floats, CurveMatrix, savetxt
+from curve_plotter import plot_curves, parse_sites, parse_bbox
+from binary_io import save_binary
+from progress import PROGRESS, add_progress_arguments, configure
 
-try:
-    from openquake.nrmllib.hazard.parsers import HazardCurveXMLParser
-except:
-    from openquake.nrmllib.hazard.parsers import HazardCurveParser
-    HazardCurveXMLParser = HazardCurveParser
+NRML='{http://openquake.org/xmlns/nrml/0.4}'
+GML='{http://www.opengis.net/gml}'
 
+# number of hazard curves held in memory at a time in streaming mode
+CHUNK_SIZE = 10000
 
-def _set_curves_matrix(hcm):
-    """
-    Store locations and poes in :class:`openquake.nrml.models.HazardCurveModel`
-    in numpy array.
-    """
-    curves = []
-    for loc, poes in hcm:
-        row = [loc.x, loc.y]
-        row.extend(poes)
-        curves.append(row)
-
-    return numpy.array(curves)
 
-def _set_header(hcm):
+def _set_header(metadata):
     """
-    Save metadata in :class:`openquake.nrml.models.HazardCurveModel`
-    in a string to be used as header
+    Save hazard curves metadata in a string to be used as header
     """
     header = ','.join(
-        ['%s=%s' % (k,v) for k,v in hcm.metadata.items()
+        ['%s=%s' % (k,v) for k,v in metadata.items()
         if v is not None and k != 'imls']
     )
     header = '# ' + header
-    header += '\nlon,lat,'+','.join([str(iml) for iml in hcm.metadata['imls']])
+    header += '\nlon,lat,'+','.join([str(iml) for iml in metadata['imls']])
 
     return header
 
-def plot_hazard_curve(filename_root, curves, hcm):
+def _set_metadata(element):
+    """
+    Extract metadata from NRML 'hazardCurves' element. Keys are the same
+    used by :class:`openquake.nrmllib.models.HazardCurveModel`
+    """
+    a = element.attrib
+    metadata = {}
+    metadata['statistics'] = a.get('statistics')
+    metadata['quantile_value'] = a.get('quantileValue')
+    metadata['smlt_path'] = a.get('sourceModelTreePath')
+    metadata['gsimlt_path'] = a.get('gsimTreePath')
+    metadata['imt'] = a['IMT']
+    metadata['investigation_time'] = a['investigationTime']
+    metadata['sa_period'] = a.get('saPeriod')
+    metadata['sa_damping'] = a.get('saDamping')
+
+    return metadata
+
+def _iter_curve_matrices(nrml_hazard_curves, chunk_size, dtype):
+    """
+    Parse NRML hazard curves file incrementally, filling a
+    :class:`utils.CurveMatrix` with the curves poes. Yield tuples
+    (metadata, curve_matrix) every time `chunk_size` curves have been
+    parsed (only once, at the end of the file, if `chunk_size` is None).
+    The same matrix is cleared and reused after each chunk. A file
+    without curves yields a single empty matrix, so that the metadata are
+    always available.
+
+    Each 'hazardCurve' element is cleared (and removed from its parent)
+    as soon as it has been consumed, so that memory use does not
+    depend on the number of sites in the file. Raise ValueError if the
+    file has no IMLs.
+    """
+    metadata = {}
+    matrix = None
+    pos = None
+    n_chunks = 0
+
+    tags = ['%shazardCurves' % NRML, '%sIMLs' % NRML, '%spos' % GML,
+            '%spoEs' % NRML, '%shazardCurve' % NRML]
+    with PROGRESS.open(nrml_hazard_curves) as source:
+        parse_args = dict(source=source,
+                          events=('start', 'end'),
+                          tag=tags)
+        for event, element in etree.iterparse(**parse_args):
+            if event == 'start':
+                if element.tag == '%shazardCurves' % NRML:
+                    metadata.update(_set_metadata(element))
+            elif element.tag == '%spos' % GML:
+                pos = element.text
+            elif element.tag == '%spoEs' % NRML:
+                if matrix is None:
+                    raise ValueError('IMLs must precede the hazard curves in '
+                                     'file %s' % nrml_hazard_curves)
+                matrix.append_text(pos, element.text)
+            elif element.tag == '%sIMLs' % NRML:
+                metadata['imls'] = decode_floats(element.text).tolist()
+                matrix = CurveMatrix(len(metadata['imls']), dtype,
+                                     chunk_size or 1024)
+            elif element.tag == '%shazardCurve' % NRML:
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                PROGRESS.update()
+                if len(matrix) == chunk_size:
+                    yield metadata, matrix
+                    matrix.clear()
+                    n_chunks += 1
+
+    if matrix is None:
+        raise ValueError('No IMLs found in hazard curves file %s' %
+                         nrml_hazard_curves)
+    if len(matrix) or not n_chunks:
+        yield metadata, matrix
+
+def iter_hazard_curves(nrml_hazard_curves, chunk_size=CHUNK_SIZE):
+    """
+    Parse NRML hazard curves file incrementally. Yield tuples
+    (metadata, curves), where `curves` is a numpy array with at most
+    `chunk_size` rows, each row containing lon, lat and poes of a site.
+    """
+    for metadata, matrix in _iter_curve_matrices(nrml_hazard_curves,
+                                                 chunk_size, numpy.float64):
+        yield metadata, matrix.to_array()
+
+def parse_nrml_hazard_curves(nrml_hazard_curves, dtype=numpy.float64):
+    """
+    Parse NRML hazard curves file. Return metadata, (n_sites, 2) array of
+    site coordinates and (n_sites, n_imls) array of poes (of type `dtype`)
+    """
+    for metadata, matrix in _iter_curve_matrices(nrml_hazard_curves,
+                                                 None, dtype):
+        return metadata, matrix.coords, matrix.values
+
+def plot_hazard_curve(filename_root, curves, metadata, jobs=1, atlas=False,
+        sites=None, bbox=None, offset=0):
     """
-    Exports the hazard curves to a set of pdf files
+    Exports the hazard curves to a set of pdf files (or to multi-page pdf
+    files if `atlas` is True) using `jobs` worker processes. See
+    :func:`curve_plotter.plot_curves` for the site selection options.
     """
-    os.mkdir(filename_root)
-    if ("PGA" in hcm.metadata["imt"]) or ("SA" in hcm.metadata["imt"]):
+    if ("PGA" in metadata["imt"]) or ("SA" in metadata["imt"]):
         imt_units = "g"
     else:
         imt_units = "cm/s"
-    num_curves = numpy.shape(curves)[0]
-    for iloc, row in enumerate(curves):
-        print "Plotting curve %d of %d" % (iloc, num_curves)
-        fig = plt.figure(figsize=(7, 5))
-        fig.set_tight_layout(True)
-        plt.loglog(hcm.metadata["imls"], row[2:], 'bo-', linewidth=2.0)
-        plt.xlabel("%s (%s)" %(hcm.metadata["imt"], imt_units), fontsize=14)
-        plt.ylabel("Probability of Being Exceeded in %s years" %
-                   hcm.metadata["investigation_time"], fontsize=14)
-        if row[0] < 0.0:
-            long_ind = "W"
-        else:
-            long_ind = "E"
-        if row[1] < 0.0:
-            lat_ind = "S"
-        else:
-            lat_ind = "N"
-        plt.title("Location: %12.6f %s, %12.6f %s" %(
-            numpy.abs(row[0]), long_ind, numpy.abs(row[1]), lat_ind))
-        output_file = os.path.join(filename_root,
-            "HazCurve_{:.5f}{:s}_{:.5f}{:s}.pdf".format(row[0], long_ind,
-            row[1], lat_ind))
-        plt.savefig(output_file, dpi=300, format="pdf", papertype="a4")
+    spec = dict(
+        x=metadata["imls"],
+        xlabel="%s (%s)" % (metadata["imt"], imt_units),
+        ylabel="Probability of Being Exceeded in %s years" %
+            metadata["investigation_time"],
+        loglog=True,
+        title="",
+        location_format="Location: %12.6f %s, %12.6f %s",
+        prefix="HazCurve")
+    return plot_curves(filename_root, curves, spec, jobs, atlas, sites, bbox,
+                       offset)
 
 def save_hazard_curves_to_csv(nrml__hazard_curves_file, file_name_root,
-    plot_curves=False):
+    plot_curves=False, streaming=False, chunk_size=CHUNK_SIZE,
+    dtype=numpy.float64, plot_options=None):
     """
     Read hazard curves in `nrml__hazard_curves_file` and save to .csv file
-    with root name `file_name_root`
+    with root name `file_name_root`. If `streaming` is True, curves are
+    parsed and written in chunks of `chunk_size` sites, so that memory use
+    stays constant whatever the number of sites in the file. Poes are
+    decoded as `dtype` (numpy.float32 halves the memory required).
+    `plot_options` are passed to :func:`plot_hazard_curve`.
     """
     output_file = '%s.csv' % file_name_root
     if os.path.isfile(output_file):
         raise ValueError('Output file already exists.'
                          ' Please specify different name or remove old file')
 
-    hcm = HazardCurveXMLParser(nrml__hazard_curves_file).parse()
+    if streaming:
+        _save_hazard_curves_in_chunks(nrml__hazard_curves_file,
+                                      file_name_root, plot_curves, chunk_size,
+                                      dtype, plot_options or {})
+        return
+
+    metadata, coords, poes = parse_nrml_hazard_curves(
+        nrml__hazard_curves_file, dtype)
 
-    curves = _set_curves_matrix(hcm)
-    header = _set_header(hcm)
+    curves = numpy.hstack((coords, poes))
+    write_hazard_curves_csv(output_file, metadata, curves)
+    if plot_curves:
+        plot_hazard_curve(file_name_root, curves, metadata,
+                          **(plot_options or {}))
+
+def write_hazard_curves_csv(output_file, metadata, curves):
+    """
+    Write hazard curves to .csv file `output_file`: a header with the
+    metadata and IMLs, then a row of lon, lat and poes per site
+    """
     f = open(output_file, 'w')
-    f.write(header+'\n')
-    numpy.savetxt(f, curves, fmt='%g', delimiter=',')
+    f.write(_set_header(metadata)+'\n')
+    savetxt(f, curves, fmt='%g', delimiter=',')
     f.close()
-    if plot_curves:
-        plot_hazard_curve(file_name_root, curves, hcm)
 
+def _save_hazard_curves_in_chunks(nrml__hazard_curves_file, file_name_root,
+        plot_curves, chunk_size, dtype, plot_options):
+    """
+    Streaming version of :func:`save_hazard_curves_to_csv`: the header is
+    written as soon as the metadata are parsed, and then each chunk of
+    curves is appended to the .csv file.
+    """
+    f = open('%s.csv' % file_name_root, 'w')
+    offset = 0
+    for metadata, matrix in _iter_curve_matrices(nrml__hazard_curves_file,
+                                                 chunk_size, dtype):
+        if f.tell() == 0:
+            f.write(_set_header(metadata)+'\n')
+        curves = matrix.to_array()
+        savetxt(f, curves, fmt='%g', delimiter=',')
+        if plot_curves and len(curves):
+            plot_hazard_curve(file_name_root, curves, metadata,
+                              offset=offset, **plot_options)
+        offset += len(curves)
+    f.close()
+
+
+
+def save_hazard_curves_to_binary(nrml__hazard_curves_file, file_name_root,
+        output_format='npz', dtype=numpy.float64):
+    """
+    Read hazard curves in `nrml__hazard_curves_file` and save to binary
+    file (see :mod:`binary_io`) with root name `file_name_root`. Value
+    columns are labelled with the IMLs.
+    """
+    output_file = '%s.%s' % (file_name_root, output_format)
+    if os.path.isfile(output_file):
+        raise ValueError('Output file already exists.'
+                         ' Please specify different name or remove old file')
 
+    metadata, coords, poes = parse_nrml_hazard_curves(
+        nrml__hazard_curves_file, dtype)
+    imls = metadata.pop('imls')
+    save_binary(file_name_root, metadata, imls, coords[:, 0], coords[:, 1],
+                poes, output_format)
 
 def set_up_arg_parser():
     """
@@ -162,6 +293,44 @@ def set_up_arg_parser():
                        help="Plot the hazard curves to pdf (True) or not "
                        "(False) - may take time for many hazard curves",
                        default=False)
+    flags.add_argument('--streaming',
+                       help="Parse and write the hazard curves in chunks, "
+                       "keeping memory use constant (for large files)",
+                       action='store_true')
+    flags.add_argument('--chunk-size',
+                       help="Number of hazard curves per chunk in streaming "
+                       "mode (Optional, default is %d)" % CHUNK_SIZE,
+                       type=int,
+                       default=CHUNK_SIZE)
+    flags.add_argument('--dtype',
+                       help="Floating point type used to store the poes "
+                       "(Optional, default is float64)",
+                       choices=['float64', 'float32'],
+                       default='float64')
+    flags.add_argument('--jobs',
+                       help="Number of processes used to plot the hazard "
+                       "curves (Optional, default is 1)",
+                       type=int,
+                       default=1)
+    flags.add_argument('--atlas',
+                       help="Plot the hazard curves as pages of multi-page "
+                       "pdf files (one per process) instead of one file per "
+                       "site",
+                       action='store_true')
+    flags.add_argument('--sites',
+                       help="Plot only the sites with the given indices, "
+                       "e.g. 0,5,10-20 (Optional)",
+                       default=None)
+    flags.add_argument('--bbox',
+                       help="Plot only the sites inside the bounding box "
+                       "west/east/south/north (Optional)",
+                       default=None)
+    flags.add_argument('--output-format',
+                       help="Format of the output file: csv, or binary npz "
+                       "or hdf5 (Optional, default is csv)",
+                       choices=['csv', 'npz', 'hdf5'],
+                       default='csv')
+    add_progress_arguments(flags)
     return parser
 
 
@@ -169,14 +338,31 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
         output_file = \
             os.path.splitext(parser.parse_args().input_file)[0] \
             if args.output_file is None else args.output_file
 
-        save_hazard_curves_to_csv(args.input_file,
-                                  output_file,
-                                  args.plot_curves)
+        plot_options = dict(
+            jobs=args.jobs,
+            atlas=args.atlas,
+            sites=parse_sites(args.sites) if args.sites else None,
+            bbox=parse_bbox(args.bbox) if args.bbox else None)
+        with PROGRESS.stage('convert'):
+            if args.output_format != 'csv':
+                save_hazard_curves_to_binary(args.input_file,
+                                             output_file,
+                                             args.output_format,
+                                             numpy.dtype(args.dtype))
+            else:
+                save_hazard_curves_to_csv(args.input_file,
+                                          output_file,
+                                          args.plot_curves,
+                                          args.streaming,
+                                          args.chunk_size,
+                                          numpy.dtype(args.dtype),
+                                          plot_options)
     else:
         parser.print_usage()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Derive hazard maps and uniform hazard spectra from NRML hazard curves
+files, by log-log interpolation of the hazard curves at given poes.
+'''
+import os
+import re
+import argparse
+import numpy
+from hazard_curve_converter import parse_nrml_hazard_curves
+from binary_io import save_binary, read_binary, BINARY_FORMATS
+from utils import savetxt
+
+# poes are floored at this value before taking the logarithm
+MIN_POE = 1E-300
+
+
+def compute_hazard_maps(imls, poes, target_poes):
+    """
+    Compute the IMLs with probabilities of exceedance `target_poes` for
+    every site, by log-log interpolation of the hazard curves. `imls` is
+    the (n_imls,) array of intensity levels, `poes` the (n_sites, n_imls)
+    array of curves poes. Return (n_sites, n_target_poes) array.
+
+    As in OpenQuake (which uses `numpy.interp`), IMLs are clamped to the
+    first (last) IML when the target poe is above (below) the curve.
+    """
+    log_imls = numpy.log(numpy.asarray(imls, dtype=float))
+    log_poes = numpy.log(numpy.maximum(poes, MIN_POE))
+    n_sites, n_imls = log_poes.shape
+    rows = numpy.arange(n_sites)
+
+    hazard_maps = numpy.empty((n_sites, len(target_poes)))
+    for j, log_poe in enumerate(numpy.log(target_poes)):
+        # index of the last IML exceeded with probability >= target poe
+        idx = (log_poes >= log_poe).sum(axis=1) - 1
+        idx = numpy.clip(idx, 0, n_imls - 2)
+        x0 = log_poes[rows, idx]
+        x1 = log_poes[rows, idx + 1]
+        dx = x1 - x0
+        dx[dx == 0] = numpy.inf
+        frac = numpy.clip((log_poe - x0) / dx, 0., 1.)
+        hazard_maps[:, j] = numpy.exp(
+            log_imls[idx] + frac * (log_imls[idx + 1] - log_imls[idx]))
+
+    return hazard_maps
+
+def read_hazard_curves(hazard_curves_file):
+    """
+    Read hazard curves from a NRML file or from a binary file written by
+    :func:`hazard_curve_converter.save_hazard_curves_to_binary`. Return
+    metadata (including the IMLs), (n_sites, 2) array of coordinates and
+    (n_sites, n_imls) array of poes.
+    """
+    if os.path.splitext(hazard_curves_file)[1][1:] in BINARY_FORMATS:
+        metadata, imls, lons, lats, poes = read_binary(hazard_curves_file)
+        metadata = dict((str(k), v) for k, v in metadata.items())
+        metadata['imls'] = imls.tolist()
+        return metadata, numpy.column_stack((lons, lats)), poes
+    return parse_nrml_hazard_curves(hazard_curves_file)
+
+def _get_period(metadata):
+    """
+    Return spectral period associated to the IMT of hazard curves metadata
+    (0 for PGA)
+    """
+    if metadata['imt'] == 'PGA':
+        return 0.0
+    if metadata.get('sa_period') is not None:
+        return float(metadata['sa_period'])
+    match = re.match(r'SA\((.+)\)', metadata['imt'])
+    if match is None:
+        raise ValueError('Cannot compute UHS from %s hazard curves' %
+                         metadata['imt'])
+    return float(match.group(1))
+
+def _save(file_name_root, header_metadata, columns, coords, values,
+        output_format):
+    """
+    Save values to .csv (with header as in the hazard map and UHS
+    converters) or to binary file
+    """
+    if output_format != 'csv':
+        save_binary(file_name_root, header_metadata, columns, coords[:, 0],
+                    coords[:, 1], values, output_format)
+        return
+    header = ','.join(
+        ['%s=%s' % (k, v) for k, v in header_metadata.items()
+         if v is not None]
+    )
+    header = '# ' + header
+    header += '\nlon,lat,' + ','.join([str(c) for c in columns])
+    f = open('%s.csv' % file_name_root, 'w')
+    f.write(header + '\n')
+    savetxt(f, numpy.hstack((coords, values)), fmt='%g', delimiter=',')
+    f.close()
+
+def save_hazard_maps_from_curves(hazard_curves_file, file_name_root, poes,
+        output_format='csv'):
+    """
+    Compute hazard maps at probabilities of exceedance `poes` from the
+    hazard curves in `hazard_curves_file`, and save each of them to a file
+    with root name `file_name_root` followed by '_poe' and the poe, using
+    the same layout as :func:`hazard_map_converter.save_hazard_map_to_csv`.
+    """
+    metadata, coords, curves = read_hazard_curves(hazard_curves_file)
+    hazard_maps = compute_hazard_maps(metadata['imls'], curves, poes)
+
+    for j, poe in enumerate(poes):
+        map_metadata = dict((k, v) for k, v in metadata.items()
+                            if k != 'imls')
+        map_metadata['poe'] = poe
+        _save('%s_poe%s' % (file_name_root, poe), map_metadata, ['iml'],
+              coords, hazard_maps[:, [j]], output_format)
+
+def save_uhs_from_curves(hazard_curves_files, file_name_root, poes,
+        output_format='csv'):
+    """
+    Compute uniform hazard spectra at probabilities of exceedance `poes`
+    from hazard curves files (one per IMT, PGA or SA, all defined on the
+    same sites), and save each of them to a file with root name
+    `file_name_root` followed by '_poe' and the poe, using the same layout
+    as :func:`uhs_converter.save_uhs_to_csv`.
+    """
+    periods = []
+    spectra = []
+    coords = None
+    for hazard_curves_file in hazard_curves_files:
+        metadata, curve_coords, curves = read_hazard_curves(hazard_curves_file)
+        if coords is None:
+            coords = curve_coords
+        elif not numpy.allclose(coords, curve_coords):
+            raise ValueError('Hazard curves in %s are not defined on the '
+                             'same sites as %s' %
+                             (hazard_curves_file, hazard_curves_files[0]))
+        periods.append(_get_period(metadata))
+        spectra.append(compute_hazard_maps(metadata['imls'], curves, poes))
+
+    order = numpy.argsort(periods)
+    periods = [periods[i] for i in order]
+    # (n_sites, n_poes, n_periods)
+    spectra = numpy.dstack([spectra[i] for i in order])
+
+    for j, poe in enumerate(poes):
+        uhs_metadata = {}
+        for key in ('statistics', 'quantile_value', 'smlt_path',
+                    'gsimlt_path', 'investigation_time'):
+            uhs_metadata[key] = metadata.get(key)
+        uhs_metadata['poe'] = poe
+        _save('%s_poe%s' % (file_name_root, poe), uhs_metadata, periods,
+              coords, spectra[:, j, :], output_format)
+
+
+def set_up_arg_parser():
+    """
+    Can run as executable. To do so, set up the command line parser
+    """
+    parser = argparse.ArgumentParser(
+        description='Compute hazard maps (or uniform hazard spectra) at '
+            'given probabilities of exceedance from NRML (or binary) hazard '
+            'curves files. A file is created for each probability of '
+            'exceedance. To run just type: python hazard_curves_to_maps.py '
+            '--input-file=/PATH/TO/INPUT_FILE --poes 0.1 0.02 '
+            '--output-file=/PATH/TO/OUTPUT_FILE', add_help=False)
+    flags = parser.add_argument_group('flag arguments')
+    flags.add_argument('-h', '--help', action='help')
+    flags.add_argument('--input-file',
+                        help='path to hazard curves file(s) (Required). '
+                             'For UHS give one file per IMT',
+                        nargs='+',
+                        required=True)
+    flags.add_argument('--poes',
+                        help='probabilities of exceedance (Required)',
+                        nargs='+',
+                        type=float,
+                        required=True)
+    flags.add_argument('--output-file',
+                        help='root of the output files, without file '
+                             'extension (Optional, default is root of first '
+                             'input file)',
+                        default=None)
+    flags.add_argument('--uhs',
+                        help='Compute uniform hazard spectra instead of '
+                             'hazard maps',
+                        action='store_true')
+    flags.add_argument('--output-format',
+                        help="Format of the output files: csv, or binary npz "
+                             "or hdf5 (Optional, default is csv)",
+                        choices=['csv', 'npz', 'hdf5'],
+                        default='csv')
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = set_up_arg_parser()
+    args = parser.parse_args()
+
+    if args.input_file:
+        output_file = \
+            os.path.splitext(args.input_file[0])[0] \
+            if args.output_file is None else args.output_file
+
+        if args.uhs:
+            save_uhs_from_curves(args.input_file, output_file, args.poes,
+                                 args.output_format)
+        else:
+            if len(args.input_file) > 1:
+                parser.error('Hazard maps are computed from one hazard '
+                             'curves file at a time')
+            save_hazard_maps_from_curves(args.input_file[0], output_file,
+                                         args.poes, args.output_format)
+    else:
+        parser.print_usage()
@@ -46,20 +46,14 @@ import os
 import argparse
 import numpy
 from lxml import etree
+from binary_io import save_binary
+from utils import savetxt
+from gridding import Grid, save_raster, RASTER_FORMATS
+from gmice import AK2007, GMICE_MODELS, gm_to_mmi, supports_imt
+from progress import PROGRESS, add_progress_arguments, configure
 
 NRML='{http://openquake.org/xmlns/nrml/0.4}'
 
-AK2007 = {"PGA": {"C1": 2.65, "C2": 1.39, "C3": -1.91, "C4": 4.09, 
-                  "logy15": 1.69, "sigma1": 1.01, "cfact": 980.665},
-          "SA(0.3)": {"C1": 2.40, "C2": 1.36, "C3": -1.83, "C4": 3.56,
-                      "logy15" :1.92, "sigma1": 0.88, "cfact": 980.665},
-          "SA(1.0)": {"C1": 3.23, "C2": 1.18, "C3": 0.57, "C4": 2.95,
-                      "logy15": 1.50, "sigma1": 0.84, "cfact": 980.665},
-          "SA(2.0)": {"C1": 3.72, "C2": 1.29, "C3": 1.99, "C4": 3.00,
-                      "logy15": 1.00, "sigma1": 0.86, "cfact": 980.665},
-          "PGV": {"C1": 4.37, "C2": 1.32, "C3": 3.54, "C4": 3.03, 
-                  "logy15": 0.48, "sigma1": 0.8, "cfact": 1.}}
-
 def atkinson_kaka_2007_rsa2mmi(imt, values):
     """
     Implements the spectral acceleration to PGA conversion model of
@@ -68,44 +62,74 @@ def atkinson_kaka_2007_rsa2mmi(imt, values):
     if not imt in AK2007.keys():
         print "IMT %s not convertable to MMI" % imt
         return values, None
-    values = values * AK2007[imt]["cfact"]
-    mmi = AK2007[imt]["C1"] + AK2007[imt]["C2"] * numpy.log10(values)
-    idx = numpy.log10(values) > AK2007[imt]["logy15"]
-    mmi[idx] = AK2007[imt]["C3"] + AK2007[imt]["C4"] * numpy.log10(values[idx])
-    mmi[mmi > 10.0] = 10.0
-    return mmi, AK2007[imt]["sigma1"] 
+    return gm_to_mmi(values, imt, 'AK2007'), AK2007[imt]["sigma1"]
 
 
 def parse_nrml_hazard_map(nrml_hazard_map):
     """
-    Parse NRML hazard map file.
+    Parse NRML hazard map file. Return metadata and (n_sites, 3) array of
+    lon, lat and iml.
+
+    Only 'hazardMap' and 'node' elements are returned by the parser, and
+    nodes are cleared as soon as they have been read into the (preallocated,
+    and doubled when full) lon, lat and iml columns, so that memory use
+    only depends on the number of sites.
     """
     metadata = {}
-    values = []
+    lons = numpy.empty(1024)
+    lats = numpy.empty(1024)
+    imls = numpy.empty(1024)
+    n_sites = 0
 
-    parse_args = dict(source=nrml_hazard_map)
-    for _, element in etree.iterparse(**parse_args):
-        if element.tag == '%shazardMap' % NRML:
-            a = element.attrib
-            metadata['statistics'] = a.get('statistics')
-            metadata['quantile_value'] = a.get('quantileValue')
-            metadata['smlt_path'] = a.get('sourceModelTreePath')
-            metadata['gsimlt_path'] = a.get('gsimTreePath')
-            metadata['imt'] = a['IMT']
-            metadata['investigation_time'] = a['investigationTime']
-            metadata['sa_period'] = a.get('saPeriod')
-            metadata['sa_damping'] = a.get('saDamping')
-            metadata['poe'] = a.get('poe')
-        elif element.tag == '%snode' % NRML:
+    with PROGRESS.open(nrml_hazard_map) as source:
+        parse_args = dict(source=source,
+                          tag=['%shazardMap' % NRML, '%snode' % NRML])
+        for _, element in etree.iterparse(**parse_args):
             a = element.attrib
-            values.append(
-                map(float, [a.get('lon'), a.get('lat'), a.get('iml')])
-            )
+            if element.tag == '%snode' % NRML:
+                if n_sites == len(lons):
+                    # double the columns size
+                    lons, lats, imls = [numpy.resize(column, 2 * n_sites)
+                                        for column in (lons, lats, imls)]
+                lons[n_sites] = float(a['lon'])
+                lats[n_sites] = float(a['lat'])
+                imls[n_sites] = float(a['iml'])
+                n_sites += 1
+                PROGRESS.update()
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            else:
+                metadata['statistics'] = a.get('statistics')
+                metadata['quantile_value'] = a.get('quantileValue')
+                metadata['smlt_path'] = a.get('sourceModelTreePath')
+                metadata['gsimlt_path'] = a.get('gsimTreePath')
+                metadata['imt'] = a['IMT']
+                metadata['investigation_time'] = a['investigationTime']
+                metadata['sa_period'] = a.get('saPeriod')
+                metadata['sa_damping'] = a.get('saDamping')
+                metadata['poe'] = a.get('poE')
 
-    return metadata, values
+    return metadata, numpy.column_stack(
+        (lons[:n_sites], lats[:n_sites], imls[:n_sites]))
+
+def _convert_to_mmi(metadata, values, gmice='AK2007'):
+    """
+    Convert imls (third column of `values`) to MMI with the `gmice` model
+    (see :mod:`gmice`), if possible for the map IMT. Return the label of
+    the values column, 'mmi' or 'iml'.
+    """
+    imt = metadata["imt"]
+    if imt == 'SA':
+        imt = 'SA(%s)' % float(metadata["sa_period"])
+    if not supports_imt(imt, gmice):
+        print "IMT %s not convertable to MMI with %s" % (imt, gmice)
+        return 'iml'
+    values[:, 2] = gm_to_mmi(values[:, 2], imt, gmice)
+    return 'mmi'
 
 def save_hazard_map_to_csv(nrml__hazard_map_file, file_name_root,
-        to_mmi=False):
+        to_mmi=False, gmice='AK2007'):
     """
     Read hazard map in `nrml__hazard_map_file` and save to .csv file
     with root name `file_name_root`
@@ -116,51 +140,59 @@ def save_hazard_map_to_csv(nrml__hazard_map_file, file_name_root,
                          ' Please specify different name or remove old file')
 
     metadata, values = parse_nrml_hazard_map(nrml__hazard_map_file)
+    column = 'iml'
     if to_mmi:
-        mmi, _ = atkinson_kaka_2007_rsa2mmi(metadata["imt"], values[:, 2])
+        column = _convert_to_mmi(metadata, values, gmice)
     header = ','.join(
         ['%s=%s' % (k, v) for k, v in metadata.items() if v is not None]
     )
     
-    header = '# ' + header + '\nlon,lat,iml'
+    header = '# ' + header + '\nlon,lat,' + column
     
     f = open(output_file, 'w')
     f.write(header+'\n')
-    numpy.savetxt(f, values, fmt='%g', delimiter=',')
+    savetxt(f, values, fmt='%g', delimiter=',')
     f.close()
 
-def save_hazard_map_to_netcdf(nrml__hazard_map_file, file_name_root,
-        to_mmi=False, resolution="10k"):
+def save_hazard_map_to_binary(nrml__hazard_map_file, file_name_root,
+        output_format='npz', to_mmi=False, gmice='AK2007'):
     """
-    Reads the hazard map in nrml format exports to xyz file then uses GMT
-    to convert to netcdf
+    Read hazard map in `nrml__hazard_map_file` and save to binary file
+    (see :mod:`binary_io`) with root name `file_name_root`. Values are
+    stored in a single column, labelled 'iml' (or 'mmi' if `to_mmi` is
+    True).
     """
-    output_file = '%s.xyz' % file_name_root
+    output_file = '%s.%s' % (file_name_root, output_format)
     if os.path.isfile(output_file):
         raise ValueError('Output file already exists.'
                          ' Please specify different name or remove old file')
+
     metadata, values = parse_nrml_hazard_map(nrml__hazard_map_file)
-    values = numpy.array(values)
-    
+    column = 'iml'
     if to_mmi:
-        values[:, 2], _ = atkinson_kaka_2007_rsa2mmi(metadata["imt"],
-                                                     values[:, 2])
-    f = open(output_file, "w")
-    numpy.savetxt(f, values, fmt="%g", delimiter=" ")
-    f.close()
+        column = _convert_to_mmi(metadata, values, gmice)
+    save_binary(file_name_root, metadata, [column], values[:, 0],
+                values[:, 1], values[:, 2:], output_format)
 
-    # Convert to netcdf
-    llon = numpy.min(values[:, 0])
-    ulon = numpy.max(values[:, 0])
-    llat = numpy.min(values[:, 1])
-    ulat = numpy.max(values[:, 1])
-    istring = " -I%s/%s" % (resolution, resolution)
-    rstring = " -R" + "{:.5f}/".format(llon) + "{:.5f}/".format(ulon) +\
-        "{:.5f}/".format(llat) + "{:.5f}".format(ulat)
-    command_string = ("xyz2grd %s -G%s" % (output_file,
-        file_name_root + ".NC"))  + istring + rstring
-    os.system(command_string)
-    os.remove(output_file)
+def save_hazard_map_to_netcdf(nrml__hazard_map_file, file_name_root,
+        to_mmi=False, resolution="10k", output_format='netcdf',
+        gmice='AK2007'):
+    """
+    Reads the hazard map in nrml format and saves it as a raster (netcdf or
+    geotiff). If the sites do not form a regular grid they are binned onto
+    a grid with the given spacing.
+    """
+    output_file = '%s%s' % (file_name_root, RASTER_FORMATS[output_format])
+    if os.path.isfile(output_file):
+        raise ValueError('Output file already exists.'
+                         ' Please specify different name or remove old file')
+    metadata, values = parse_nrml_hazard_map(nrml__hazard_map_file)
+
+    name = metadata["imt"]
+    if to_mmi and _convert_to_mmi(metadata, values, gmice) == 'mmi':
+        name = 'mmi'
+    grid = Grid.from_sites(values[:, 0], values[:, 1], resolution)
+    save_raster(file_name_root, grid, values[:, 2], output_format, name)
 
 
 def set_up_arg_parser():
@@ -184,20 +216,38 @@ def set_up_arg_parser():
                         default=None)
     flags.add_argument('--to-mmi',
                        help="Convert the ground motion values to MMI using "
-                       "the model of Atkinson & Kaka (2007) - Note this will"
-                       "only apply to PGA, PGV SA(0.3), SA(1.0), SA(2.0)",
+                       "the model selected with --gmice, by default "
+                       "Atkinson & Kaka (2007) - Note this will only apply "
+                       "to PGA, PGV SA(0.3), SA(1.0), SA(2.0)",
                        default=False,
                        required=False)
+    flags.add_argument('--gmice',
+                       help="Ground motion to intensity conversion model "
+                       "used with --to-mmi (Optional, default is AK2007)",
+                       choices=sorted(GMICE_MODELS),
+                       default='AK2007')
     flags.add_argument('--to-netcdf',
-                       help="Convert the output to netcdf for use with "
-                       "GMT and/or QGIS",
+                       help="Convert the output to netcdf (or geotiff, see "
+                       "--raster-format) for use with GMT and/or QGIS",
                        default=False,
                        required=False)
     flags.add_argument('--spacing',
-                       help="Approximate spacing (km) of points: ##k",
+                       help="Approximate spacing of the raster when sites "
+                       "are not on a regular grid: ##k (km), ##m (arc "
+                       "minutes) or ## (degrees)",
                        default="10k",
                        required=False)
-    
+    flags.add_argument('--raster-format',
+                       help="Format of the raster written with --to-netcdf "
+                       "(Optional, default is netcdf)",
+                       choices=sorted(RASTER_FORMATS),
+                       default='netcdf')
+    flags.add_argument('--output-format',
+                       help="Format of the output file: csv, or binary npz "
+                       "or hdf5 (Optional, default is csv)",
+                       choices=['csv', 'npz', 'hdf5'],
+                       default='csv')
+    add_progress_arguments(flags)
 
     return parser
 
@@ -206,16 +256,24 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
         output_file = \
             os.path.splitext(parser.parse_args().input_file)[0] \
             if args.output_file is None else args.output_file
-        if args.to_netcdf:
-            save_hazard_map_to_netcdf(args.input_file, args.output_file,
-                                      args.to_mmi, args.spacing)
-        else:
-            save_hazard_map_to_csv(args.input_file, output_file)
+        with PROGRESS.stage('convert'):
+            if args.to_netcdf:
+                save_hazard_map_to_netcdf(args.input_file, output_file,
+                                          args.to_mmi, args.spacing,
+                                          args.raster_format, args.gmice)
+            elif args.output_format != 'csv':
+                save_hazard_map_to_binary(args.input_file, output_file,
+                                          args.output_format, args.to_mmi,
+                                          args.gmice)
+            else:
+                save_hazard_map_to_csv(args.input_file, output_file,
+                                       args.to_mmi, args.gmice)
     else:
         parser.print_usage()
 
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Merge hazard map files (e.g. one per poE, IMT and statistic, as written by
+OpenQuake) into a single table with one row per site and one column per
+map, saved to .csv or binary (npz or hdf5) file.
+
+Sites are aligned using keys computed from the coordinates rounded to
+`DECIMALS` decimal places; sites missing in a map get NaN values. Columns
+are labelled from the metadata of each map, while metadata common to all
+maps are stored in the output header.
+'''
+import os
+import argparse
+import numpy
+from multiprocessing import Pool
+from lxml import etree
+from hazard_map_converter import parse_nrml_hazard_map
+from binary_io import save_binary, read_binary, BINARY_FORMATS
+from utils import site_keys, savetxt
+
+# number of decimals of the coordinates used to match sites
+DECIMALS = 5
+
+
+def _read_hazard_map(file_name):
+    """
+    Read hazard map from NRML or binary file. Return metadata and
+    (n_sites, 3) array of lon, lat, iml
+    """
+    if os.path.splitext(file_name)[1][1:] in BINARY_FORMATS:
+        metadata, _, lons, lats, values = read_binary(file_name)
+        return metadata, numpy.column_stack((lons, lats, values[:, 0]))
+    try:
+        return parse_nrml_hazard_map(file_name)
+    except etree.XMLSyntaxError as exc:
+        # lxml errors cannot be sent back from the worker processes
+        raise ValueError('Invalid hazard map file %s: %s' % (file_name, exc))
+
+
+def get_column_label(metadata):
+    """
+    Return label of a hazard map column, e.g. 'PGA_poe0.1',
+    'SA(1.0)_poe0.02_mean' or 'PGA_poe0.1_quantile0.85'
+    """
+    imt = metadata['imt']
+    if imt == 'SA':
+        imt = 'SA(%s)' % metadata['sa_period']
+    label = '%s_poe%s' % (imt, metadata['poe'])
+    if metadata.get('statistics') == 'quantile':
+        label += '_quantile%s' % metadata['quantile_value']
+    elif metadata.get('statistics'):
+        label += '_%s' % metadata['statistics']
+    return label
+
+
+def get_column_labels(metadata_list):
+    """
+    Return labels of the hazard map columns. Logic tree paths are added to
+    the labels of maps that would otherwise have the same label.
+    """
+    base_labels = [get_column_label(metadata) for metadata in metadata_list]
+    labels = list(base_labels)
+    for i, metadata in enumerate(metadata_list):
+        if base_labels.count(base_labels[i]) > 1:
+            labels[i] += '_%s_%s' % (metadata.get('smlt_path'),
+                                     metadata.get('gsimlt_path'))
+    duplicates = sorted(set(l for l in labels if labels.count(l) > 1))
+    if duplicates:
+        raise ValueError('Hazard maps with the same metadata: %s' %
+                         ', '.join(duplicates))
+    return labels
+
+
+def align_sites(coords_list, decimals=DECIMALS):
+    """
+    Given a list of (n_sites_i, 2) arrays of site coordinates, return the
+    (n_sites, 2) coordinates of the union of the sites, in order of first
+    appearance, and for each input array the indices of its sites in the
+    union
+    """
+    keys_list = [site_keys(coords[:, 0], coords[:, 1], decimals)
+                 for coords in coords_list]
+    all_keys = numpy.concatenate(keys_list)
+    _, first = numpy.unique(all_keys, return_index=True)
+    first.sort()
+    union_keys = all_keys[first]
+    union_coords = numpy.concatenate(coords_list)[first]
+
+    sorter = numpy.argsort(union_keys)
+    indices = [sorter[numpy.searchsorted(union_keys, keys, sorter=sorter)]
+               for keys in keys_list]
+    return union_coords, indices
+
+
+def merge_hazard_maps(hazard_map_files, file_name_root, output_format='csv',
+        jobs=1):
+    """
+    Merge hazard maps (NRML or binary files) into one table saved to
+    `file_name_root` plus extension. Files are parsed by `jobs` worker
+    processes. Return the name of the output file.
+    """
+    output_file = '%s.%s' % (file_name_root, output_format)
+    if os.path.isfile(output_file):
+        raise ValueError('Output file already exists.'
+                         ' Please specify different name or remove old file')
+
+    if jobs > 1:
+        pool = Pool(jobs)
+        try:
+            hazard_maps = pool.map(_read_hazard_map, hazard_map_files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        hazard_maps = map(_read_hazard_map, hazard_map_files)
+
+    metadata_list = [metadata for metadata, _ in hazard_maps]
+    columns = get_column_labels(metadata_list)
+    coords, indices = align_sites(
+        [values[:, :2] for _, values in hazard_maps])
+
+    cube = numpy.empty((len(coords), len(hazard_maps)))
+    cube.fill(numpy.nan)
+    for j, ((_, values), idx) in enumerate(zip(hazard_maps, indices)):
+        cube[idx, j] = values[:, 2]
+
+    # metadata shared by all maps
+    metadata = dict(
+        (key, value) for key, value in metadata_list[0].items()
+        if value is not None and
+        all(m.get(key) == value for m in metadata_list[1:]))
+
+    if output_format == 'csv':
+        header = ','.join(
+            ['%s=%s' % (k, v) for k, v in metadata.items()])
+        f = open(output_file, 'w')
+        f.write('# %s\nlon,lat,%s\n' % (header, ','.join(columns)))
+        savetxt(f, numpy.hstack((coords, cube)), fmt='%g', delimiter=',')
+        f.close()
+    else:
+        save_binary(file_name_root, metadata, columns, coords[:, 0],
+                    coords[:, 1], cube, output_format)
+    return output_file
+
+
+def set_up_arg_parser():
+    """
+    Can run as executable. To do so, set up the command line parser
+    """
+    parser = argparse.ArgumentParser(
+        description='Merge hazard map files (NRML or binary) into a single '
+            'file with one row per site and one column per map. '
+            'To run just type: python merge_hazard_maps.py '
+            '--input-file PATH_TO_MAP_1 PATH_TO_MAP_2 ... '
+            '--output-file=PATH_TO_OUTPUT_FILE', add_help=False)
+    flags = parser.add_argument_group('flag arguments')
+    flags.add_argument('-h', '--help', action='help')
+    flags.add_argument('--input-file',
+        help='paths to hazard map files (Required)',
+        nargs='+',
+        default=None,
+        required=True)
+    flags.add_argument('--output-file',
+        help='path to output file, without file extension (Required)',
+        default=None,
+        required=True)
+    flags.add_argument('--output-format',
+        help='format of the output file: csv, or binary npz or hdf5 '
+             '(Optional, default is csv)',
+        choices=['csv'] + list(BINARY_FORMATS),
+        default='csv')
+    flags.add_argument('--jobs',
+        help='number of processes parsing the input files (default 1)',
+        type=int,
+        default=1)
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = set_up_arg_parser()
+    args = parser.parse_args()
+
+    if args.input_file:
+        merge_hazard_maps(args.input_file, args.output_file,
+                          args.output_format, args.jobs)
+    else:
+        parser.print_usage()
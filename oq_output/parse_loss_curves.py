@@ -54,6 +54,7 @@ import argparse
 import numpy as np
 from lxml import etree
 from collections import OrderedDict
+from progress import PROGRESS, add_progress_arguments, configure
 
 xmlNRML='{http://openquake.org/xmlns/nrml/0.4}'
 xmlGML = '{http://www.opengis.net/gml}'
@@ -101,31 +102,34 @@ def LossCurveParser(input_file):
     poes = []
     meta_info = {}
 
-    for _, element in etree.iterparse(input_file):
-        if element.tag == '%slossCurves' % xmlNRML:
-            meta_info = parse_metadata(element)
-        elif element.tag == '%slossCurve' % xmlNRML:
-            lon, lat, ref, poe, loss = parse_single_loss_curve(element)
-            longitude.append(lon)
-            latitude.append(lat)
-            refs.append(ref)
-            poes.append(poe)
-            losses.append(loss)
-        else:
-            continue
+    with PROGRESS.open(input_file) as source:
+        for _, element in etree.iterparse(source):
+            if element.tag == '%slossCurves' % xmlNRML:
+                meta_info = parse_metadata(element)
+            elif element.tag == '%slossCurve' % xmlNRML:
+                lon, lat, ref, poe, loss = parse_single_loss_curve(element)
+                longitude.append(lon)
+                latitude.append(lat)
+                refs.append(ref)
+                poes.append(poe)
+                losses.append(loss)
+                PROGRESS.update()
+            else:
+                continue
     longitude = np.array(longitude)
     latitude = np.array(latitude)
     
     return refs, longitude, latitude, poes, losses
    
-def LossCurves2Csv(nrml_loss_curves):
+def LossCurves2Csv(nrml_loss_curves, output_file_name=None):
     '''
-    Writes the Loss curve set to csv
+    Writes the Loss curve set to csv (by default next to the input file)
     '''
     refs, longitude, latitude, poes, losses = LossCurveParser(nrml_loss_curves)
-    output_file = open(nrml_loss_curves.replace('xml','csv'),'w')
+    if output_file_name is None:
+        output_file_name = nrml_loss_curves.replace('xml','csv')
+    output_file = open(output_file_name,'w')
     for iloc in range(len(refs)):
-        print len(poes)
         poes_list = ','.join(map(str, poes[iloc]))
         losses_list = ','.join(map(str, losses[iloc]))
         output_file.write(str(refs[iloc])+','+str(longitude[iloc])+','+str(latitude[iloc])+','+poes_list+','+losses_list+'\n')
@@ -148,6 +152,7 @@ def set_up_arg_parser():
         help='path to loss curves NRML file (Required)',
         default=None,
         required=True)
+    add_progress_arguments(flags)
 
     return parser
 
@@ -155,8 +160,8 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
-        # create the output directory immediately. Raise an error if
-        # it already exists
-        LossCurves2Csv(args.input_file)
\ No newline at end of file
+        with PROGRESS.stage('convert'):
+            LossCurves2Csv(args.input_file)
\ No newline at end of file
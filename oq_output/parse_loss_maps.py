@@ -53,6 +53,7 @@ import csv
 import argparse
 import numpy as np
 from lxml import etree
+from progress import PROGRESS, add_progress_arguments, configure
 from collections import OrderedDict
 
 xmlNRML='{http://openquake.org/xmlns/nrml/0.4}'
@@ -102,14 +103,16 @@ def LossMapParser(input_file):
     values = []
     meta_info = {}
 
-    for _, element in etree.iterparse(input_file):
-        if element.tag == '%slossMap' % xmlNRML:
-            meta_info = parse_metadata(element)
-        elif element.tag == '%snode' % xmlNRML:
-            value = parse_single_loss_node(element)
-            values.append(value)
-        else:
-            continue
+    with PROGRESS.open(input_file) as source:
+        for _, element in etree.iterparse(source):
+            if element.tag == '%slossMap' % xmlNRML:
+                meta_info = parse_metadata(element)
+            elif element.tag == '%snode' % xmlNRML:
+                value = parse_single_loss_node(element)
+                values.append(value)
+                PROGRESS.update()
+            else:
+                continue
     
     return values
     
@@ -127,19 +130,24 @@ def aggLossMapLosses(values):
         
     return uniqueLocations, agg_losses
     
-def LossMap2Csv(nrml_loss_map,agg_losses):
+def LossMap2Csv(nrml_loss_map,agg_losses,output_file_name=None):
     '''
-    Writes the Loss map set to csv
+    Writes the Loss map set to csv (by default next to the input file)
     '''
     values = LossMapParser(nrml_loss_map)
-    output_file = open(nrml_loss_map.replace('xml','csv'),'w')        
+    if output_file_name is None:
+        output_file_name = nrml_loss_map.replace('xml','csv')
+        agg_output_file_name = nrml_loss_map.replace('xml','_agg.csv')
+    else:
+        agg_output_file_name = output_file_name.replace('.csv','_agg.csv')
+    output_file = open(output_file_name,'w')        
     for inode in range(len(values)):
         for iasset in range(len(values[inode])):
             output_file.write(values[inode][iasset][0]+','+str(values[inode][iasset][1])+','+str(values[inode][iasset][2])+','+str(values[inode][iasset][3])+'\n')
     output_file.close()
     
     if agg_losses:
-        agg_output_file = open(nrml_loss_map.replace('xml','_agg.csv'),'w')
+        agg_output_file = open(agg_output_file_name,'w')
         agg_values = aggLossMapLosses(values)
         for iloc in range(len(agg_values[0])):
             agg_output_file.write(str(agg_values[0][iloc])+','+str(agg_values[1][iloc])+'\n')
@@ -167,6 +175,7 @@ def set_up_arg_parser():
     flags.add_argument('--agg-losses', action="store_true",
         help='aggregates the losses per location',
         required=False)
+    add_progress_arguments(flags)
 
     return parser
 
@@ -175,6 +184,8 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
-        LossMap2Csv(args.input_file,args.agg_losses)
+        with PROGRESS.stage('convert'):
+            LossMap2Csv(args.input_file,args.agg_losses)
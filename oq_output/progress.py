@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Progress reporting and instrumentation of the converters.
+
+The work of a converter is divided in stages (e.g. parsing and writing).
+Parsers open their input in a with statement with :meth:`Progress.open`,
+which counts the bytes read, and report each item processed (e.g. a ground
+motion field or a rupture) with :meth:`Progress.update`. When enabled, the
+progress of the current stage (percentage of the input read, rate and
+estimated time to completion) is printed on a single line of the standard
+error, at most every UPDATE_INTERVAL seconds. Wall time, bytes read and
+items of each stage can also be saved to a JSON file.
+
+The command line tools share the instance PROGRESS, configured by the
+options added with :func:`add_progress_arguments`.
+'''
+import os
+import sys
+import json
+import time
+import atexit
+from contextlib import contextmanager
+
+# minimum time between two updates of the progress line (seconds)
+UPDATE_INTERVAL = 0.25
+
+
+def _format_time(seconds):
+    """
+    Format seconds as h:mm:ss
+    """
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class Stage(object):
+    """
+    Stage of a conversion: wall time, bytes read (out of `total_bytes`,
+    if known) and number of items processed
+    """
+    def __init__(self, name, total_bytes=None):
+        self.name = name
+        self.total_bytes = total_bytes
+        # the total is the size of the inputs, unless given
+        self.sized_by_inputs = total_bytes is None
+        self.bytes = 0
+        self.items = 0
+        self.start = time.time()
+        self.seconds = None
+
+    def as_dict(self):
+        """
+        Return dictionary of the stage measures
+        """
+        return dict(name=self.name, seconds=self.seconds, bytes=self.bytes,
+                    items=self.items)
+
+
+class ProgressFile(object):
+    """
+    Read-only binary file reporting the bytes read to a :class:`Progress`,
+    if given. `source` is a file name, opened here and closed by
+    :meth:`close`, or a file object, which is left open for the caller.
+    Can be used as a context manager.
+    """
+    def __init__(self, source, progress=None):
+        self.progress = progress
+        if isinstance(source, basestring):
+            self.name = source
+            self._file = open(source, 'rb')
+            self._owned = True
+        else:
+            self.name = getattr(source, 'name', None)
+            self._file = source
+            self._owned = False
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        if self.progress is not None:
+            self.progress.update(items=0, nbytes=len(data))
+        return data
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Progress(object):
+    """
+    Throttled progress reporter and stage timer (see module
+    documentation). Progress lines are written to `stream` (by default the
+    standard error) only if `show` is True.
+    """
+    def __init__(self, show=False, stream=None, interval=UPDATE_INTERVAL):
+        self.show = show
+        self.stream = stream
+        self.interval = interval
+        self.stages = []
+        self._stage = None
+        self._last_report = 0.
+
+    @contextmanager
+    def stage(self, name, total_bytes=None):
+        """
+        Context manager measuring the stage `name` of a conversion
+        """
+        stage = Stage(name, total_bytes)
+        self.stages.append(stage)
+        previous, self._stage = self._stage, stage
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.time() - stage.start
+            self._stage = previous
+            if self.show:
+                self._report(stage, final=True)
+
+    @contextmanager
+    def paused(self):
+        """
+        Context manager suspending the measures of the current stage, e.g.
+        while running a conversion whose progress is reported by the caller
+        """
+        stage, self._stage = self._stage, None
+        try:
+            yield
+        finally:
+            self._stage = stage
+
+    def open(self, source):
+        """
+        Return a :class:`ProgressFile` reading input `source` (file name or
+        file object), to be used in a with statement. The bytes read are
+        counted in the current stage if `source` is a file name and the
+        stage total is the size of its inputs.
+        """
+        stage = self._stage
+        counting = stage is not None and stage.sized_by_inputs and \
+            isinstance(source, basestring)
+        if counting:
+            stage.total_bytes = (stage.total_bytes or 0) + \
+                os.path.getsize(source)
+        return ProgressFile(source, self if counting else None)
+
+    def update(self, items=1, nbytes=0):
+        """
+        Add processed items and bytes read to the current stage
+        """
+        stage = self._stage
+        if stage is None:
+            return
+        stage.items += items
+        stage.bytes += nbytes
+        if self.show:
+            now = time.time()
+            if now - self._last_report >= self.interval:
+                self._last_report = now
+                self._report(stage)
+
+    def _report(self, stage, final=False):
+        """
+        Write the progress line of a stage
+        """
+        elapsed = max(time.time() - stage.start, 1e-6)
+        parts = ['%s:' % stage.name]
+        if stage.total_bytes:
+            parts.append('%5.1f%%' % (100. * stage.bytes / stage.total_bytes))
+        if stage.bytes:
+            parts.append('%.1f MB/s' % (stage.bytes / elapsed / 1e6))
+        if stage.items:
+            parts.append('%d items (%.0f/s)' %
+                         (stage.items, stage.items / elapsed))
+        if final:
+            parts.append('done in %s' % _format_time(elapsed))
+        elif stage.total_bytes and stage.bytes:
+            parts.append('ETA %s' % _format_time(
+                elapsed * (stage.total_bytes - stage.bytes) / stage.bytes))
+        stream = self.stream or sys.stderr
+        stream.write('\r%-79s' % ' '.join(parts) + ('\n' if final else ''))
+        stream.flush()
+
+    def save_json(self, file_name):
+        """
+        Save name, wall time, bytes read and items of the stages to JSON
+        file `file_name`
+        """
+        f = open(file_name, 'w')
+        json.dump({'stages': [stage.as_dict() for stage in self.stages]},
+                  f, indent=2)
+        f.close()
+
+
+PROGRESS = Progress()
+
+
+def add_progress_arguments(flags):
+    """
+    Add the progress options to argument group `flags`
+    """
+    flags.add_argument('--no-progress',
+        help='Do not print the progress of the conversion',
+        action='store_true')
+    flags.add_argument('--progress-json',
+        help='Save wall time, bytes read and items processed by each stage '
+             'of the conversion to this JSON file',
+        default=None)
+
+def configure(args):
+    """
+    Configure PROGRESS from parsed command line arguments. The JSON file
+    of the stages is saved at exit.
+    """
+    PROGRESS.show = not args.no_progress
+    if args.progress_json:
+        atexit.register(PROGRESS.save_json, args.progress_json)
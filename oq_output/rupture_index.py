@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+'''
+Index of the ruptures of stochastic event sets converted to .txt files
+(see eventset_converter.py), to select ruptures by magnitude, distance of
+the centroid from a site and source id (the 'src=' token of the rupture
+id) without reading the whole catalogue.
+
+The index stores, for each rupture, the file and byte offset of its line,
+the ruptures sorted by magnitude, a grid of cells (of GRID_SPACING degrees)
+over the centroids and the ruptures of each source. It is saved in the
+output directory of the conversion (as ruptures.ridx) and only the lines
+of the selected ruptures are read.
+'''
+import os
+import argparse
+import cPickle
+import numpy
+from site_index import geodetic_distance, EARTH_RADIUS
+
+RUPTURE_INDEX_FILE = 'ruptures.ridx'
+
+# spacing (degrees) of the grid over the rupture centroids
+GRID_SPACING = 1.0
+
+
+def get_source_id(rupture_id):
+    """
+    Return source id from rupture id (e.g. '10138' from
+    'rlz=00|ses=0001|src=10138|i=0049-00'), None if not found
+    """
+    for token in rupture_id.split('|'):
+        if token.startswith('src='):
+            return token[4:]
+    return None
+
+
+class RuptureIndex(object):
+    """
+    Index of the ruptures written in the SES files `files`. For each
+    rupture, `file_indices`, `offsets` and `lengths` give the file, byte
+    offset and length of its line, `magnitudes`, `lons` and `lats` its
+    magnitude and centroid coordinates. `header` is the header line of the
+    files and `sources` a dictionary of the (sorted) indices of the
+    ruptures of each source id.
+    """
+    def __init__(self, header, files, file_indices, offsets, lengths,
+                 magnitudes, lons, lats, sources, spacing=GRID_SPACING):
+        self.header = header
+        self.files = files
+        self.file_indices = file_indices
+        self.offsets = offsets
+        self.lengths = lengths
+        self.magnitudes = magnitudes
+        self.lons = lons
+        self.lats = lats
+        self.sources = sources
+        self.spacing = spacing
+
+        self.magnitude_order = numpy.argsort(magnitudes, kind='mergesort')
+        self.sorted_magnitudes = magnitudes[self.magnitude_order]
+
+        # ruptures sorted by grid cell, with the sorted ids of the cells
+        # not empty and the index of the first rupture of each of them
+        self.n_cols = int(numpy.ceil(360. / spacing))
+        cells = self._get_cells(self._get_rows(lats), self._get_cols(lons))
+        self.cell_order = numpy.argsort(cells, kind='mergesort')
+        self.cell_ids, self.cell_starts = numpy.unique(cells[self.cell_order],
+                                                       return_index=True)
+        self.cell_starts = numpy.append(self.cell_starts, len(cells))
+
+    def __len__(self):
+        return len(self.magnitudes)
+
+    def _get_rows(self, lats):
+        """
+        Return grid row of latitudes
+        """
+        n_rows = int(numpy.ceil(180. / self.spacing))
+        return numpy.clip(numpy.floor((numpy.asarray(lats) + 90.) /
+                                      self.spacing).astype(int),
+                          0, n_rows - 1)
+
+    def _get_cols(self, lons):
+        """
+        Return grid column of longitudes (wrapped around the globe)
+        """
+        return numpy.floor((numpy.asarray(lons) + 180.) /
+                           self.spacing).astype(int) % self.n_cols
+
+    def _get_cells(self, rows, cols):
+        """
+        Return id of the grid cells of given rows and columns
+        """
+        return rows * self.n_cols + cols
+
+    def select_by_magnitude(self, min_mag=None, max_mag=None):
+        """
+        Return sorted indices of the ruptures with min_mag <= magnitude
+        <= max_mag (bounds are optional)
+        """
+        start = 0 if min_mag is None else numpy.searchsorted(
+            self.sorted_magnitudes, min_mag, side='left')
+        stop = len(self) if max_mag is None else numpy.searchsorted(
+            self.sorted_magnitudes, max_mag, side='right')
+        return numpy.sort(self.magnitude_order[start: stop])
+
+    def select_by_distance(self, lon, lat, distance):
+        """
+        Return sorted indices of the ruptures whose centroid is within
+        `distance` km of the point (lon, lat). Only the ruptures in the grid
+        cells overlapping the circle are checked.
+        """
+        dist = distance / EARTH_RADIUS
+        dlat = numpy.degrees(dist)
+        rows = numpy.arange(self._get_rows(max(lat - dlat, -90.)),
+                            self._get_rows(min(lat + dlat, 90.)) + 1)
+        # half width in longitude of the circle, all the columns if the
+        # circle contains a pole
+        sin_dist = numpy.sin(min(dist, numpy.pi / 2))
+        cos_lat = numpy.cos(numpy.radians(lat))
+        if dist >= numpy.pi / 2 or sin_dist >= cos_lat:
+            cols = numpy.arange(self.n_cols)
+        else:
+            dlon = numpy.degrees(numpy.arcsin(sin_dist / cos_lat))
+            west = (lon - dlon + 180.) % 360. - 180.
+            east = west + 2 * dlon
+            if east < 180.:
+                cols = numpy.arange(self._get_cols(west),
+                                    self._get_cols(east) + 1)
+            else:
+                # the circle crosses the antimeridian
+                cols = numpy.concatenate((
+                    numpy.arange(self._get_cols(west), self.n_cols),
+                    numpy.arange(0, self._get_cols(east - 360.) + 1)))
+                cols = numpy.unique(cols)
+
+        cells = self._get_cells(rows[:, None], cols[None, :]).ravel()
+        positions = numpy.searchsorted(self.cell_ids, cells)
+        found = positions < len(self.cell_ids)
+        found[found] = self.cell_ids[positions[found]] == cells[found]
+        positions = positions[found]
+        if not len(positions):
+            return numpy.zeros(0, dtype=int)
+        candidates = numpy.concatenate(
+            [self.cell_order[self.cell_starts[pos]: self.cell_starts[pos + 1]]
+             for pos in positions])
+        distances = geodetic_distance(lon, lat, self.lons[candidates],
+                                      self.lats[candidates])
+        return numpy.sort(candidates[distances <= distance])
+
+    def select_by_source(self, source_id):
+        """
+        Return sorted indices of the ruptures of a source
+        """
+        return self.sources.get(str(source_id), numpy.zeros(0, dtype=int))
+
+    def select(self, min_mag=None, max_mag=None, lon=None, lat=None,
+               distance=None, source_id=None):
+        """
+        Return sorted indices of the ruptures matching all the given
+        criteria: magnitude range, distance (km) of the centroid from the
+        point (lon, lat) and source id
+        """
+        selections = []
+        if source_id is not None:
+            selections.append(self.select_by_source(source_id))
+        if distance is not None:
+            if lon is None or lat is None:
+                raise ValueError('Longitude and latitude are required to '
+                                 'select ruptures by distance')
+            selections.append(self.select_by_distance(lon, lat, distance))
+        if min_mag is not None or max_mag is not None:
+            selections.append(self.select_by_magnitude(min_mag, max_mag))
+        if not selections:
+            return numpy.arange(len(self))
+        selected = selections[0]
+        for selection in selections[1:]:
+            selected = numpy.intersect1d(selected, selection,
+                                         assume_unique=True)
+        return selected
+
+    def read_lines(self, input_dir, indices):
+        """
+        Return (file_name, line) for each rupture of the given indices,
+        reading only its line from the SES file in `input_dir`
+        """
+        lines = [None] * len(indices)
+        file_indices = self.file_indices[indices]
+        for file_index in numpy.unique(file_indices):
+            f = open(os.path.join(input_dir, self.files[file_index]), 'rb')
+            for i in numpy.flatnonzero(file_indices == file_index):
+                f.seek(self.offsets[indices[i]])
+                lines[i] = (self.files[file_index],
+                            f.read(self.lengths[indices[i]]).rstrip('\n'))
+            f.close()
+        return lines
+
+    def save(self, file_name):
+        """
+        Save index to file
+        """
+        f = open(file_name, 'wb')
+        cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+
+
+class RuptureIndexBuilder(object):
+    """
+    Collect the position of the lines of the ruptures written to the SES
+    files, with their magnitudes, centroids and source ids, to build a
+    :class:`RuptureIndex`
+    """
+    def __init__(self, header):
+        self.header = header
+        self.files = []
+        self.file_indices = []
+        self.offsets = []
+        self.lengths = []
+        self.magnitudes = []
+        self.lons = []
+        self.lats = []
+        self.sources = {}
+        self.n_ruptures = 0
+
+    def add(self, file_name, offset, lines, ids, magnitudes, lons, lats):
+        """
+        Add the ruptures written as `lines` (text block of one line per
+        rupture) at position `offset` of file `file_name`
+        """
+        if file_name not in self.files:
+            self.files.append(file_name)
+        lengths = numpy.array([len(line) + 1
+                               for line in lines.split('\n')[:-1]])
+        self.file_indices.append(
+            numpy.repeat(self.files.index(file_name), len(lengths)))
+        self.offsets.append(offset + numpy.cumsum(lengths) - lengths)
+        self.lengths.append(lengths)
+        self.magnitudes.append(magnitudes)
+        self.lons.append(lons)
+        self.lats.append(lats)
+        for i, rupture_id in enumerate(ids):
+            source_id = get_source_id(rupture_id)
+            if source_id is not None:
+                self.sources.setdefault(source_id, []).append(
+                    self.n_ruptures + i)
+        self.n_ruptures += len(lengths)
+
+    def build(self, spacing=GRID_SPACING):
+        """
+        Return :class:`RuptureIndex` of the ruptures added so far
+        """
+        def concatenate(arrays, dtype):
+            return numpy.concatenate(arrays + [numpy.zeros(0, dtype=dtype)])
+
+        return RuptureIndex(
+            self.header, self.files, concatenate(self.file_indices, int),
+            concatenate(self.offsets, int), concatenate(self.lengths, int),
+            concatenate(self.magnitudes, float), concatenate(self.lons, float),
+            concatenate(self.lats, float),
+            dict((source_id, numpy.array(indices))
+                 for source_id, indices in self.sources.items()),
+            spacing)
+
+
+def load_index(input_dir):
+    """
+    Load the rupture index saved in the output directory of a SES
+    conversion
+    """
+    index_file = os.path.join(input_dir, RUPTURE_INDEX_FILE)
+    if not os.path.isfile(index_file):
+        raise ValueError('No rupture index in %s. Please convert the event '
+                         'set with the --index flag' % input_dir)
+    f = open(index_file, 'rb')
+    index = cPickle.load(f)
+    f.close()
+    return index
+
+def query_ruptures(input_dir, min_mag=None, max_mag=None, lon=None,
+                   lat=None, distance=None, source_id=None):
+    """
+    Return the header and the lines of the ruptures of the SES files in
+    `input_dir` matching the given criteria (see
+    :meth:`RuptureIndex.select`), as (file_name, line) tuples
+    """
+    index = load_index(input_dir)
+    indices = index.select(min_mag, max_mag, lon, lat, distance, source_id)
+    return index.header, index.read_lines(input_dir, indices)
+
+def save_query_to_txt(input_dir, output_file, **criteria):
+    """
+    Save the ruptures matching the criteria (see :func:`query_ruptures`)
+    to tab delimited `output_file`, with the name of the SES file of each
+    rupture in the first column
+    """
+    if os.path.isfile(output_file):
+        raise ValueError('Output file already exists.'
+                         ' Please specify different name or remove old file')
+    header, lines = query_ruptures(input_dir, **criteria)
+    f = open(output_file, 'w')
+    f.write('ses_file\t%s\n' % header)
+    for file_name, line in lines:
+        f.write('%s\t%s\n' % (file_name, line))
+    f.close()
+    return len(lines)
+
+
+def set_up_arg_parser():
+    """
+    Can run as executable. To do so, set up the command line parser
+    """
+    parser = argparse.ArgumentParser(
+        description='Select ruptures from stochastic event sets converted '
+            'with eventset_converter.py --index, by magnitude, distance '
+            'from a site and source id, and save them to a tab delimited '
+            'file. '
+            'To run just type: python rupture_index.py '
+            '--input-dir=PATH_TO_SES_OUTPUT_DIRECTORY '
+            '--output-file=PATH_TO_OUTPUT_FILE --min-magnitude=6.5 '
+            '--lon=10.0 --lat=45.0 --distance=50', add_help=False)
+    flags = parser.add_argument_group('flag arguments')
+    flags.add_argument('-h', '--help', action='help')
+    flags.add_argument('--input-dir',
+        help='path to output directory of the SES conversion (Required)',
+        default=None,
+        required=True)
+    flags.add_argument('--output-file',
+        help='path to output file (Required)',
+        default=None,
+        required=True)
+    flags.add_argument('--min-magnitude',
+        help='minimum magnitude (Optional)',
+        type=float,
+        default=None)
+    flags.add_argument('--max-magnitude',
+        help='maximum magnitude (Optional)',
+        type=float,
+        default=None)
+    flags.add_argument('--lon',
+        help='longitude of the site (Required with --distance)',
+        type=float,
+        default=None)
+    flags.add_argument('--lat',
+        help='latitude of the site (Required with --distance)',
+        type=float,
+        default=None)
+    flags.add_argument('--distance',
+        help='maximum distance (km) of the rupture centroids from the site '
+             '(Optional)',
+        type=float,
+        default=None)
+    flags.add_argument('--source-id',
+        help='source id, as in the src= token of the rupture ids '
+             '(Optional)',
+        default=None)
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = set_up_arg_parser()
+    args = parser.parse_args()
+
+    if args.input_dir:
+        n_ruptures = save_query_to_txt(
+            args.input_dir, args.output_file, min_mag=args.min_magnitude,
+            max_mag=args.max_magnitude, lon=args.lon, lat=args.lat,
+            distance=args.distance, source_id=args.source_id)
+        print '%d ruptures saved to %s' % (n_ruptures, args.output_file)
+    else:
+        parser.print_usage()
@@ -51,38 +51,212 @@ import argparse
 import numpy
 from collections import OrderedDict
 from lxml import etree
-from hazard_map_converter import atkinson_kaka_2007_rsa2mmi, AK2007
+from gmice import GMICE_MODELS, supports_imt, convert_gmv_columns
+from utils import savetxt, SiteTable
+from gridding import Grid, save_rasters, RASTER_FORMATS
+from gmf_output import LONG_FORMATS, get_gmf_writer
+from progress import PROGRESS, add_progress_arguments, configure
 
 NRML='{http://openquake.org/xmlns/nrml/0.4}'
 
 
-def parse_gmfs_file(file_name):
+# quantiles of the per-site statistics, and maximum number of values per
+# site sampled to estimate them
+QUANTILES = (0.05, 0.16, 0.5, 0.84, 0.95)
+SAMPLE_SIZE = 64
+
+
+def iter_gmfs(file_name):
     """
-    Parse NRML 0.4 GMF set file.
+    Parse NRML 0.4 GMF set file incrementally, yielding (imt, values) for
+    each ground motion field, where values is a (n, 3) array of longitude,
+    latitude and ground motion value. Elements are cleared as soon as they
+    are consumed.
     """
-    parse_args = dict(source=file_name)
-
-    gmfs = OrderedDict()
-    for _, element in etree.iterparse(**parse_args):
-        if element.tag == '%sgmf' % NRML:
+    with PROGRESS.open(file_name) as source:
+        for _, element in etree.iterparse(source,
+                                          tag='%sgmf' % NRML):
             imt = element.attrib['IMT']
             if imt == 'SA':
-                damping = element.attrib['saDamping']
-                period = element.attrib['saPeriod']
-                imt = '%s(%s)' % (imt, period)
-            gmf = []
-            for node in element:
-                gmv = float(node.attrib['gmv'])
-                lon = float(node.attrib['lon'])
-                lat = float(node.attrib['lat'])
-                gmf.append([lon, lat, gmv])
-            if imt in gmfs.keys():
-                gmfs[imt].append(gmf)
-            else:
-                gmfs[imt] = [gmf]
+                imt = '%s(%s)' % (imt, element.attrib['saPeriod'])
+            values = numpy.array(
+                [(node.attrib['lon'], node.attrib['lat'], node.attrib['gmv'])
+                 for node in element], dtype=numpy.float64).reshape(-1, 3)
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            PROGRESS.update()
+            yield imt, values
+
+def parse_gmfs_file(file_name):
+    """
+    Parse NRML 0.4 GMF set file. Return dictionary of the list of (n, 3)
+    arrays of longitude, latitude and value of the fields of each IMT.
+    """
+    gmfs = OrderedDict()
+    for imt, values in iter_gmfs(file_name):
+        gmfs.setdefault(imt, []).append(values)
 
     return gmfs
 
+
+class GmfStatistics(object):
+    """
+    Per-site statistics of the natural logarithm of the ground motion values
+    of a set of fields, updated one field at a time: count, mean and
+    standard deviation (with Welford's algorithm), minimum and maximum, and
+    approximate quantiles. Quantiles are computed from a uniform random
+    sample (reservoir) of at most `sample_size` values per site, so memory
+    use does not depend on the number of fields.
+
+    Sites are those of :class:`utils.SiteTable` `sites`. Non-positive
+    ground motion values are not counted.
+    """
+    def __init__(self, sites, quantiles=QUANTILES, sample_size=SAMPLE_SIZE,
+            seed=0):
+        self.sites = sites
+        self.quantiles = numpy.asarray(quantiles, dtype=numpy.float64)
+        self.sample_size = sample_size
+        self._rng = numpy.random.RandomState(seed)
+        self._allocate(0)
+
+    def _allocate(self, n_sites):
+        """
+        Extend the per-site arrays to `n_sites` sites (doubling their
+        capacity when needed)
+        """
+        old_size = len(self._count) if hasattr(self, '_count') else 0
+        if n_sites <= old_size:
+            return
+        size = max(n_sites, 2 * old_size, 1)
+        arrays = dict(
+            _count=numpy.zeros(size, dtype=numpy.int64),
+            _mean=numpy.zeros(size), _m2=numpy.zeros(size),
+            _min=numpy.empty(size), _max=numpy.empty(size),
+            _sample=numpy.empty((size, self.sample_size),
+                                dtype=numpy.float32))
+        arrays['_min'].fill(numpy.inf)
+        arrays['_max'].fill(-numpy.inf)
+        for name, array in arrays.items():
+            if old_size:
+                array[:old_size] = getattr(self, name)
+            setattr(self, name, array)
+
+    def add(self, site_indices, gmvs):
+        """
+        Update the statistics with the ground motion values of a field at
+        the sites of the given indices
+        """
+        site_indices = numpy.asarray(site_indices)
+        gmvs = numpy.asarray(gmvs, dtype=numpy.float64)
+        positive = gmvs > 0
+        site_indices = site_indices[positive]
+        values = numpy.log(gmvs[positive])
+        if not len(values):
+            return
+        self._allocate(site_indices.max() + 1)
+
+        count = self._count[site_indices] + 1
+        self._count[site_indices] = count
+        delta = values - self._mean[site_indices]
+        mean = self._mean[site_indices] + delta / count
+        self._mean[site_indices] = mean
+        self._m2[site_indices] += delta * (values - mean)
+        numpy.minimum.at(self._min, site_indices, values)
+        numpy.maximum.at(self._max, site_indices, values)
+
+        # reservoir sampling: the first values fill the sample, then the
+        # n-th value replaces a random element with probability size / n
+        slots = count - 1
+        replace = count > self.sample_size
+        slots[replace] = (self._rng.random_sample(replace.sum()) *
+                          count[replace]).astype(numpy.int64)
+        keep = slots < self.sample_size
+        self._sample[site_indices[keep], slots[keep]] = values[keep]
+
+    def get_statistics(self):
+        """
+        Return count, mean, standard deviation, minimum, maximum (arrays of
+        length n_sites) and quantiles (array (n_sites, n_quantiles)) of the
+        logarithm of the ground motion values. Statistics not defined for a
+        site (e.g. the standard deviation of a single value) are NaN.
+        """
+        n_sites = len(self.sites)
+        self._allocate(n_sites)
+        count = self._count[:n_sites]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.where(count > 0, self._mean[:n_sites], numpy.nan)
+            std = numpy.sqrt(self._m2[:n_sites] / (count - 1))
+        std[count < 2] = numpy.nan
+        minimum = numpy.where(count > 0, self._min[:n_sites], numpy.nan)
+        maximum = numpy.where(count > 0, self._max[:n_sites], numpy.nan)
+
+        # linear interpolation between the closest ranks of the sorted
+        # sample, as numpy.percentile
+        n_values = numpy.minimum(count, self.sample_size)
+        sample = self._sample[:n_sites].copy()
+        sample[numpy.arange(self.sample_size) >= n_values[:, None]] = \
+            numpy.inf
+        sample.sort(axis=1)
+        last = numpy.maximum(n_values - 1, 0)[:, None]
+        position = self.quantiles * last
+        lower = numpy.floor(position).astype(numpy.int64)
+        upper = numpy.minimum(lower + 1, last)
+        rows = numpy.arange(n_sites)[:, None]
+        with numpy.errstate(invalid='ignore'):
+            quantiles = sample[rows, lower] + (position - lower) * \
+                (sample[rows, upper] - sample[rows, lower])
+        quantiles[count == 0] = numpy.nan
+
+        return count, mean, std, minimum, maximum, quantiles
+
+    def save(self, file_name, header=None):
+        """
+        Save the statistics to .csv file, one row per site. `header` is
+        an optional comment line.
+        """
+        count, mean, std, minimum, maximum, quantiles = self.get_statistics()
+        columns = ['lon', 'lat', 'count', 'mean_ln_gmv', 'std_ln_gmv',
+                   'min_ln_gmv', 'max_ln_gmv'] + \
+            ['q%s_ln_gmv' % q for q in self.quantiles]
+        f = open(file_name, 'w')
+        if header is not None:
+            f.write('# %s\n' % header)
+        f.write(','.join(columns) + '\n')
+        savetxt(f, numpy.column_stack((self.sites.lons, self.sites.lats,
+                                       count, mean, std, minimum, maximum,
+                                       quantiles)),
+                fmt=','.join(['%s', '%s', '%d'] +
+                             ['%g'] * (len(columns) - 3)))
+        f.close()
+
+
+def save_gmf_statistics(file_name, out_dir, quantiles=QUANTILES,
+        sample_size=SAMPLE_SIZE):
+    """
+    Compute per-site statistics of the ground motion fields of NRML file
+    `file_name` in a single pass (see :class:`GmfStatistics`), and save
+    them to `out_dir`/gmf_statistics_<IMT>.csv. Return the names of the
+    files.
+    """
+    sites = SiteTable()
+    statistics = OrderedDict()
+    n_fields = {}
+    for imt, values in iter_gmfs(file_name):
+        if imt not in statistics:
+            statistics[imt] = GmfStatistics(sites, quantiles, sample_size)
+            n_fields[imt] = 0
+        statistics[imt].add(sites.get_indices(values[:, 0], values[:, 1]),
+                            values[:, 2])
+        n_fields[imt] += 1
+
+    file_names = []
+    for imt, stats in statistics.items():
+        file_names.append('%s/gmf_statistics_%s.csv' % (out_dir, imt))
+        stats.save(file_names[-1], 'IMT=%s, realizations=%d' %
+                   (imt, n_fields[imt]))
+    return file_names
+
 def save_gmfs_to_csv(gmfs, out_dir):
     """
     Save GMFs to .csv files
@@ -95,9 +269,24 @@ def save_gmfs_to_csv(gmfs, out_dir):
             fname = '%s/gmf_%s.csv' % (dir_name, (i + 1))
             f = open(fname, 'w')
             f.write(header+'\n')
-            numpy.savetxt(f, numpy.array(gmf), fmt='%g', delimiter=',')
+            savetxt(f, numpy.array(gmf), fmt='%g', delimiter=',')
             f.close()
 
+def save_gmfs_to_long_format(gmfs, out_dir, output_format='long-csv'):
+    """
+    Save GMFs to consolidated long-format output (see :mod:`gmf_output`)
+    in `out_dir`, with a row per ground motion field and site. Fields are
+    numbered from 1, as by :func:`save_gmfs_to_csv`. Return the names of
+    the files written.
+    """
+    writer = get_gmf_writer(output_format, out_dir, ('gmf_id',))
+    for imt in gmfs.keys():
+        for i, gmf in enumerate(gmfs[imt]):
+            gmf = numpy.array(gmf).reshape(-1, 3)
+            site_indices = writer.sites.get_indices(gmf[:, 0], gmf[:, 1])
+            writer.write((i + 1,), imt, site_indices, gmf[:, 2])
+    return writer.close()
+
 def magic_flipud(values, llat, ulat):
     """
 
@@ -110,51 +299,48 @@ def magic_flipud(values, llat, ulat):
 
 
 def save_gmfs_to_netcdf(gmfs, out_dir, to_mmi=False, resolution="10k",
-        cleanup=False, magic=False):
+        cleanup=False, magic=False, output_format='netcdf', jobs=1,
+        gmice='AK2007'):
+    """
+    Save ground motion fields to netCDF (or GeoTIFF) files for use in GMT
+    and/or QGis. Rasters are written by `jobs` worker processes.
+    `cleanup` is ignored (no .xyz files are created any more) and kept
+    for backward compatibility.
     """
-    Save ground motion fields to netCDF files for use in GMT and/or QGis
+    save_rasters(_gmf_rasters(gmfs, out_dir, to_mmi, resolution, magic,
+                              gmice),
+                 output_format, jobs)
+
+def _gmf_rasters(gmfs, out_dir, to_mmi, resolution, magic, gmice):
+    """
+    Yield (file name root, grid, values, name) of the ground motion fields.
+    The grid is only rebuilt when the sites change.
     """
+    grid = None
     for imt in gmfs.keys():
         dir_name = '%s/GMFS_%s' % (out_dir, imt)
         os.makedirs(dir_name)
+        ogmfs = [numpy.array(gmf) for gmf in gmfs[imt]]
         if to_mmi:
-            if imt in AK2007.keys():
+            if supports_imt(imt, gmice):
                 get_mmi = True
+                # all the fields of the IMT are converted at once
+                convert_gmv_columns(ogmfs, imt, gmice)
             else:
                 print "Cannot convert %s to MMI" % imt
                 get_mmi = False
         else:
             get_mmi = False
             
-        for i, gmf in enumerate(gmfs[imt]):
+        for i, ogmf in enumerate(ogmfs):
             f_stem = '%s/gmf_%s' % (dir_name, (i + 1))
-            ogmf = numpy.array(gmf)
             if magic:
                 ogmf = magic_flipud(ogmf,
                                     numpy.min(ogmf[:, 1]),
                                     numpy.max(ogmf[:, 1]))
-            if get_mmi:
-                ogmf[:, 2], sigma = atkinson_kaka_2007_rsa2mmi(imt, ogmf[:, 2])
-            f = open(f_stem + ".xyz", "w")
-            numpy.savetxt(f, ogmf, fmt="%g", delimiter=" ")
-            f.close()
-            # Generate GMT xyz2grd string
-            llon = numpy.min(ogmf[:, 0])
-            ulon = numpy.max(ogmf[:, 0])
-            llat = numpy.min(ogmf[:, 1])
-            ulat = numpy.max(ogmf[:, 1])
-            istring = " -I%s/%s" % (resolution, resolution)
-            rstring = " -R" + "{:.5f}/".format(llon) + "{:.5f}/".format(ulon) +\
-                "{:.5f}/".format(llat) + "{:.5f}".format(ulat)
-            if "SA" in imt:
-                mod1 = f_stem.replace("(", "\(")
-                f_stem = mod1.replace(")", "\)")
-                
-            command_string = ("xyz2grd %s -G%s" % (f_stem + ".xyz",
-                              f_stem + ".NC")) + istring + rstring
-            os.system(command_string)
-    if cleanup:
-        os.system("find . -name '*.xyz' -type f -delete")
+            if grid is None or not grid.has_sites(ogmf[:, 0], ogmf[:, 1]):
+                grid = Grid.from_sites(ogmf[:, 0], ogmf[:, 1], resolution)
+            yield f_stem, grid, ogmf[:, 2], 'mmi' if get_mmi else imt
         
 
 def set_up_arg_parser():
@@ -181,30 +367,68 @@ def set_up_arg_parser():
         default=None,
         required=True)
 
+    flags.add_argument('--output-format',
+        help="Format of the ground motion fields: csv (one file per field, "
+             "default), long-csv (a file per IMT with a row per field and "
+             "site) or long-hdf5 (appendable version of long-csv)",
+        choices=('csv',) + LONG_FORMATS,
+        default='csv')
+    flags.add_argument('--statistics',
+        help='Instead of the fields, save per-site statistics of the '
+             'logarithm of the ground motion values (count, mean, standard '
+             'deviation, minimum, maximum and quantiles), computed in a '
+             'single pass over the file',
+        action='store_true')
+    flags.add_argument('--quantiles',
+        help='Comma separated quantiles of the statistics (default %s)' %
+             ','.join(map(str, QUANTILES)),
+        default=','.join(map(str, QUANTILES)))
+    flags.add_argument('--sample-size',
+        help='Number of values per site sampled to estimate the quantiles '
+             '(default %d)' % SAMPLE_SIZE,
+        type=int,
+        default=SAMPLE_SIZE)
     flags.add_argument('--to-netcdf',
-        help='Converts files to netcdf format for use with GMT/QGis',
+        help='Converts files to netcdf (or geotiff, see --raster-format) '
+             'format for use with GMT/QGis',
         default=False,
         required=False)
     flags.add_argument('--spacing',
-        help="Approximate spacing (km) of interpolated mesh",
+        help="Approximate spacing of the raster when sites are not on a "
+             "regular grid: ##k (km), ##m (arc minutes) or ## (degrees)",
         default="10k",
         required=False)
+    flags.add_argument('--raster-format',
+        help="Format of the rasters written with --to-netcdf (default "
+             "netcdf)",
+        choices=sorted(RASTER_FORMATS),
+        default='netcdf')
+    flags.add_argument('--jobs',
+        help="Number of processes writing the rasters (default 1)",
+        type=int,
+        default=1)
 
     flags.add_argument('--to-mmi',
-        help="Convert the ground motion values to MMI using the model of "
-             "Atkinson & Kaka (2007) - Note this will only apply to PGA, PGV "
-             "SA(0.3), SA(1.0), SA(2.0)",
+        help="Convert the ground motion values to MMI using the model "
+             "selected with --gmice, by default Atkinson & Kaka (2007) - "
+             "Note this will only apply to PGA, PGV SA(0.3), SA(1.0), "
+             "SA(2.0)",
         default=False,
         required=False)
+    flags.add_argument('--gmice',
+        help="Ground motion to intensity conversion model used with "
+             "--to-mmi (default AK2007)",
+        choices=sorted(GMICE_MODELS),
+        default='AK2007')
     flags.add_argument('--cleanup',
-        help="Removes .xyz files after creation of NetCDF",
+        help="Deprecated and ignored: no .xyz files are created any more",
         default=False,
         required=False)
-
     flags.add_argument('--magic',
         help="Flips raster in vertical",
         default=False,
         required=False)
+    add_progress_arguments(flags)
 
     return parser
 
@@ -213,16 +437,31 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
         # create the output directory immediately. Raise an error if
         # it already exists
         os.makedirs(args.output_dir)
-        gmfc = parse_gmfs_file(args.input_file)
-        if args.to_netcdf:
-            save_gmfs_to_netcdf(gmfc, args.output_dir, args.to_mmi,
-                                args.spacing, args.cleanup, args.magic)    
+        if args.statistics:
+            with PROGRESS.stage('statistics'):
+                save_gmf_statistics(
+                    args.input_file, args.output_dir,
+                    [float(q) for q in args.quantiles.split(',')],
+                    args.sample_size)
         else:
-            save_gmfs_to_csv(gmfc, args.output_dir)
+            with PROGRESS.stage('parse'):
+                gmfc = parse_gmfs_file(args.input_file)
+            with PROGRESS.stage('write'):
+                if args.to_netcdf:
+                    save_gmfs_to_netcdf(gmfc, args.output_dir, args.to_mmi,
+                                        args.spacing, args.cleanup,
+                                        args.magic, args.raster_format,
+                                        args.jobs, args.gmice)
+                elif args.output_format in LONG_FORMATS:
+                    save_gmfs_to_long_format(gmfc, args.output_dir,
+                                             args.output_format)
+                else:
+                    save_gmfs_to_csv(gmfc, args.output_dir)
     else:
         parser.print_usage()
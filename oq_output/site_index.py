@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+# 
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+'''
+Spatial index over the sites of converted hazard outputs (hazard curves,
+hazard maps, UHS) and query of the values at arbitrary locations.
+
+If the sites form a regular lon/lat grid, the index is a grid hash (the
+site index of each grid cell), which also supports bilinear interpolation.
+Otherwise a KD-tree (requires scipy) over the sites 3-D cartesian
+coordinates is used, giving the nearest site. The index is saved next to
+the hazard output file (with extension .sidx) and reused by later queries.
+'''
+import os
+import argparse
+import cPickle
+import numpy
+from utils import read_hazard_csv, savetxt
+from binary_io import read_binary, BINARY_FORMATS
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+EARTH_RADIUS = 6371.0
+
+# number of decimals used to compare site coordinates
+DECIMALS = 5
+
+
+def read_hazard_output(file_name):
+    """
+    Read hazard output from .csv or binary file. Return metadata, column
+    labels, site longitudes, latitudes and values
+    """
+    if os.path.splitext(file_name)[1][1:] in BINARY_FORMATS:
+        return read_binary(file_name)
+    return read_hazard_csv(file_name)
+
+def geodetic_distance(lons1, lats1, lons2, lats2):
+    """
+    Great circle distance (km) between points
+    """
+    lons1, lats1, lons2, lats2 = map(numpy.radians,
+                                     (lons1, lats1, lons2, lats2))
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(
+        numpy.sin((lats1 - lats2) / 2.0) ** 2.0 +
+        numpy.cos(lats1) * numpy.cos(lats2) *
+        numpy.sin((lons1 - lons2) / 2.0) ** 2.0).clip(-1., 1.))
+
+
+class RegularGridIndex(object):
+    """
+    Index of sites located on a regular lon/lat grid, stored as a
+    (n_lats, n_lons) array of site indices (-1 for grid nodes without site)
+    """
+    def __init__(self, lon0, dlon, n_lons, lat0, dlat, n_lats, lons, lats):
+        self.lon0 = lon0
+        self.dlon = dlon
+        self.lat0 = lat0
+        self.dlat = dlat
+        self.grid = -numpy.ones((n_lats, n_lons), dtype=numpy.int64)
+        cols, rows = self._fractional_indices(lons, lats)
+        self.grid[numpy.rint(rows).astype(int),
+                  numpy.rint(cols).astype(int)] = numpy.arange(len(lons))
+
+    @classmethod
+    def from_sites(cls, lons, lats):
+        """
+        Return index if the sites form a regular grid, None otherwise
+        """
+        ulons = numpy.unique(numpy.round(lons, DECIMALS))
+        ulats = numpy.unique(numpy.round(lats, DECIMALS))
+        if len(ulons) < 2 or len(ulats) < 2 or \
+                len(ulons) * len(ulats) > 4 * len(lons):
+            return None
+        dlons = numpy.diff(ulons)
+        dlats = numpy.diff(ulats)
+        tol = 10. ** -DECIMALS
+        if not (numpy.allclose(dlons, dlons[0], atol=tol) and
+                numpy.allclose(dlats, dlats[0], atol=tol)):
+            return None
+        # steps are computed over the whole grid, to reduce rounding errors
+        dlon = (ulons[-1] - ulons[0]) / (len(ulons) - 1)
+        dlat = (ulats[-1] - ulats[0]) / (len(ulats) - 1)
+        return cls(ulons[0], dlon, len(ulons), ulats[0], dlat, len(ulats),
+                   lons, lats)
+
+    def _fractional_indices(self, lons, lats):
+        """
+        Return (fractional) grid column and row of points
+        """
+        return (numpy.asarray(lons) - self.lon0) / self.dlon, \
+            (numpy.asarray(lats) - self.lat0) / self.dlat
+
+    def nearest(self, lons, lats):
+        """
+        Return index of the site closest to each point: the site at the
+        closest grid node or, if that node has no site, the closest of the
+        sites of the other nodes
+        """
+        lons = numpy.asarray(lons, dtype=float)
+        lats = numpy.asarray(lats, dtype=float)
+        cols, rows = self._fractional_indices(lons, lats)
+        n_lats, n_lons = self.grid.shape
+        cols = numpy.clip(numpy.rint(cols).astype(int), 0, n_lons - 1)
+        rows = numpy.clip(numpy.rint(rows).astype(int), 0, n_lats - 1)
+        idx = self.grid[rows, cols]
+        empty = idx < 0
+        if empty.any():
+            idx[empty] = self._nearest_site(lons[empty], lats[empty])
+        return idx
+
+    def _nearest_site(self, lons, lats):
+        """
+        Return index of the site closest to each point, searched over all
+        the sites (used for points whose closest grid node has no site)
+        """
+        rows, cols = numpy.nonzero(self.grid >= 0)
+        site_idx = self.grid[rows, cols]
+        site_lons = self.lon0 + cols * self.dlon
+        site_lats = self.lat0 + rows * self.dlat
+        if cKDTree is not None:
+            return site_idx[KDTreeIndex(site_lons, site_lats).nearest(lons,
+                                                                      lats)]
+        nearest = numpy.empty(len(lons), dtype=numpy.int64)
+        block_size = max(1, 10 ** 6 // len(site_idx))
+        for start in range(0, len(lons), block_size):
+            stop = start + block_size
+            distances = geodetic_distance(
+                lons[start: stop, None], lats[start: stop, None],
+                site_lons[None, :], site_lats[None, :])
+            nearest[start: stop] = site_idx[distances.argmin(axis=1)]
+        return nearest
+
+    def bilinear(self, lons, lats):
+        """
+        Return (n_points, 4) arrays of site indices and bilinear weights of
+        the grid cell containing each point. Points outside the grid get the
+        values of the closest edge. Weights of missing sites are set to zero
+        and the others renormalised.
+        """
+        cols, rows = self._fractional_indices(lons, lats)
+        n_lats, n_lons = self.grid.shape
+        col0 = numpy.clip(numpy.floor(cols).astype(int), 0, n_lons - 2)
+        row0 = numpy.clip(numpy.floor(rows).astype(int), 0, n_lats - 2)
+        tx = numpy.clip(cols - col0, 0., 1.)
+        ty = numpy.clip(rows - row0, 0., 1.)
+        idx = numpy.column_stack((
+            self.grid[row0, col0], self.grid[row0, col0 + 1],
+            self.grid[row0 + 1, col0], self.grid[row0 + 1, col0 + 1]))
+        weights = numpy.column_stack((
+            (1 - tx) * (1 - ty), tx * (1 - ty), (1 - tx) * ty, tx * ty))
+        weights[idx < 0] = 0.
+        total = weights.sum(axis=1)
+        total[total == 0] = numpy.nan
+        return idx, weights / total[:, None]
+
+
+class KDTreeIndex(object):
+    """
+    Index of scattered sites, as a KD-tree over the sites 3-D cartesian
+    coordinates on the unit sphere
+    """
+    def __init__(self, lons, lats):
+        if cKDTree is None:
+            raise ImportError('scipy is required to index sites not on a '
+                              'regular grid')
+        self.tree = cKDTree(self._to_xyz(lons, lats))
+
+    @staticmethod
+    def _to_xyz(lons, lats):
+        """
+        Convert geographic coordinates to cartesian ones on the unit sphere
+        """
+        lons = numpy.radians(lons)
+        lats = numpy.radians(lats)
+        cos_lats = numpy.cos(lats)
+        return numpy.column_stack((cos_lats * numpy.cos(lons),
+                                   cos_lats * numpy.sin(lons),
+                                   numpy.sin(lats)))
+
+    def nearest(self, lons, lats):
+        """
+        Return index of the site closest to each point
+        """
+        _, idx = self.tree.query(self._to_xyz(lons, lats))
+        return idx
+
+    def bilinear(self, lons, lats):
+        raise ValueError('Bilinear interpolation requires sites on a '
+                         'regular grid')
+
+
+def build_index(lons, lats):
+    """
+    Build index of the sites: grid hash if the sites form a regular grid,
+    KD-tree otherwise
+    """
+    index = RegularGridIndex.from_sites(lons, lats)
+    if index is None:
+        index = KDTreeIndex(lons, lats)
+    return index
+
+def get_index(file_name, lons, lats):
+    """
+    Return index of the sites of hazard output `file_name`, loading it from
+    the index file saved next to it, or building (and saving) it if the
+    index file does not exist or is older than the hazard output
+    """
+    index_file = '%s.sidx' % file_name
+    if os.path.isfile(index_file) and \
+            os.path.getmtime(index_file) >= os.path.getmtime(file_name):
+        f = open(index_file, 'rb')
+        index = cPickle.load(f)
+        f.close()
+        return index
+
+    index = build_index(lons, lats)
+    f = open(index_file, 'wb')
+    cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    return index
+
+def query_hazard_output(file_name, query_lons, query_lats, method='nearest'):
+    """
+    Return the values of hazard output `file_name` at the query points,
+    either from the nearest site (`method` = 'nearest') or by bilinear
+    interpolation ('bilinear', only for regular grids). Return metadata,
+    column labels, (n_points, n_columns) array of values and, for the
+    nearest method, the index and distance (km) of the nearest site (None
+    for bilinear). Interpolated values are NaN for points in a grid cell
+    without sites.
+    """
+    metadata, columns, lons, lats, values = read_hazard_output(file_name)
+    index = get_index(file_name, lons, lats)
+    query_lons = numpy.asarray(query_lons, dtype=float)
+    query_lats = numpy.asarray(query_lats, dtype=float)
+
+    if method == 'bilinear':
+        idx, weights = index.bilinear(query_lons, query_lats)
+        site_values = numpy.asarray(values)[numpy.maximum(idx, 0)]
+        result = (site_values * weights[:, :, None]).sum(axis=1)
+        return metadata, columns, result, None, None
+
+    idx = index.nearest(query_lons, query_lats)
+    result = numpy.array(values[idx], dtype=float)
+    distances = geodetic_distance(query_lons, query_lats, lons[idx],
+                                  lats[idx])
+    return metadata, columns, result, idx, distances
+
+def read_query_points(file_name):
+    """
+    Read query points (lon,lat on each line, optional header line) from
+    .csv file
+    """
+    f = open(file_name)
+    first_line = f.readline()
+    f.close()
+    try:
+        map(float, first_line.split(',')[:2])
+        skiprows = 0
+    except ValueError:
+        skiprows = 1
+    points = numpy.loadtxt(file_name, delimiter=',', skiprows=skiprows,
+                           usecols=(0, 1), ndmin=2)
+    return points[:, 0], points[:, 1]
+
+def save_query_to_csv(file_name, query_file, output_file, method='nearest'):
+    """
+    Query hazard output `file_name` at the points in `query_file` and save
+    values to `output_file`
+    """
+    if os.path.isfile(output_file):
+        raise ValueError('Output file already exists.'
+                         ' Please specify different name or remove old file')
+    query_lons, query_lats = read_query_points(query_file)
+    metadata, columns, values, idx, distances = query_hazard_output(
+        file_name, query_lons, query_lats, method)
+
+    header = ','.join(
+        ['%s=%s' % (k, v) for k, v in metadata.items() if v is not None]
+    )
+    header = '# ' + header + ',method=%s' % method
+    if method == 'bilinear':
+        header += '\nlon,lat,'
+        data = numpy.column_stack((query_lons, query_lats, values))
+    else:
+        header += '\nlon,lat,site_index,distance,'
+        data = numpy.column_stack((query_lons, query_lats, idx, distances,
+                                   values))
+    header += ','.join([str(c) for c in columns])
+
+    f = open(output_file, 'w')
+    f.write(header + '\n')
+    savetxt(f, data, fmt='%g', delimiter=',')
+    f.close()
+
+
+def set_up_arg_parser():
+    """
+    Can run as executable. To do so, set up the command line parser
+    """
+    parser = argparse.ArgumentParser(
+        description='Extract the values of a converted hazard output '
+            '(hazard curves, hazard map or UHS .csv or binary file) at the '
+            'points listed in a .csv file (lon,lat). The site index is '
+            'saved next to the hazard output and reused by later queries. '
+            'To run just type: python site_index.py '
+            '--input-file=/PATH/TO/HAZARD_OUTPUT '
+            '--query-file=/PATH/TO/POINTS_FILE '
+            '--output-file=/PATH/TO/OUTPUT_FILE', add_help=False)
+    flags = parser.add_argument_group('flag arguments')
+    flags.add_argument('-h', '--help', action='help')
+    flags.add_argument('--input-file',
+                        help='path to hazard output file (Required)',
+                        default=None,
+                        required=True)
+    flags.add_argument('--query-file',
+                        help='path to .csv file of query points (Required)',
+                        default=None,
+                        required=True)
+    flags.add_argument('--output-file',
+                        help='path to output .csv file (Required)',
+                        default=None,
+                        required=True)
+    flags.add_argument('--method',
+                        help='nearest site, or bilinear interpolation '
+                             '(regular grids only) (Optional, default is '
+                             'nearest)',
+                        choices=['nearest', 'bilinear'],
+                        default='nearest')
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = set_up_arg_parser()
+    args = parser.parse_args()
+
+    if args.input_file:
+        save_query_to_csv(args.input_file, args.query_file, args.output_file,
+                          args.method)
+    else:
+        parser.print_usage()
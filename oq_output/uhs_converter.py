@@ -46,105 +46,160 @@ import os
 import argparse
 import numpy
 from lxml import etree
-import matplotlib.pyplot as plt
+from utils import decode_floats, CurveMatrix, savetxt
+from curve_plotter import plot_curves, parse_sites, parse_bbox
+from binary_io import save_binary
+from progress import PROGRESS, add_progress_arguments, configure
 
 NRML='{http://openquake.org/xmlns/nrml/0.4}'
 GML='{http://www.opengis.net/gml}'
 
+# number of spectra parsed and written at a time by save_uhs_to_csv
+CHUNK_SIZE = 10000
 
-def parse_nrml_uhs_curves(nrml_uhs_map):
+
+def _iter_uhs_matrices(nrml_uhs_map, chunk_size, dtype):
     """
-    Parse NRML uhs file.
+    Parse NRML uhs file incrementally, filling a :class:`utils.CurveMatrix`
+    (sized from the number of periods) with the spectra IMLs. Yield tuples
+    (metadata, periods, uhs_matrix) every time `chunk_size` spectra have
+    been parsed (only once, at the end of the file, if `chunk_size` is
+    None). The same matrix is cleared and reused after each chunk. A file
+    without spectra yields a single empty matrix.
+
+    Site position and IMLs are read at the end events of the 'gml:pos' and
+    'IMLs' elements, and each 'uhs' element is cleared (and removed from
+    its parent) as soon as it has been consumed. Raise ValueError if the
+    file has no periods.
     """
     metadata = {}
     periods = None
-    values = []
-
-    parse_args = dict(source=nrml_uhs_map)
-    for _, element in etree.iterparse(**parse_args):
-        if element.tag == '%suniformHazardSpectra' % NRML:
-            a = element.attrib
-            metadata['statistics'] = a.get('statistics')
-            metadata['quantile_value'] = a.get('quantileValue')
-            metadata['smlt_path'] = a.get('sourceModelTreePath')
-            metadata['gsimlt_path'] = a.get('gsimTreePath')
-            metadata['investigation_time'] = a['investigationTime']
-            metadata['poe'] = a.get('poE')
-        elif element.tag == '%speriods' % NRML:
-            periods = map(float, element.text.split())
-        elif element.tag == '%suhs' % NRML:
-            lon, lat = map(
-                float, element.find('%sPoint/%spos' % (GML, GML)).text.split()
-            )
-            imls = map(float, element.find('%sIMLs' % NRML).text.split())
+    matrix = None
+    pos = None
+    n_chunks = 0
 
-            uhs = [lon, lat]
-            uhs.extend(imls)
-            values.append(uhs)
+    tags = ['%suniformHazardSpectra' % NRML, '%speriods' % NRML,
+            '%spos' % GML, '%sIMLs' % NRML, '%suhs' % NRML]
+    with PROGRESS.open(nrml_uhs_map) as source:
+        parse_args = dict(source=source,
+                          events=('start', 'end'), tag=tags)
+        for event, element in etree.iterparse(**parse_args):
+            if event == 'start':
+                if element.tag == '%suniformHazardSpectra' % NRML:
+                    a = element.attrib
+                    metadata['statistics'] = a.get('statistics')
+                    metadata['quantile_value'] = a.get('quantileValue')
+                    metadata['smlt_path'] = a.get('sourceModelTreePath')
+                    metadata['gsimlt_path'] = a.get('gsimTreePath')
+                    metadata['investigation_time'] = a['investigationTime']
+                    metadata['poe'] = a.get('poE')
+            elif element.tag == '%spos' % GML:
+                pos = element.text
+            elif element.tag == '%sIMLs' % NRML:
+                if matrix is None:
+                    raise ValueError('Periods must precede the spectra in '
+                                     'file %s' % nrml_uhs_map)
+                matrix.append_text(pos, element.text)
+            elif element.tag == '%suhs' % NRML:
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                PROGRESS.update()
+                if len(matrix) == chunk_size:
+                    yield metadata, periods, matrix
+                    matrix.clear()
+                    n_chunks += 1
+            elif element.tag == '%speriods' % NRML:
+                periods = decode_floats(element.text).tolist()
+                matrix = CurveMatrix(len(periods), dtype, chunk_size or 1024)
 
-    return metadata, periods, numpy.array(values)
+    if matrix is None:
+        raise ValueError('No periods found in UHS file %s' % nrml_uhs_map)
+    if len(matrix) or not n_chunks:
+        yield metadata, periods, matrix
 
-def plot_uhs(file_name_root, uhs, periods, metadata):
+def parse_nrml_uhs_curves(nrml_uhs_map, dtype=numpy.float64):
+    """
+    Parse NRML uhs file. IMLs are decoded as `dtype`. Return metadata,
+    periods and (n_sites, 2 + n_periods) array of lon, lat and IMLs.
+    """
+    for metadata, periods, matrix in _iter_uhs_matrices(nrml_uhs_map, None,
+                                                        dtype):
+        return metadata, periods, matrix.to_array()
+
+def plot_uhs(file_name_root, uhs, periods, metadata, jobs=1, atlas=False,
+        sites=None, bbox=None, offset=0):
     """
     Takes the UHS data and produces a set of curves as pdf images in the
-    output folder
+    output folder (or multi-page pdf files if `atlas` is True), using
+    `jobs` worker processes. See :func:`curve_plotter.plot_curves` for the
+    site selection options.
     """
-    os.mkdir(file_name_root)
-    num_curves = numpy.shape(uhs)[0]
-    if not metadata["statistics"]:
-        metadata["statistics"] = ""
-    for iloc, row in enumerate(uhs):
-        print "Plotting curve %d of %d" % (iloc + 1, num_curves)
-        fig = plt.figure(figsize=(7, 5))
-        fig.set_tight_layout(True)
-        plt.plot(periods, row[2:], 'bo-', linewidth=2.0)
-        plt.xlabel("Period (s)", fontsize=14)
-        plt.ylabel("Spectral Acceleration (g)", fontsize=14)
-        plt.grid(b=True, color='0.66', linestyle="--")
-        if row[0] < 0.0:
-            long_ind = "W"
-        else:
-            long_ind = "E"
-        if row[1] < 0.0:
-            lat_ind = "S"
-        else:
-            lat_ind = "N"
-        title_string_upper = "{:s} UHS with a {:s} PoE in {:s} Years\n".format(
-             metadata["statistics"],
-             metadata["poe"],
-             metadata["investigation_time"])
-        title_string_lower = "Location: {:.6f}{:s}, {:.6f}{:s}".format(
-            numpy.abs(row[0]), long_ind, numpy.abs(row[1]), lat_ind)
-        plt.title(title_string_upper + title_string_lower, fontsize=16)
-        output_file = os.path.join(file_name_root,
-            "UHS_{:.5f}{:s}_{:.5f}{:s}.pdf".format(row[0], long_ind,
-            row[1], lat_ind))
-        plt.savefig(output_file, dpi=300, format="pdf", papertype="a4")
-
-def save_uhs_to_csv(nrml_uhs_file, file_name_root, plot_spectra=False):
+    statistics = metadata["statistics"] or ""
+    spec = dict(
+        x=periods,
+        xlabel="Period (s)",
+        ylabel="Spectral Acceleration (g)",
+        grid=True,
+        title="{:s} UHS with a {:s} PoE in {:s} Years\n".format(
+            statistics,
+            metadata["poe"],
+            metadata["investigation_time"]),
+        location_format="Location: %.6f%s, %.6f%s",
+        title_fontsize=16,
+        prefix="UHS")
+    return plot_curves(file_name_root, uhs, spec, jobs, atlas, sites, bbox,
+                       offset)
+
+def save_uhs_to_csv(nrml_uhs_file, file_name_root, plot_spectra=False,
+        dtype=numpy.float64, plot_options=None, chunk_size=CHUNK_SIZE):
     """
-    Read hazard map in `nrml__hazard_map_file` and save to .csv file
-    with root name `file_name_root`
+    Read uniform hazard spectra in `nrml_uhs_file` and save to .csv file
+    with root name `file_name_root`. Spectra are parsed, written (and
+    plotted) in chunks of `chunk_size` sites, so that memory use does not
+    depend on the number of sites. `plot_options` are passed to
+    :func:`plot_uhs`.
     """
     output_file = '%s.csv' % file_name_root
     if os.path.isfile(output_file):
         raise ValueError('Output file already exists.'
                          ' Please specify different name or remove old file')
 
-    metadata, periods, values = parse_nrml_uhs_curves(nrml_uhs_file)
-
-    header = ','.join(
-        ['%s=%s' % (k, v) for k, v in metadata.items() if v is not None]
-    )
-    header = '# ' + header
-    header += '\nlon,lat,'+','.join([str(p) for p in periods])
-
     f = open(output_file, 'w')
-    f.write(header+'\n')
-    numpy.savetxt(f, values, fmt='%g', delimiter=',')
+    offset = 0
+    for metadata, periods, matrix in _iter_uhs_matrices(nrml_uhs_file,
+                                                        chunk_size, dtype):
+        values = matrix.to_array()
+        if offset == 0:
+            header = ','.join(
+                ['%s=%s' % (k, v) for k, v in metadata.items()
+                 if v is not None]
+            )
+            header = '# ' + header
+            header += '\nlon,lat,'+','.join([str(p) for p in periods])
+            f.write(header+'\n')
+        savetxt(f, values, fmt='%g', delimiter=',')
+        if plot_spectra and len(values):
+            plot_uhs(file_name_root, values, periods, metadata,
+                     offset=offset, **(plot_options or {}))
+        offset += len(values)
     f.close()
-    if plot_spectra:
-        plot_uhs(file_name_root, values, periods, metadata)
+
+def save_uhs_to_binary(nrml_uhs_file, file_name_root, output_format='npz',
+        dtype=numpy.float64):
+    """
+    Read uniform hazard spectra in `nrml_uhs_file` and save to binary file
+    (see :mod:`binary_io`) with root name `file_name_root`. Value columns
+    are labelled with the periods.
+    """
+    output_file = '%s.%s' % (file_name_root, output_format)
+    if os.path.isfile(output_file):
+        raise ValueError('Output file already exists.'
+                         ' Please specify different name or remove old file')
+
+    metadata, periods, values = parse_nrml_uhs_curves(nrml_uhs_file, dtype)
+    save_binary(file_name_root, metadata, periods, values[:, 0],
+                values[:, 1], values[:, 2:], output_format)
 
 def set_up_arg_parser():
     """
@@ -170,6 +225,39 @@ def set_up_arg_parser():
                        help="Plot the uniform hazard spectra to pdf (True) " 
                        "or not (False) - may take time for many hazard curves",
                        default=False)
+    flags.add_argument('--chunk-size',
+                       help="Number of spectra parsed and written at a time "
+                       "(Optional, default is %d)" % CHUNK_SIZE,
+                       type=int,
+                       default=CHUNK_SIZE)
+    flags.add_argument('--dtype',
+                       help="Floating point type used to store the IMLs "
+                       "(Optional, default is float64)",
+                       choices=['float64', 'float32'],
+                       default='float64')
+    flags.add_argument('--output-format',
+                       help="Format of the output file: csv, or binary npz "
+                       "or hdf5 (Optional, default is csv)",
+                       choices=['csv', 'npz', 'hdf5'],
+                       default='csv')
+    flags.add_argument('--jobs',
+                       help="Number of processes used to plot the spectra "
+                       "(Optional, default is 1)",
+                       type=int,
+                       default=1)
+    flags.add_argument('--atlas',
+                       help="Plot the spectra as pages of multi-page pdf "
+                       "files (one per process) instead of one file per site",
+                       action='store_true')
+    flags.add_argument('--sites',
+                       help="Plot only the sites with the given indices, "
+                       "e.g. 0,5,10-20 (Optional)",
+                       default=None)
+    flags.add_argument('--bbox',
+                       help="Plot only the sites inside the bounding box "
+                       "west/east/south/north (Optional)",
+                       default=None)
+    add_progress_arguments(flags)
 
     return parser
 
@@ -178,12 +266,25 @@ if __name__ == "__main__":
 
     parser = set_up_arg_parser()
     args = parser.parse_args()
+    configure(args)
 
     if args.input_file:
         output_file = \
             os.path.splitext(parser.parse_args().input_file)[0] \
             if args.output_file is None else args.output_file
 
-        save_uhs_to_csv(args.input_file, output_file, args.plot_spectra)
+        plot_options = dict(
+            jobs=args.jobs,
+            atlas=args.atlas,
+            sites=parse_sites(args.sites) if args.sites else None,
+            bbox=parse_bbox(args.bbox) if args.bbox else None)
+        with PROGRESS.stage('convert'):
+            if args.output_format != 'csv':
+                save_uhs_to_binary(args.input_file, output_file,
+                                   args.output_format, numpy.dtype(args.dtype))
+            else:
+                save_uhs_to_csv(args.input_file, output_file,
+                                args.plot_spectra, numpy.dtype(args.dtype),
+                                plot_options, args.chunk_size)
     else:
         parser.print_usage()
@@ -41,6 +41,7 @@
 """
 Utility functions for use with the OQ Output converters
 """
+import re
 import numpy as np
 
 # Based on scitools meshgrid
@@ -171,3 +172,230 @@ def meshgrid(*xi, **kwargs):
             return [x * mult_fact for x in output]
         else:
             return np.broadcast_arrays(*output)
+
+
+def decode_floats(text, dtype=np.float64):
+    """
+    Convert the text of a NRML element containing whitespace separated
+    numbers (e.g. <poEs>, <IMLs>, <gml:pos>) to a numpy array of type
+    `dtype`, in a single call.
+    """
+    return np.fromstring(text, dtype=dtype, sep=' ')
+
+
+class CurveMatrix(object):
+    """
+    Growable matrix storing site coordinates (float64) and values (of type
+    `dtype`) for a set of sites, e.g. hazard curves poes or uniform hazard
+    spectra IMLs.
+
+    Storage is preallocated for `size` sites and doubled every time it is
+    exhausted, so that sites can be added one at a time without building
+    intermediate Python lists.
+    """
+    def __init__(self, n_values, dtype=np.float64, size=1024):
+        self.n_values = n_values
+        self.dtype = dtype
+        self.n_sites = 0
+        self._coords = np.empty((size, 2), dtype=np.float64)
+        self._values = np.empty((size, n_values), dtype=dtype)
+
+    def __len__(self):
+        return self.n_sites
+
+    @property
+    def coords(self):
+        """
+        (n_sites, 2) array of site longitudes and latitudes
+        """
+        return self._coords[:self.n_sites]
+
+    @property
+    def values(self):
+        """
+        (n_sites, n_values) array of site values
+        """
+        return self._values[:self.n_sites]
+
+    def _grow(self):
+        """
+        Double the storage capacity
+        """
+        size = 2 * max(len(self._coords), 1)
+        coords = np.empty((size, 2), dtype=np.float64)
+        values = np.empty((size, self.n_values), dtype=self.dtype)
+        coords[:self.n_sites] = self.coords
+        values[:self.n_sites] = self.values
+        self._coords = coords
+        self._values = values
+
+    def append(self, lon, lat, values):
+        """
+        Add site with coordinates `lon`, `lat` and `values`
+        """
+        if self.n_sites == len(self._coords):
+            self._grow()
+        self._coords[self.n_sites] = lon, lat
+        self._values[self.n_sites] = values
+        self.n_sites += 1
+
+    def append_text(self, pos_text, values_text):
+        """
+        Add site from the text of a <gml:pos> element and of the element
+        containing the site values (e.g. <poEs> or <IMLs>).
+        """
+        values = decode_floats(values_text, self.dtype)
+        if len(values) != self.n_values:
+            raise ValueError('Expected %d values, found %d: %s' %
+                             (self.n_values, len(values), values_text))
+        lon, lat = decode_floats(pos_text)
+        self.append(lon, lat, values)
+
+    def clear(self):
+        """
+        Remove all sites, keeping the allocated storage
+        """
+        self.n_sites = 0
+
+    def to_array(self):
+        """
+        Return (n_sites, 2 + n_values) array, each row containing lon, lat
+        and values of a site
+        """
+        return np.hstack((self.coords, self.values))
+
+
+def read_hazard_csv(file_name):
+    """
+    Read .csv file written by the hazard curve, hazard map or UHS
+    converters: a '# key=value,...' metadata line, a 'lon,lat,...' columns
+    line and one row per site. Return metadata, column labels (as floats
+    when possible) and site longitudes, latitudes and values (2-D array)
+    """
+    f = open(file_name)
+    metadata = {}
+    for item in f.readline().lstrip('#').strip().split(','):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            metadata[key.strip()] = value.strip()
+    columns = f.readline().strip().split(',')[2:]
+    data = np.loadtxt(f, delimiter=',', ndmin=2)
+    f.close()
+    try:
+        columns = np.array(columns, dtype=float)
+    except ValueError:
+        columns = np.array(columns)
+    return metadata, columns, data[:, 0], data[:, 1], data[:, 2:]
+
+
+def site_keys(lons, lats, decimals=5):
+    """
+    Return int64 keys identifying sites by their coordinates rounded to
+    `decimals` decimal places, so that the same site gets the same key in
+    different files even if coordinates differ by rounding errors
+    """
+    scale = 10. ** decimals
+    ilons = np.rint((np.asarray(lons) + 180.) * scale).astype(np.int64)
+    ilats = np.rint((np.asarray(lats) + 90.) * scale).astype(np.int64)
+    return ilons * np.int64(int(181 * scale)) + ilats
+
+
+class SiteTable(object):
+    """
+    Table of the coordinates of a set of sites, assigning an index to each
+    distinct site. Sites are identified by their rounded coordinates (see
+    :func:`site_keys`).
+    """
+    def __init__(self, decimals=5):
+        self.decimals = decimals
+        self.lons = np.empty(0)
+        self.lats = np.empty(0)
+        self._index = {}
+        # coordinates and indices of the last lookup, since consecutive
+        # lookups are usually for the same sites
+        self._last = None
+
+    def __len__(self):
+        return len(self.lons)
+
+    def get_indices(self, lons, lats):
+        """
+        Return array of the indices of the given sites, adding to the table
+        the sites not yet in it
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        if self._last is not None and np.array_equal(lons, self._last[0]) \
+                and np.array_equal(lats, self._last[1]):
+            return self._last[2]
+
+        keys = site_keys(lons, lats, self.decimals)
+        indices = np.empty(len(keys), dtype=np.int64)
+        new_sites = []
+        for i, key in enumerate(keys.tolist()):
+            index = self._index.get(key)
+            if index is None:
+                index = self._index[key] = len(self._index)
+                new_sites.append(i)
+            indices[i] = index
+        if new_sites:
+            self.lons = np.concatenate((self.lons, lons[new_sites]))
+            self.lats = np.concatenate((self.lats, lats[new_sites]))
+        self._last = (lons, lats, indices)
+        return indices
+
+
+# number of rows formatted at a time by savetxt
+SAVETXT_CHUNK_SIZE = 10000
+
+# conversion types for which numpy scalars and Python scalars are formatted
+# identically
+_NUMERIC_CONVERSIONS = set('diouxXeEfFgG%')
+
+
+def savetxt(fname, X, fmt='%.18e', delimiter=' ', newline='\n',
+        chunk_size=SAVETXT_CHUNK_SIZE):
+    """
+    Save array to text file, producing the same output as `numpy.savetxt`
+    (for 1-D and 2-D arrays, without header and footer).
+
+    Instead of applying the format to each row, the row format is repeated
+    for a block of `chunk_size` rows and applied once to the whole block,
+    which is then written with a single call.
+    """
+    X = np.asarray(X)
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+    elif X.ndim != 2:
+        raise ValueError('Expected 1D or 2D array, got %dD array instead' %
+                         X.ndim)
+    ncol = X.shape[1]
+
+    if isinstance(fmt, (list, tuple)):
+        if len(fmt) != ncol:
+            raise AttributeError('fmt has wrong shape.  %s' % str(fmt))
+        row_format = delimiter.join(fmt)
+    elif fmt.count('%') == 1:
+        row_format = delimiter.join([fmt] * ncol)
+    elif fmt.count('%') != ncol:
+        raise AttributeError('fmt has wrong number of %% formats:  %s' % fmt)
+    else:
+        row_format = fmt
+    row_format += newline
+
+    # '%s' formats numpy floats differently from Python floats, so values
+    # are converted to Python scalars only for numeric formats
+    conversions = set(re.findall(r'%[-+ #0-9.*]*([a-zA-Z%])', row_format))
+    to_list = X.dtype.kind in 'biuf' and conversions <= _NUMERIC_CONVERSIONS
+
+    own_file = isinstance(fname, basestring)
+    f = open(fname, 'w') if own_file else fname
+    try:
+        for start in xrange(0, len(X), chunk_size):
+            block = X[start: start + chunk_size]
+            values = block.ravel()
+            values = tuple(values.tolist() if to_list else values)
+            f.write((row_format * len(block)) % values)
+    finally:
+        if own_file:
+            f.close()
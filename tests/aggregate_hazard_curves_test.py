@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from oq_output.binary_io import save_binary
+from oq_output.hazard_curve_converter import parse_nrml_hazard_curves
+from oq_output.aggregate_hazard_curves import weighted_quantile, \
+    read_realizations_file, aggregate_hazard_curves
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+HAZARD_CURVES = os.path.join(DATA_PATH, 'hazard_curves_short.xml')
+
+
+def direct_quantile(curves, weights, quantile):
+    """
+    Weighted quantile computed separately for each poe, interpolating on
+    the cumulative weights of the sorted realizations
+    """
+    n_real, n_sites, n_imls = curves.shape
+    result = numpy.zeros((n_sites, n_imls))
+    for i in range(n_sites):
+        for j in range(n_imls):
+            order = numpy.argsort(curves[:, i, j])
+            result[i, j] = numpy.interp(quantile,
+                                        numpy.cumsum(weights[order]),
+                                        curves[order, i, j])
+    return result
+
+
+class TestAggregateHazardCurves(unittest.TestCase):
+    """
+    Tests computation of mean and quantile hazard curves of logic tree
+    realizations
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.weights = numpy.array([0.2, 0.3, 0.5])
+        metadata, coords, poes = parse_nrml_hazard_curves(HAZARD_CURVES)
+        self.imls = metadata.pop('imls')
+        self.lons = coords[:, 0]
+        self.lats = coords[:, 1]
+        # first realization is the NRML file, the others binary files
+        self.curves = numpy.array([poes, 0.5 * poes, numpy.sqrt(poes)])
+        self.files = [HAZARD_CURVES]
+        for i, rlz_poes in enumerate(self.curves[1:]):
+            self.files.append(save_binary(
+                os.path.join(self.output_dir, 'rlz_%d' % (i + 1)), metadata,
+                self.imls, self.lons, self.lats, rlz_poes, 'npz'))
+        self.output_root = os.path.join(self.output_dir, 'hc')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _read_output(self, output_file):
+        """
+        Read header lines and values of .csv output file
+        """
+        lines = open(output_file).read().splitlines()
+        return lines[:2], numpy.loadtxt(lines[2:], delimiter=',', ndmin=2)
+
+    def test_weighted_quantile(self):
+        """
+        Test weighted quantiles against quantiles computed poe by poe
+        """
+        curves = numpy.random.RandomState(42).uniform(size=(5, 4, 3))
+        weights = numpy.array([0.1, 0.3, 0.15, 0.25, 0.2])
+        for quantile in (0.05, 0.1, 0.33, 0.5, 0.84, 1.):
+            numpy.testing.assert_allclose(
+                weighted_quantile(curves, weights, quantile),
+                direct_quantile(curves, weights, quantile))
+
+    def test_weighted_quantile_single_realization(self):
+        """
+        Test quantiles of a single realization are its curves
+        """
+        curves = numpy.random.RandomState(1).uniform(size=(1, 3, 2))
+        numpy.testing.assert_allclose(
+            weighted_quantile(curves, [1.], 0.16), curves[0])
+
+    def test_read_realizations_file(self):
+        """
+        Test realizations files are taken relative to the realizations
+        file directory, skipping comments and blank lines
+        """
+        realizations_file = os.path.join(self.output_dir, 'rlzs.csv')
+        open(realizations_file, 'w').write(
+            '# path,weight\nrlz_1.npz, 0.4\n\n/data/rlz_2.xml,0.6\n')
+        files, weights = read_realizations_file(realizations_file)
+        self.assertEqual(files, [os.path.join(self.output_dir, 'rlz_1.npz'),
+                                 '/data/rlz_2.xml'])
+        self.assertEqual(weights, [0.4, 0.6])
+
+    def test_mean_and_quantiles(self):
+        """
+        Test mean and quantile curves against numpy, with sites processed
+        in several blocks
+        """
+        aggregate_hazard_curves(self.files, self.weights, self.output_root,
+                                quantiles=[0.16, 0.5, 0.84],
+                                max_block_values=40)
+        coords = numpy.column_stack((self.lons, self.lats))
+
+        header, values = self._read_output('%s_mean.csv' % self.output_root)
+        self.assertTrue('statistics=mean' in header[0])
+        self.assertEqual(header[1], 'lon,lat,' +
+                         ','.join([str(iml) for iml in self.imls]))
+        numpy.testing.assert_allclose(values[:, :2], coords, rtol=1e-5)
+        numpy.testing.assert_allclose(
+            values[:, 2:],
+            numpy.average(self.curves, axis=0, weights=self.weights),
+            rtol=1e-5)
+
+        for quantile in (0.16, 0.5, 0.84):
+            header, values = self._read_output(
+                '%s_quantile_%s.csv' % (self.output_root, quantile))
+            self.assertTrue('statistics=quantile' in header[0])
+            self.assertTrue('quantile_value=%s' % quantile in header[0])
+            numpy.testing.assert_allclose(
+                values[:, 2:],
+                direct_quantile(self.curves, self.weights, quantile),
+                rtol=1e-5)
+
+    def test_parallel_conversion(self):
+        """
+        Test outputs are the same using one or two worker processes
+        """
+        outputs = []
+        for jobs in (1, 2):
+            output_root = '%s_%d' % (self.output_root, jobs)
+            aggregate_hazard_curves(self.files, self.weights, output_root,
+                                    quantiles=[0.5], jobs=jobs)
+            outputs.append([
+                open('%s_mean.csv' % output_root).read(),
+                open('%s_quantile_0.5.csv' % output_root).read()
+            ])
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_invalid_weights(self):
+        """
+        Test weights not summing to 1, negative or not matching the
+        realizations are rejected
+        """
+        for weights in ([0.2, 0.3, 0.4], [1., 1., 1.], [-0.5, 0.5, 1.],
+                        [0.5, 0.5]):
+            self.assertRaises(ValueError, aggregate_hazard_curves,
+                              self.files, weights, self.output_root)
+        self.assertFalse(os.path.exists('%s_mean.csv' % self.output_root))
+
+    def test_different_sites(self):
+        """
+        Test realizations with different sites are rejected
+        """
+        metadata = {'imt': 'PGA', 'investigation_time': '50.0'}
+        self.files[2] = save_binary(
+            os.path.join(self.output_dir, 'other'), metadata, self.imls,
+            self.lons + 1., self.lats, self.curves[2], 'npz')
+        self.assertRaises(ValueError, aggregate_hazard_curves, self.files,
+                          self.weights, self.output_root)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from oq_output.batch_converter import detect_output_type, convert_files, \
+    print_summary
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+SAMPLE_DATA_PATH = '%s/../sample_data/' % os.path.dirname(__file__)
+
+
+class TestBatchConverter(unittest.TestCase):
+    """
+    Tests the conversion of a batch of NRML output files
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_detect_output_type(self):
+        """
+        Test the output type is read from the first element below nrml
+        """
+        self.assertEqual(detect_output_type(
+            os.path.join(DATA_PATH, 'hazard_curves_short.xml')),
+            'hazardCurves')
+        self.assertEqual(detect_output_type(
+            os.path.join(SAMPLE_DATA_PATH, 'hazard_map.xml')), 'hazardMap')
+        self.assertEqual(detect_output_type(
+            os.path.join(SAMPLE_DATA_PATH, 'sample_site_model.csv')), None)
+
+    def test_convert_files(self):
+        """
+        Test supported files are converted and other files are skipped
+        """
+        input_files = [
+            os.path.join(DATA_PATH, 'hazard_curves_short.xml'),
+            os.path.join(SAMPLE_DATA_PATH, 'uniform_hazard_spectra_short.xml'),
+            os.path.join(SAMPLE_DATA_PATH, 'sample_site_model.xml')]
+        results = convert_files(input_files, self.output_dir, jobs=2)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(error is None for _, _, _, error in results))
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ['hazard_curves_short.csv',
+                          'uniform_hazard_spectra_short.csv'])
+
+        summary = StringIO()
+        print_summary(results, 1.0, summary)
+        self.assertIn('Converted 2 file(s)', summary.getvalue())
+        self.assertIn('1 skipped', summary.getvalue())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import unittest
+import numpy
+
+from oq_output.binary_io import save_binary, read_binary, save_arrays, \
+    read_arrays, h5py
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+
+
+class TestBinaryIO(unittest.TestCase):
+    """
+    Tests the binary storage of hazard outputs
+    """
+    def setUp(self):
+        self.file_root = os.path.join(DATA_PATH, 'temp_binary')
+        self.metadata = {'imt': 'PGA', 'investigation_time': '50.0',
+                         'statistics': None}
+        self.imls = [0.005, 0.007, 0.0098]
+        self.lons = numpy.array([-122.5, -122.4])
+        self.lats = numpy.array([37.5, 37.6])
+        self.poes = numpy.array([[0.9, 0.5, 0.1], [0.8, 0.4, 0.05]])
+
+    def tearDown(self):
+        for output_format in ('npz', 'hdf5'):
+            if os.path.isfile('%s.%s' % (self.file_root, output_format)):
+                os.remove('%s.%s' % (self.file_root, output_format))
+
+    def test_npz_round_trip(self):
+        """
+        Tests that arrays written to npz are memory mapped back unchanged
+        """
+        save_binary(self.file_root, self.metadata, self.imls, self.lons,
+                    self.lats, self.poes, 'npz')
+        metadata, columns, lons, lats, values = \
+            read_binary('%s.npz' % self.file_root)
+        self.assertEqual(metadata, {'imt': 'PGA',
+                                    'investigation_time': '50.0'})
+        self.assertTrue(isinstance(values, numpy.memmap))
+        self.assertEqual(lons.dtype, numpy.float64)
+        numpy.testing.assert_array_equal(columns, self.imls)
+        numpy.testing.assert_array_equal(lons, self.lons)
+        numpy.testing.assert_array_equal(lats, self.lats)
+        numpy.testing.assert_array_equal(values, self.poes)
+
+    @unittest.skipIf(h5py is None, 'h5py not available')
+    def test_hdf5_round_trip(self):
+        """
+        Tests that arrays written to hdf5 are memory mapped back unchanged
+        """
+        save_binary(self.file_root, self.metadata, self.imls, self.lons,
+                    self.lats, self.poes, 'hdf5')
+        metadata, columns, lons, lats, values = \
+            read_binary('%s.hdf5' % self.file_root)
+        self.assertEqual(metadata, {'imt': 'PGA',
+                                    'investigation_time': '50.0'})
+        self.assertTrue(isinstance(values, numpy.memmap))
+        self.assertEqual(lons.dtype, numpy.float64)
+        numpy.testing.assert_array_equal(columns, self.imls)
+        numpy.testing.assert_array_equal(lons, self.lons)
+        numpy.testing.assert_array_equal(lats, self.lats)
+        numpy.testing.assert_array_equal(values, self.poes)
+
+    def test_arrays_round_trip(self):
+        """
+        Tests that named arrays are read back unchanged from both formats
+        """
+        arrays = {'gmv': numpy.array([[0.1, 0.2], [0.3, 0.4]], numpy.float32),
+                  'rupture_ids': numpy.array(['r1', 'r2']),
+                  'empty': numpy.zeros(0)}
+        output_formats = ['npz'] if h5py is None else ['npz', 'hdf5']
+        for output_format in output_formats:
+            file_name = save_arrays(self.file_root, self.metadata, arrays,
+                                    output_format)
+            metadata, read = read_arrays(file_name)
+            self.assertEqual(metadata, {'imt': 'PGA',
+                                        'investigation_time': '50.0'})
+            self.assertEqual(sorted(read), sorted(arrays))
+            self.assertTrue(isinstance(read['gmv'], numpy.memmap))
+            for name, array in arrays.items():
+                self.assertEqual(read[name].dtype, array.dtype)
+                numpy.testing.assert_array_equal(read[name], array)
+
+    def test_unsupported_format(self):
+        """
+        Tests that an unknown binary format raises an error
+        """
+        self.assertRaises(ValueError, save_binary, self.file_root,
+                          self.metadata, self.imls, self.lons, self.lats,
+                          self.poes, 'xls')
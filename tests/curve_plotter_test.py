@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from oq_output.curve_plotter import parse_sites, parse_bbox, select_sites, \
+    CurvePlotter, _plot_block, plot_curves
+
+SPEC = dict(x=[0.1, 0.2, 0.4], xlabel='PGA (g)', ylabel='PoE', loglog=True,
+            title='', location_format='Location: %12.6f %s, %12.6f %s',
+            prefix='HazCurve', dpi=50)
+
+
+class TestSiteSelection(unittest.TestCase):
+    """
+    Tests the selection of the sites to plot
+    """
+    def setUp(self):
+        self.coords = numpy.array([[10., 45.], [11., 45.], [10., 46.],
+                                   [-1., -1.]])
+
+    def test_parse_sites(self):
+        """
+        Test indices and inclusive ranges are parsed
+        """
+        self.assertEqual(parse_sites('0,5, 10-12,'), [0, 5, 10, 11, 12])
+
+    def test_parse_bbox(self):
+        """
+        Test bounding box is parsed as west/east/south/north
+        """
+        self.assertEqual(parse_bbox('10/11/-45.5/46'), (10., 11., -45.5, 46.))
+        self.assertRaises(ValueError, parse_bbox, '10/11/45')
+
+    def test_select_sites(self):
+        """
+        Test selection by indices (counted from the offset), by bounding
+        box and by both
+        """
+        self.assertEqual(list(select_sites(self.coords)), [0, 1, 2, 3])
+        self.assertEqual(list(select_sites(self.coords, sites=[1, 3, 7])),
+                         [1, 3])
+        self.assertEqual(
+            list(select_sites(self.coords, sites=[5, 6, 100], offset=4)),
+            [1, 2])
+        self.assertEqual(
+            list(select_sites(self.coords, bbox=(9.5, 10.5, 44., 47.))),
+            [0, 2])
+        self.assertEqual(
+            list(select_sites(self.coords, sites=[0, 1],
+                              bbox=(9.5, 10.5, 44., 47.))), [0])
+
+
+class TestCurvePlotter(unittest.TestCase):
+    """
+    Tests the plotting of curves to pdf files
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.curves = numpy.array([[10., 45., 0.5, 0.1, 0.01],
+                                   [-11.5, 45., 0.4, 0.05, 0.001],
+                                   [10., -46., 0.3, 0.02, 0.002],
+                                   [12., 47., 0.2, 0.01, 0.0001]])
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _get_files(self, name):
+        """
+        Return the sorted names of the files in a subdirectory of the
+        output directory
+        """
+        return sorted(os.listdir(os.path.join(self.output_dir, name)))
+
+    def test_curve_plotter(self):
+        """
+        Test the figure is reused and file names follow the site location
+        """
+        plotter = CurvePlotter(SPEC)
+        plotter.draw(self.curves[0])
+        line = plotter.line
+        plotter.draw(self.curves[1])
+        self.assertIs(plotter.line, line)
+        numpy.testing.assert_equal(line.get_ydata(), self.curves[1, 2:])
+        self.assertEqual(plotter.title.get_text(),
+                         'Location:    11.500000 W,    45.000000 N')
+        self.assertEqual(plotter.site_file_name(self.curves[1]),
+                         'HazCurve_-11.50000W_45.00000N.pdf')
+
+    def test_plot_block(self):
+        """
+        Test a block is plotted to a file per site or to an atlas
+        """
+        self.assertEqual(_plot_block((SPEC, self.output_dir, self.curves[:2],
+                                      5, True)), 2)
+        self.assertEqual(os.listdir(self.output_dir),
+                         ['HazCurve_atlas_5.pdf'])
+
+    def test_plot_curves(self):
+        """
+        Test the pdf files written with and without atlas, and with one
+        and two processes
+        """
+        expected = ['HazCurve_-11.50000W_45.00000N.pdf',
+                    'HazCurve_10.00000E_-46.00000S.pdf',
+                    'HazCurve_10.00000E_45.00000N.pdf',
+                    'HazCurve_12.00000E_47.00000N.pdf']
+        for jobs in (1, 2):
+            name = 'sites_%d' % jobs
+            self.assertEqual(plot_curves(os.path.join(self.output_dir, name),
+                                         self.curves, SPEC, jobs), 4)
+            self.assertEqual(self._get_files(name), expected)
+
+        self.assertEqual(plot_curves(os.path.join(self.output_dir, 'atlas'),
+                                     self.curves, SPEC, atlas=True), 4)
+        self.assertEqual(self._get_files('atlas'), ['HazCurve_atlas_0.pdf'])
+        self.assertEqual(plot_curves(os.path.join(self.output_dir, 'atlas2'),
+                                     self.curves, SPEC, jobs=2, atlas=True,
+                                     offset=10), 4)
+        self.assertEqual(self._get_files('atlas2'),
+                         ['HazCurve_atlas_10.pdf', 'HazCurve_atlas_12.pdf'])
+
+    def test_plot_selected_curves(self):
+        """
+        Test only the selected sites are plotted
+        """
+        self.assertEqual(plot_curves(os.path.join(self.output_dir, 'sel'),
+                                     self.curves, SPEC, jobs=2, sites=[0, 3],
+                                     bbox=(0., 20., 0., 90.)), 2)
+        self.assertEqual(self._get_files('sel'),
+                         ['HazCurve_10.00000E_45.00000N.pdf',
+                          'HazCurve_12.00000E_47.00000N.pdf'])
+        self.assertEqual(plot_curves(os.path.join(self.output_dir, 'none'),
+                                     self.curves, SPEC, sites=[9]), 0)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from lxml import etree
+
+from oq_output.eventset_converter import iter_ruptures, parse_sesc_file, \
+    save_sess_to_txt, get_centroids, PlanarSurface, MultiPlanarSurface, \
+    MeshSurface, RuptureTable, parse_mesh, get_row_major_indices, \
+    ROW_MAJOR_INDICES, MAX_CACHED_SHAPES
+
+SAMPLE_DATA_PATH = '%s/../sample_data/' % os.path.dirname(__file__)
+SES_FILE = os.path.join(SAMPLE_DATA_PATH, 'event_set.xml')
+
+
+class TestEventSetConverter(unittest.TestCase):
+    """
+    Tests the streaming conversion of stochastic event sets
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_iter_ruptures(self):
+        """
+        Test ruptures are yielded in order with their set id
+        """
+        metadata = {}
+        investigation_times = {}
+        ruptures = list(iter_ruptures(SES_FILE, metadata,
+                                      investigation_times))
+        self.assertEqual(len(ruptures), 199)
+        ses_id, rupture = ruptures[0]
+        self.assertEqual(ses_id, '1')
+        self.assertEqual(rupture.ID, 'rlz=00|ses=0001|src=10138|i=0049-00')
+        self.assertEqual(rupture.magnitude, 5.45)
+        self.assertEqual(metadata, {'smtp': 'b1'})
+        self.assertEqual(investigation_times, {'1': '50.0'})
+
+    def test_save_sess_to_txt(self):
+        """
+        Test streamed and collected ruptures give the same file
+        """
+        save_sess_to_txt(iter_ruptures(SES_FILE), self.output_dir,
+                         chunk_size=7)
+        collection_dir = os.path.join(self.output_dir, 'collection')
+        os.mkdir(collection_dir)
+        save_sess_to_txt(parse_sesc_file(SES_FILE), collection_dir)
+
+        lines = open(os.path.join(self.output_dir,
+                                  'ses_1.txt')).read().splitlines()
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(lines[1].split('\t')[:2],
+                         ['rlz=00|ses=0001|src=10138|i=0049-00', '5.5'])
+        self.assertEqual(
+            open(os.path.join(collection_dir, 'ses_1.txt')).read().splitlines(),
+            lines)
+
+    def test_save_sess_without_boundaries(self):
+        """
+        Test the boundary column is omitted when not asked for
+        """
+        save_sess_to_txt(iter_ruptures(SES_FILE), self.output_dir,
+                         boundaries=False)
+        lines = open(os.path.join(self.output_dir,
+                                  'ses_1.txt')).read().splitlines()
+        self.assertEqual(lines[0].split('\t')[-1], 'rake')
+        self.assertTrue(all(len(line.split('\t')) == 9 for line in lines))
+
+
+class TestParseMesh(unittest.TestCase):
+    """
+    Tests the parsing of mesh surfaces
+    """
+    NODE = '<node row="%d" col="%d" lon="%s" lat="%s" depth="%s"/>'
+
+    def _get_mesh(self, nodes):
+        """
+        Return mesh element with 2 rows and 3 columns and given nodes
+        """
+        return etree.fromstring(
+            '<mesh xmlns="http://openquake.org/xmlns/nrml/0.4" '
+            'rows="2" cols="3">%s</mesh>' % ''.join(
+                self.NODE % (row, col, 10. + col * 0.1, 45. - row * 0.1,
+                             5. * row) for row, col in nodes))
+
+    def test_row_major_and_shuffled_nodes(self):
+        """
+        Test nodes are placed in the grids whatever their order
+        """
+        nodes = [(row, col) for row in range(2) for col in range(3)]
+        expected = parse_mesh(self._get_mesh(nodes))
+        numpy.testing.assert_equal(expected.lons,
+                                   [[10., 10.1, 10.2], [10., 10.1, 10.2]])
+        numpy.testing.assert_equal(expected.lats,
+                                   [[45., 45., 45.], [44.9, 44.9, 44.9]])
+        numpy.testing.assert_equal(expected.depths,
+                                   [[0., 0., 0.], [5., 5., 5.]])
+
+        surf = parse_mesh(self._get_mesh(nodes[::-1]))
+        for name in ('lons', 'lats', 'depths'):
+            numpy.testing.assert_equal(getattr(surf, name),
+                                       getattr(expected, name))
+
+        surf = parse_mesh(self._get_mesh(
+            [(row, col) for col in range(3) for row in range(2)]))
+        numpy.testing.assert_equal(surf.lons, expected.lons)
+
+    def test_row_major_indices_cache(self):
+        """
+        Test the indices of the most recently used mesh shapes are cached
+        """
+        self.assertEqual(get_row_major_indices(2, 3),
+                         (['0', '0', '0', '1', '1', '1'],
+                          ['0', '1', '2', '0', '1', '2']))
+        for ncols in range(1, MAX_CACHED_SHAPES + 5):
+            get_row_major_indices(1, ncols)
+        get_row_major_indices(1, 5)
+        self.assertEqual(len(ROW_MAJOR_INDICES), MAX_CACHED_SHAPES)
+        self.assertFalse((2, 3) in ROW_MAJOR_INDICES)
+        self.assertEqual(list(ROW_MAJOR_INDICES)[-1], (1, 5))
+
+class TestRuptureTable(unittest.TestCase):
+    """
+    Tests the columnar storage of ruptures
+    """
+    def setUp(self):
+        ruptures = [rupture for _, rupture in iter_ruptures(SES_FILE)][:4]
+        self.ruptures = ruptures
+        self.table = RuptureTable.from_ruptures(['2', '1', '2', '1'],
+                                                ruptures)
+
+    def test_boundaries(self):
+        """
+        Test boundaries are stored as flat arrays with offsets and
+        formatted as WKT only on request
+        """
+        self.assertEqual(len(self.table), 4)
+        self.assertEqual(self.table.rupture_offsets[-1],
+                         len(self.table.ring_offsets) - 1)
+        self.assertEqual(self.table.ring_offsets[-1],
+                         len(self.table.boundary_lons))
+        lons, lats = self.ruptures[0].surf.get_surface_boundaries()
+        self.assertEqual(
+            self.table.get_boundary_wkt(0),
+            'MULTIPOLYGON(((%s)))' % ','.join(
+                '%s %s' % point for point in zip(lons[0], lats[0])))
+        self.assertEqual(self.table.get_rows([0, 1]).shape, (2, 10))
+        self.assertEqual(self.table.get_rows([0, 1], False).shape, (2, 9))
+
+    def test_group_by_ses(self):
+        """
+        Test ruptures are grouped by set, keeping their order
+        """
+        groups = [(ses_id, list(indices))
+                  for ses_id, indices in self.table.group_by_ses()]
+        self.assertEqual(groups, [('1', [1, 3]), ('2', [0, 2])])
+
+
+class TestCentroids(unittest.TestCase):
+    """
+    Tests the batch computation of surface middle points
+    """
+    def test_planar_surface(self):
+        """
+        Test the middle point of a plane is halfway along the great circles
+        """
+        surf = PlanarSurface(numpy.array([0., 2., 2., 0.]),
+                             numpy.array([1., 1., -1., -1.]),
+                             numpy.array([0., 0., 10., 10.]))
+        centroids = get_centroids([surf, MultiPlanarSurface([surf, surf])])
+        numpy.testing.assert_allclose(centroids,
+                                      [[1., 0., 5.], [1., 0., 5.]],
+                                      atol=1e-10)
+
+    def test_mesh_surfaces(self):
+        """
+        Test the middle node is taken from meshes with odd number of rows
+        and columns, and batch and single surface middle points agree
+        """
+        rng = numpy.random.RandomState(42)
+        surfs = []
+        for shape in [(3, 5), (4, 6), (3, 5), (2, 7)]:
+            surfs.append(MeshSurface(rng.uniform(10., 11., shape),
+                                     rng.uniform(45., 46., shape),
+                                     rng.uniform(0., 20., shape)))
+        centroids = get_centroids(surfs)
+        self.assertEqual(tuple(centroids[0]),
+                         (surfs[0].lons[1, 2], surfs[0].lats[1, 2],
+                          surfs[0].depths[1, 2]))
+        numpy.testing.assert_allclose(
+            centroids, [surf.get_middle_point() for surf in surfs])
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from oq_output.gmf_output import GmfWriter, get_gmf_writer, h5py
+from oq_output.gmfset_converter import iter_gmf_records, \
+    write_gmfs_to_long_format
+from oq_output.scenario_gmf_converter import parse_gmfs_file, \
+    save_gmfs_to_long_format
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+
+
+class TestGmfWriters(unittest.TestCase):
+    """
+    Tests the consolidated GMF writers
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _write_fields(self, writer):
+        """
+        Write two PGA fields (the second at a new site) and a PGV field
+        """
+        indices = writer.sites.get_indices([10.0, 10.1], [45.0, 45.0])
+        writer.write(('1', 'rup_a'), 'PGA', indices, [0.1, 0.2])
+        writer.write(('1', 'rup_b'), 'PGV', indices, [3.0, 4.0])
+        indices = writer.sites.get_indices([10.1, 10.2], [45.0, 45.0])
+        writer.write(('2', 'rup_c'), 'PGA', indices, [0.3, 0.4])
+
+    def test_incomplete_writer(self):
+        """
+        Test writers must implement close and _write_fields
+        """
+        class IncompleteWriter(GmfWriter):
+            def close(self):
+                return []
+
+        self.assertRaises(TypeError, GmfWriter, ('ses_id',))
+        self.assertRaises(TypeError, IncompleteWriter, ('ses_id',))
+
+    def test_csv_writer(self):
+        """
+        Test a long-format file is written per IMT, plus the site table
+        """
+        writer = get_gmf_writer('long-csv', self.output_dir,
+                                ('ses_id', 'rupture_id'), {'smltp': 'b1'})
+        writer.buffer_size = 3
+        self._write_fields(writer)
+        file_names = writer.close()
+        self.assertEqual([os.path.basename(f) for f in file_names],
+                         ['gmfs_PGA.csv', 'gmfs_PGV.csv', 'sites.csv'])
+        self.assertEqual(open(file_names[0]).read().splitlines(),
+                         ['# smltp=b1', 'ses_id,rupture_id,site_idx,gmv',
+                          '1,rup_a,0,0.1', '1,rup_a,1,0.2',
+                          '2,rup_c,1,0.3', '2,rup_c,2,0.4'])
+        self.assertEqual(open(file_names[2]).read().splitlines()[1:],
+                         ['site_idx,lon,lat', '0,10.0,45.0', '1,10.1,45.0',
+                          '2,10.2,45.0'])
+
+    @unittest.skipIf(h5py is None, 'h5py not available')
+    def test_hdf5_writer(self):
+        """
+        Test the datasets are extended at each flush
+        """
+        writer = get_gmf_writer('long-hdf5', self.output_dir,
+                                ('ses_id', 'rupture_id'), {'smltp': 'b1'})
+        writer.buffer_size = 2
+        self._write_fields(writer)
+        file_name, = writer.close()
+
+        f = h5py.File(file_name, 'r')
+        try:
+            self.assertEqual(f.attrs['smltp'], 'b1')
+            numpy.testing.assert_allclose(f['lon'][()], [10.0, 10.1, 10.2])
+            pga = f['PGA']
+            self.assertEqual(list(pga['rupture_id'][()]), ['rup_a', 'rup_c'])
+            numpy.testing.assert_equal(pga['event_idx'][()], [0, 0, 1, 1])
+            numpy.testing.assert_equal(pga['site_idx'][()], [0, 1, 1, 2])
+            numpy.testing.assert_allclose(pga['gmv'][()],
+                                          [0.1, 0.2, 0.3, 0.4], rtol=1e-6)
+            self.assertEqual(list(f['PGV/ses_id'][()]), ['1'])
+        finally:
+            f.close()
+
+    @unittest.skipIf(h5py is None, 'h5py not available')
+    def test_hdf5_round_trip(self):
+        """
+        Test the fields read back from the hdf5 file are those written
+        """
+        gmfc_file = os.path.join(DATA_PATH, 'gmf_collection.xml')
+        metadata = {}
+        file_name, = write_gmfs_to_long_format(
+            iter_gmf_records(gmfc_file, metadata), self.output_dir, metadata,
+            'long-hdf5')
+
+        read_records = []
+        f = h5py.File(file_name, 'r')
+        try:
+            self.assertEqual(dict(f.attrs), {'smltp': 'b1', 'gsimltp': 'b1'})
+            lons, lats = f['lon'][()], f['lat'][()]
+            for imt in f:
+                if imt in ('lon', 'lat'):
+                    continue
+                group = f[imt]
+                event_idx = group['event_idx'][()]
+                site_idx = group['site_idx'][()]
+                gmv = group['gmv'][()]
+                for i, (ses_id, rup_id) in enumerate(
+                        zip(group['ses_id'][()], group['rupture_id'][()])):
+                    rows = event_idx == i
+                    values = numpy.column_stack((lons[site_idx[rows]],
+                                                 lats[site_idx[rows]],
+                                                 gmv[rows]))
+                    read_records.append((ses_id, imt, rup_id, values))
+        finally:
+            f.close()
+
+        records = sorted(iter_gmf_records(gmfc_file), key=lambda r: r[:3])
+        read_records.sort(key=lambda r: r[:3])
+        self.assertEqual([r[:3] for r in read_records],
+                         [r[:3] for r in records])
+        for (_, _, _, read_values), (_, _, _, values) in zip(read_records,
+                                                             records):
+            numpy.testing.assert_allclose(read_values, values, rtol=1e-6)
+
+    def test_scenario_long_format(self):
+        """
+        Test scenario fields are numbered as in the per-field output
+        """
+        file_names = save_gmfs_to_long_format(
+            parse_gmfs_file(os.path.join(DATA_PATH, 'scenario_gmfs.xml')),
+            self.output_dir)
+        self.assertEqual([os.path.basename(f) for f in file_names],
+                         ['gmfs_PGA.csv', 'gmfs_SA(1.0).csv', 'sites.csv'])
+        self.assertEqual(open(file_names[0]).read().splitlines(),
+                         ['gmf_id,site_idx,gmv', '1,0,0.1', '1,1,0.2',
+                          '2,0,0.3', '2,1,0.4'])
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from oq_output.gmfset_converter import parse_gmfc_file, save_gmfs_to_csv, \
+    save_gmfs_to_wide_csv, save_gmfs_to_binary, read_gmfs_binary, \
+    save_gmfs_to_long_format, iter_gmf_records, write_gmfs_to_csv, \
+    ExceedanceCounter, save_hazard_curves_from_gmfs, save_gmfs_to_netcdf, \
+    _gmf_rasters
+from oq_output import gmfset_converter
+from oq_output.gmice import gm_to_mmi
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+GMFC_FILE = os.path.join(DATA_PATH, 'gmf_collection.xml')
+NODE_ORDER_FILE = os.path.join(DATA_PATH, 'gmf_node_order.xml')
+
+
+class TestGmfCollection(unittest.TestCase):
+    """
+    Tests the site-deduplicated representation of a GMF collection
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_parse_gmfc_file(self):
+        """
+        Test sites are stored once and fields as rows of float32 matrices
+        """
+        gmfc = parse_gmfc_file(GMFC_FILE)
+        self.assertEqual((gmfc.sm_tp, gmfc.gsim_tp), ('b1', 'b1'))
+        numpy.testing.assert_allclose(gmfc.sites.lons,
+                                      [10.0, 10.1, 10.0, 10.1])
+        numpy.testing.assert_allclose(gmfc.sites.lats,
+                                      [45.0, 45.0, 45.1, 45.1])
+
+        ses1, ses2 = gmfc.gmfss
+        self.assertEqual(list(ses1.gmfs), ['PGA', 'SA(0.1)'])
+        self.assertEqual(ses1.gmfs['PGA'].rupture_ids,
+                         ['rup_1_1', 'rup_1_2'])
+        self.assertEqual(ses1.gmfs['PGA'].gmvs.dtype, numpy.float32)
+        numpy.testing.assert_allclose(
+            gmfc.get_gmvs(ses1, 'PGA'),
+            [[0.1, 0.2, 0.3, numpy.nan], [0.01, 0.02, 0.03, numpy.nan]],
+            rtol=1e-6)
+        numpy.testing.assert_allclose(
+            gmfc.get_gmvs(ses2, 'PGA'), [[numpy.nan, 0.05, numpy.nan, 0.07]],
+            rtol=1e-6)
+
+    def test_sets_compacted(self):
+        """
+        Test the matrices of every set, including the last, hold no unused
+        rows, and sets without fields are kept
+        """
+        gmfc_file = os.path.join(self.output_dir, 'gmfs.xml')
+        content = open(GMFC_FILE).read().replace(
+            '</gmfCollection>',
+            '<gmfSet stochasticEventSetId="3" investigationTime="50.0">\n'
+            '    </gmfSet>\n  </gmfCollection>')
+        open(gmfc_file, 'w').write(content)
+        gmfc = parse_gmfc_file(gmfc_file)
+        self.assertEqual([gmf_set.stochasticEventSetId
+                          for gmf_set in gmfc.gmfss], ['1', '2', '3'])
+        self.assertEqual(gmfc.gmfss[2].investigationTime, '50.0')
+        self.assertEqual(gmfc.gmfss[2].gmfs, {})
+        for gmf_set in gmfc.gmfss:
+            for matrix in gmf_set.gmfs.values():
+                self.assertEqual(matrix._gmvs.shape[0],
+                                 len(matrix.rupture_ids))
+
+    def test_save_gmfs_to_csv(self):
+        """
+        Test a file per rupture lists only the sites of the field
+        """
+        save_gmfs_to_csv(parse_gmfc_file(GMFC_FILE), self.output_dir)
+        lines = open(os.path.join(self.output_dir,
+                                  'StochasticEventSet_2_PGA',
+                                  'rup_2_1.csv')).read().splitlines()
+        self.assertEqual(lines, ['# smltp=b1, gsimltp=b1', '# IMT=PGA',
+                                 'lon,lat,gmf_value', '10.10,45.00,0.05',
+                                 '10.10,45.10,0.07'])
+
+    def test_save_gmfs_to_netcdf_cleanup(self):
+        """
+        Test the ignored cleanup argument is still accepted positionally
+        and by keyword, before the output format
+        """
+        gmfc = parse_gmfc_file(GMFC_FILE)
+        for name, args, kwargs in [
+                ('positional', (False, '10k', True, 'geotiff'), {}),
+                ('keyword', (), dict(cleanup=True, output_format='geotiff'))]:
+            out_dir = os.path.join(self.output_dir, name)
+            save_gmfs_to_netcdf(gmfc, out_dir, *args, **kwargs)
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(
+                    out_dir, 'StochasticEventSet_1_PGA'))),
+                ['rup_1_1.tif', 'rup_1_2.tif'])
+
+    def test_gmf_rasters_mmi(self):
+        """
+        Test the fields of each IMT in a batch are converted to MMI with a
+        single call
+        """
+        calls = []
+        original = gmfset_converter.convert_gmv_columns
+
+        def convert_gmv_columns(gmfs, imt, model):
+            calls.append((imt, len(gmfs)))
+            original(gmfs, imt, model)
+
+        gmfset_converter.convert_gmv_columns = convert_gmv_columns
+        try:
+            rasters = list(_gmf_rasters(iter_gmf_records(GMFC_FILE),
+                                        self.output_dir, True, '10k',
+                                        'AK2007', batch_size=3))
+        finally:
+            gmfset_converter.convert_gmv_columns = original
+        self.assertEqual(calls, [('PGA', 2), ('PGA', 1)])
+        self.assertEqual([raster[3] for raster in rasters],
+                         ['mmi', 'SA(0.1)', 'mmi', 'mmi'])
+        records = list(iter_gmf_records(GMFC_FILE))
+        for (_, imt, _, values), raster in zip(records, rasters):
+            if imt == 'PGA':
+                values = gm_to_mmi(values[:, 2], imt)
+            else:
+                values = values[:, 2]
+            numpy.testing.assert_allclose(raster[2], values)
+
+    def test_save_gmfs_to_wide_csv(self):
+        """
+        Test the wide .csv file has a row per rupture and a column per site
+        """
+        root = os.path.join(self.output_dir, 'gmfs')
+        gmfs_file, sites_file = save_gmfs_to_wide_csv(
+            parse_gmfc_file(GMFC_FILE), root, chunk_size=1)
+        lines = open(gmfs_file).read().splitlines()
+        self.assertEqual(lines[1], 'ses_id,imt,rupture_id,site_0,site_1,'
+                                   'site_2,site_3')
+        self.assertEqual(lines[2:], ['1,PGA,rup_1_1,0.1,0.2,0.3,',
+                                     '1,PGA,rup_1_2,0.01,0.02,0.03,',
+                                     '1,SA(0.1),rup_1_1,0.4,0.5,0.6,',
+                                     '2,PGA,rup_2_1,,0.05,,0.07'])
+        self.assertEqual(open(sites_file).read().splitlines()[-1],
+                         '3,10.1,45.1')
+
+    def test_binary_round_trip(self):
+        """
+        Test the collection read back from binary files is the same
+        """
+        gmfc = parse_gmfc_file(GMFC_FILE)
+        for output_format in ('npz', 'hdf5'):
+            output_file = save_gmfs_to_binary(
+                gmfc, os.path.join(self.output_dir, 'gmfs'), output_format)
+            read_gmfc = read_gmfs_binary(output_file)
+            self.assertEqual(read_gmfc.gsim_tp, 'b1')
+            numpy.testing.assert_equal(read_gmfc.sites.lons, gmfc.sites.lons)
+            for gmf_set, read_set in zip(gmfc.gmfss, read_gmfc.gmfss):
+                self.assertEqual(read_set.stochasticEventSetId,
+                                 gmf_set.stochasticEventSetId)
+                self.assertEqual(list(read_set.gmfs), list(gmf_set.gmfs))
+                for imt in gmf_set.gmfs:
+                    self.assertEqual(read_set.gmfs[imt].rupture_ids,
+                                     gmf_set.gmfs[imt].rupture_ids)
+                    numpy.testing.assert_equal(
+                        read_gmfc.get_gmvs(read_set, imt),
+                        gmfc.get_gmvs(gmf_set, imt))
+
+    def test_save_gmfs_to_long_format(self):
+        """
+        Test a row is written per rupture and site of the field
+        """
+        file_names = save_gmfs_to_long_format(parse_gmfc_file(GMFC_FILE),
+                                              self.output_dir)
+        self.assertEqual(open(file_names[0]).read().splitlines(),
+                         ['# gsimltp=b1', '# smltp=b1',
+                          'ses_id,rupture_id,site_idx,gmv',
+                          '1,rup_1_1,0,0.1', '1,rup_1_1,1,0.2',
+                          '1,rup_1_1,2,0.3', '1,rup_1_2,0,0.01',
+                          '1,rup_1_2,1,0.02', '1,rup_1_2,2,0.03',
+                          '2,rup_2_1,1,0.05', '2,rup_2_1,3,0.07'])
+
+    def test_iter_gmf_records(self):
+        """
+        Test a record is yielded per field, with metadata read on the way
+        """
+        metadata = {}
+        investigation_times = {}
+        records = list(iter_gmf_records(GMFC_FILE, metadata,
+                                        investigation_times))
+        self.assertEqual([record[:3] for record in records],
+                         [('1', 'PGA', 'rup_1_1'), ('1', 'SA(0.1)', 'rup_1_1'),
+                          ('1', 'PGA', 'rup_1_2'), ('2', 'PGA', 'rup_2_1')])
+        numpy.testing.assert_allclose(records[-1][3], [[10.1, 45.0, 0.05],
+                                                       [10.1, 45.1, 0.07]])
+        self.assertEqual(metadata, {'smltp': 'b1', 'gsimltp': 'b1'})
+        self.assertEqual(investigation_times, {'1': '50.0', '2': '50.0'})
+
+    def test_iter_gmf_records_set_callback(self):
+        """
+        Test set boundaries are signalled around the records of each set
+        """
+        events = []
+        for record in iter_gmf_records(
+                GMFC_FILE, set_callback=lambda *args: events.append(args)):
+            events.append(record[:3])
+        self.assertEqual(events, [('start', '1'), ('1', 'PGA', 'rup_1_1'),
+                                  ('1', 'SA(0.1)', 'rup_1_1'),
+                                  ('1', 'PGA', 'rup_1_2'), ('end', '1'),
+                                  ('start', '2'), ('2', 'PGA', 'rup_2_1'),
+                                  ('end', '2')])
+
+    def test_write_gmfs_to_csv(self):
+        """
+        Test streamed records give the same files as the collection
+        """
+        metadata = {}
+        write_gmfs_to_csv(iter_gmf_records(GMFC_FILE, metadata),
+                          self.output_dir, metadata)
+        collection_dir = os.path.join(self.output_dir, 'collection')
+        save_gmfs_to_csv(parse_gmfc_file(GMFC_FILE), collection_dir)
+        for dir_name in os.listdir(collection_dir):
+            for file_name in os.listdir(os.path.join(collection_dir,
+                                                     dir_name)):
+                self.assertEqual(
+                    open(os.path.join(self.output_dir, dir_name,
+                                      file_name)).read(),
+                    open(os.path.join(collection_dir, dir_name,
+                                      file_name)).read())
+
+    def test_write_gmfs_to_csv_node_order(self):
+        """
+        Test streamed records are written in node order with full
+        precision, as by the converter before the site table was introduced
+        """
+        metadata = {}
+        write_gmfs_to_csv(iter_gmf_records(NODE_ORDER_FILE, metadata),
+                          self.output_dir, metadata)
+        header = '# smltp=b1, gsimltp=b1\n# IMT=PGA\nlon,lat,gmf_value\n'
+        dir_name = os.path.join(self.output_dir, 'StochasticEventSet_1_PGA')
+        self.assertEqual(open(os.path.join(dir_name, 'rup_1.csv')).read(),
+                         header + '10.00,45.00,0.277978\n'
+                                  '10.10,45.00,0.539447\n'
+                                  '10.00,45.10,0.372812\n')
+        self.assertEqual(open(os.path.join(dir_name, 'rup_2.csv')).read(),
+                         header + '10.00,45.10,0.904012\n'
+                                  '10.00,45.00,0.0123457\n'
+                                  '10.10,45.00,1.5\n')
+
+    def test_save_gmfs_to_csv_site_order(self):
+        """
+        Test the collection writes float32 values in site table order
+        """
+        save_gmfs_to_csv(parse_gmfc_file(NODE_ORDER_FILE), self.output_dir)
+        lines = open(os.path.join(self.output_dir,
+                                  'StochasticEventSet_1_PGA',
+                                  'rup_2.csv')).read().splitlines()
+        self.assertEqual(lines[3:], ['10.00,45.00,0.0123457',
+                                     '10.10,45.00,1.5',
+                                     '10.00,45.10,0.904013'])
+
+    def test_exceedance_counter(self):
+        """
+        Test counts of values greater than or equal to each IML
+        """
+        counter = ExceedanceCounter([0.1, 0.2, 0.3])
+        counter.add(numpy.array([0, 2]), numpy.array([0.05, 0.2]))
+        counter.add(numpy.array([2, 0]), numpy.array([0.35, 0.1]))
+        numpy.testing.assert_equal(counter.get_counts(4),
+                                   [[1, 0, 0], [0, 0, 0], [2, 2, 1],
+                                    [0, 0, 0]])
+
+    def test_save_hazard_curves_from_gmfs(self):
+        """
+        Test hazard curves from the exceedance counts of the two sets
+        """
+        file_names = save_hazard_curves_from_gmfs(GMFC_FILE, self.output_dir,
+                                                  [0.02, 0.1, 0.25])
+        self.assertEqual([os.path.basename(f) for f in file_names],
+                         ['hazard_curves_PGA.csv',
+                          'hazard_curves_SA(0.1).csv'])
+        lines = open(file_names[0]).read().splitlines()
+        self.assertTrue(lines[0].startswith('# '))
+        self.assertTrue('investigation_time=50.0' in lines[0])
+        self.assertEqual(lines[1], 'lon,lat,0.02,0.1,0.25')
+        # counts over the 100 years of the two sets
+        counts = numpy.array([[1, 1, 0], [3, 1, 0], [2, 1, 1], [1, 0, 0]])
+        curves = numpy.array([line.split(',') for line in lines[2:]],
+                             dtype=float)
+        numpy.testing.assert_allclose(curves[:, :2],
+                                      [[10., 45.], [10.1, 45.], [10., 45.1],
+                                       [10.1, 45.1]])
+        numpy.testing.assert_allclose(curves[:, 2:],
+                                      1 - numpy.exp(-counts / 2.), rtol=1e-5)
+        self.assertTrue(
+            'imt=SA' in open(file_names[1]).readline() and
+            'sa_period=0.1' in open(file_names[1]).readline())
+
+    def test_hazard_curves_without_sets(self):
+        """
+        Test a collection without stochastic event sets is rejected
+        """
+        gmfc_file = os.path.join(self.output_dir, 'gmfs.xml')
+        open(gmfc_file, 'w').write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<nrml xmlns="http://openquake.org/xmlns/nrml/0.4">\n'
+            '  <gmfCollection sourceModelTreePath="b1" gsimTreePath="b1">\n'
+            '  </gmfCollection>\n</nrml>\n')
+        with self.assertRaises(ValueError) as cm:
+            save_hazard_curves_from_gmfs(gmfc_file, self.output_dir, [0.1])
+        self.assertTrue(gmfc_file in str(cm.exception))
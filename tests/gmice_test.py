@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import unittest
+import numpy
+
+from oq_output.gmice import gm_to_mmi, convert_gmv_columns, supports_imt, \
+    AK2007
+
+
+class TestGMICE(unittest.TestCase):
+    """
+    Tests the vectorized ground motion to intensity conversion
+    """
+    def setUp(self):
+        self.pga = numpy.array([0.001, 0.01, 0.05, 0.1, 0.5, 5.])
+
+    def test_ak2007_pga(self):
+        """
+        Tests both branches of the bilinear relation and the MMI limit
+        """
+        coeffs = AK2007['PGA']
+        logy = numpy.log10(self.pga * coeffs['cfact'])
+        expected = numpy.where(logy > coeffs['logy15'],
+                               coeffs['C3'] + coeffs['C4'] * logy,
+                               coeffs['C1'] + coeffs['C2'] * logy)
+        expected[expected > 10.] = 10.
+        numpy.testing.assert_allclose(gm_to_mmi(self.pga, 'PGA'), expected)
+        self.assertEqual(gm_to_mmi(self.pga, 'PGA')[-1], 10.)
+
+    def test_multiple_imts(self):
+        """
+        Tests conversion of (n_sites, n_imts) values, with sigma
+        """
+        values = numpy.column_stack((self.pga, self.pga * 100.))
+        mmi, sigma = gm_to_mmi(values, ['PGA', 'PGV'], 'WGRW12',
+                               return_sigma=True)
+        self.assertEqual(mmi.shape, (6, 2))
+        numpy.testing.assert_allclose(
+            mmi[:, 1], gm_to_mmi(values[:, 1], 'PGV', 'WGRW12'))
+        numpy.testing.assert_allclose(sigma[0], [0.73, 0.65])
+
+    def test_unsupported_imt(self):
+        """
+        Tests an error is raised for IMTs not covered by the model
+        """
+        self.assertRaises(ValueError, gm_to_mmi, self.pga, 'SA(1.0)',
+                          'Wald99')
+        self.assertRaises(ValueError, gm_to_mmi, self.pga, 'PGA', 'XYZ')
+
+    def test_sa_period_format(self):
+        """
+        Tests SA periods are matched whatever their format
+        """
+        self.assertTrue(supports_imt('SA(1)', 'WGRW12'))
+        self.assertFalse(supports_imt('SA(x)', 'WGRW12'))
+        numpy.testing.assert_allclose(gm_to_mmi(self.pga, 'SA(1)'),
+                                      gm_to_mmi(self.pga, 'SA(1.0)'))
+
+    def test_convert_gmv_columns(self):
+        """
+        Tests the last column of each field is converted in place
+        """
+        gmfs = [numpy.column_stack((self.pga, self.pga, self.pga)),
+                numpy.array([[0., 0., 0.2]])]
+        convert_gmv_columns(gmfs, 'PGA')
+        numpy.testing.assert_allclose(gmfs[0][:, 2],
+                                      gm_to_mmi(self.pga, 'PGA'))
+        numpy.testing.assert_allclose(gmfs[0][:, 0], self.pga)
+        self.assertAlmostEqual(gmfs[1][0, 2], gm_to_mmi([0.2], 'PGA')[0])
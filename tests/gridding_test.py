@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy
+
+from oq_output.gridding import Grid, parse_spacing, save_raster, save_rasters
+
+try:
+    from scipy.io import netcdf_file
+except ImportError:
+    netcdf_file = None
+
+
+class TestGrid(unittest.TestCase):
+    """
+    Tests the rasterization of site values
+    """
+    def setUp(self):
+        lons, lats = numpy.meshgrid(numpy.arange(10., 12.01, 0.1),
+                                    numpy.arange(40., 41.01, 0.05))
+        self.lons = lons.ravel()
+        self.lats = lats.ravel()
+        self.values = self.lons * 100. + self.lats
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_regular_grid(self):
+        """
+        Test sites on a regular grid are used as grid nodes, missing sites
+        are NaN
+        """
+        grid = Grid.from_sites(self.lons[1:], self.lats[1:], '50k')
+        self.assertEqual((len(grid.lats), len(grid.lons)), (21, 21))
+        raster = grid.rasterize(self.values[1:])
+        expected = self.values.reshape(21, 21).astype(numpy.float32)
+        expected[0, 0] = numpy.nan
+        numpy.testing.assert_array_equal(raster, expected)
+
+    def test_binning(self):
+        """
+        Test scattered sites are binned with the mean of the values
+        """
+        grid = Grid.from_sites([0., 0.01, 1.], [0., 0.01, 0.5], '0.5')
+        raster = grid.rasterize(numpy.array([1., 3., 5.]))
+        numpy.testing.assert_array_equal(
+            raster, [[2., numpy.nan, numpy.nan], [numpy.nan, numpy.nan, 5.]])
+
+    def test_non_finite_values(self):
+        """
+        Test non-finite values are excluded from the node means
+        """
+        grid = Grid.from_sites([0., 0.01, 0.02, 1.], [0., 0.01, 0., 0.5],
+                               '0.5')
+        raster = grid.rasterize(numpy.array([1., numpy.nan, 3., numpy.inf]))
+        numpy.testing.assert_array_equal(
+            raster, [[2., numpy.nan, numpy.nan],
+                     [numpy.nan, numpy.nan, numpy.nan]])
+
+    def test_parse_spacing(self):
+        """
+        Test km spacing is converted to degrees at the grid latitude
+        """
+        dlon, dlat = parse_spacing('10k', 60.)
+        self.assertAlmostEqual(dlat, 10. / 111.19492664, 8)
+        self.assertAlmostEqual(dlon, 2 * dlat, 8)
+        self.assertEqual(parse_spacing('30m'), (0.5, 0.5))
+
+    def test_netcdf(self):
+        """
+        Test NetCDF file is readable and has CF coordinates
+        """
+        if netcdf_file is None:
+            self.skipTest('scipy not available')
+        grid = Grid.from_sites(self.lons, self.lats)
+        root = os.path.join(self.output_dir, 'map')
+        save_raster(root, grid, self.values, 'netcdf', 'PGA')
+        nc = netcdf_file('%s.NC' % root, 'r', mmap=False)
+        self.assertEqual(nc.Conventions, 'CF-1.6')
+        self.assertEqual(nc.variables['lon'].units, 'degrees_east')
+        numpy.testing.assert_allclose(nc.variables['lat'][:],
+                                      numpy.arange(40., 41.01, 0.05))
+        numpy.testing.assert_allclose(nc.variables['z'][:],
+                                      self.values.reshape(21, 21), rtol=1e-6)
+
+    def test_geotiff(self):
+        """
+        Test GeoTIFF image starts from the north-west corner
+        """
+        grid = Grid.from_sites(self.lons, self.lats)
+        root = os.path.join(self.output_dir, 'map')
+        save_raster(root, grid, self.values, 'geotiff')
+        data = open('%s.tif' % root, 'rb').read()
+        self.assertEqual(data[:4], 'II*\x00')
+        n_tags = struct.unpack('<H', data[8: 10])[0]
+        tags = dict((tag, value) for tag, _, _, value in [
+            struct.unpack('<HHII', data[10 + 12 * i: 22 + 12 * i])
+            for i in range(n_tags)])
+        image = numpy.frombuffer(data[tags[273]: tags[273] + tags[279]],
+                                 dtype='<f4').reshape(21, 21)
+        numpy.testing.assert_allclose(
+            image, self.values.reshape(21, 21)[::-1], rtol=1e-6)
+        tiepoint = struct.unpack('<6d', data[tags[33922]: tags[33922] + 48])
+        numpy.testing.assert_allclose(tiepoint[3:5], [9.95, 41.025])
+
+    def test_save_rasters_in_workers(self):
+        """
+        Test rasters of several grids are the same written by one or more
+        processes, with batches split across grids
+        """
+        grids = [Grid.from_sites(self.lons, self.lats),
+                 Grid.from_sites(self.lons[:-21], self.lats[:-21])]
+        outputs = []
+        for jobs in (1, 3):
+            tasks = []
+            for i in range(7):
+                grid = grids[i // 4]
+                tasks.append((os.path.join(self.output_dir,
+                                           '%d_%d' % (jobs, i)),
+                              grid, self.values[:len(grid.nodes)] * i, 'PGA'))
+            save_rasters(tasks, 'geotiff', jobs, batch_size=5)
+            outputs.append([open('%s.tif' % task[0], 'rb').read()
+                            for task in tasks])
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertNotEqual(outputs[0][3], outputs[0][4])
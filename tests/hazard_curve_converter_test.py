@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from oq_output.hazard_curve_converter import iter_hazard_curves, \
+    parse_nrml_hazard_curves, save_hazard_curves_to_csv, plot_hazard_curve
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+
+
+class TestHazardCurveStreaming(unittest.TestCase):
+    """
+    Tests the streaming (chunked) conversion of NRML hazard curves
+    """
+    def setUp(self):
+        self.input_xml = os.path.join(DATA_PATH, 'hazard_curves_short.xml')
+        self.output_root = os.path.join(DATA_PATH, 'temp_hazard_curves')
+
+    def tearDown(self):
+        if os.path.isfile('%s.csv' % self.output_root):
+            os.remove('%s.csv' % self.output_root)
+
+    def test_chunks(self):
+        """
+        Tests that curves are yielded in chunks of at most chunk_size sites
+        """
+        chunks = [curves for _, curves in
+                  iter_hazard_curves(self.input_xml, chunk_size=4)]
+        self.assertEqual([len(c) for c in chunks], [4, 4, 4, 2])
+        metadata, curves = next(iter_hazard_curves(self.input_xml))
+        self.assertEqual(metadata['imt'], 'PGA')
+        self.assertEqual(metadata['investigation_time'], '50.0')
+        self.assertEqual(len(metadata['imls']), 19)
+        self.assertEqual(curves.shape, (14, 21))
+        numpy.testing.assert_allclose(
+            curves[0, :3], [-122.874441727, 42.029656169, 0.993191288898])
+
+    def test_save_streaming(self):
+        """
+        Tests that the streaming conversion writes header and all curves
+        """
+        save_hazard_curves_to_csv(self.input_xml, self.output_root,
+                                  streaming=True, chunk_size=3)
+        f = open('%s.csv' % self.output_root)
+        lines = f.readlines()
+        f.close()
+        self.assertTrue(lines[0].startswith('# '))
+        self.assertTrue(lines[1].startswith('lon,lat,0.005,0.007'))
+        curves = numpy.loadtxt(lines[2:], delimiter=',')
+        _, expected = next(iter_hazard_curves(self.input_xml))
+        self.assertEqual(curves.shape, (14, 21))
+        numpy.testing.assert_allclose(curves, expected, rtol=1e-5)
+
+    def test_parse_single_precision(self):
+        """
+        Tests that poes can be decoded directly to a float32 matrix
+        """
+        metadata, coords, poes = parse_nrml_hazard_curves(self.input_xml,
+                                                          numpy.float32)
+        self.assertEqual(coords.dtype, numpy.float64)
+        self.assertEqual(poes.dtype, numpy.float32)
+        self.assertEqual(poes.shape, (14, 19))
+        _, expected = next(iter_hazard_curves(self.input_xml))
+        numpy.testing.assert_array_equal(coords, expected[:, :2])
+        numpy.testing.assert_allclose(poes, expected[:, 2:], rtol=1e-6)
+
+    def test_missing_imls(self):
+        """
+        Tests that a file without IMLs is rejected naming the file
+        """
+        input_xml = os.path.join(DATA_PATH, 'temp_no_imls.xml')
+        f = open(input_xml, 'w')
+        f.write(open(self.input_xml).read().split('<IMLs>')[0] +
+                '</hazardCurves></nrml>')
+        f.close()
+        try:
+            with self.assertRaises(ValueError) as ctx:
+                parse_nrml_hazard_curves(input_xml)
+            self.assertIn(input_xml, str(ctx.exception))
+        finally:
+            os.remove(input_xml)
+
+    def test_save_streaming_without_curves(self):
+        """
+        Tests that a file without curves gives the same header in streaming
+        and in memory
+        """
+        input_xml = os.path.join(DATA_PATH, 'temp_no_curves.xml')
+        content = open(self.input_xml).read()
+        f = open(input_xml, 'w')
+        f.write(content.split('<hazardCurve>')[0] + '</hazardCurves></nrml>')
+        f.close()
+        try:
+            save_hazard_curves_to_csv(input_xml, self.output_root,
+                                      streaming=True, chunk_size=3)
+            streamed = open('%s.csv' % self.output_root).read()
+            os.remove('%s.csv' % self.output_root)
+            save_hazard_curves_to_csv(input_xml, self.output_root)
+            expected = open('%s.csv' % self.output_root).read()
+        finally:
+            os.remove(input_xml)
+        self.assertEqual(len(expected.splitlines()), 2)
+        self.assertEqual(streamed, expected)
+
+
+class TestHazardCurvePlots(unittest.TestCase):
+    """
+    Tests the plotting of the converted hazard curves
+    """
+    def setUp(self):
+        self.input_xml = os.path.join(DATA_PATH, 'hazard_curves_short.xml')
+        self.output_dir = tempfile.mkdtemp()
+        self.output_root = os.path.join(self.output_dir, 'hazard_curves')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_plot_curves(self):
+        """
+        Tests that a pdf file is written for each selected site
+        """
+        save_hazard_curves_to_csv(self.input_xml, self.output_root,
+                                  plot_curves=True,
+                                  plot_options=dict(sites=[0, 2]))
+        self.assertEqual(len(os.listdir(self.output_root)), 2)
+        self.assertTrue(all(name.startswith('HazCurve_') and
+                            name.endswith('.pdf')
+                            for name in os.listdir(self.output_root)))
+
+    def test_plot_streaming(self):
+        """
+        Tests that sites are selected by index over all the chunks
+        """
+        metadata, coords, poes = parse_nrml_hazard_curves(self.input_xml)
+        save_hazard_curves_to_csv(self.input_xml, self.output_root,
+                                  plot_curves=True, streaming=True,
+                                  chunk_size=4,
+                                  plot_options=dict(sites=[1, 5, 13]))
+        self.assertEqual(len(os.listdir(self.output_root)), 3)
+        num_plotted = plot_hazard_curve(
+            os.path.join(self.output_dir, 'atlas'),
+            numpy.hstack((coords, poes)), metadata, atlas=True)
+        self.assertEqual(num_plotted, 14)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import unittest
+import numpy
+
+from oq_output.hazard_curve_converter import parse_nrml_hazard_curves
+from oq_output.hazard_curves_to_maps import compute_hazard_maps, \
+    save_uhs_from_curves
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+
+
+class TestHazardCurvesToMaps(unittest.TestCase):
+    """
+    Tests the computation of hazard maps and UHS from hazard curves
+    """
+    def setUp(self):
+        self.input_xml = os.path.join(DATA_PATH, 'hazard_curves_short.xml')
+        self.sa_xml = os.path.join(DATA_PATH, 'temp_hazard_curves_sa.xml')
+        self.output_root = os.path.join(DATA_PATH, 'temp_uhs')
+
+    def tearDown(self):
+        for fname in [self.sa_xml, '%s_poe0.1.csv' % self.output_root]:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def test_compute_hazard_maps(self):
+        """
+        Tests that vectorized interpolation gives the same results as
+        log-log interpolation of each curve with numpy.interp, including
+        poes outside of the curves
+        """
+        metadata, _, poes = parse_nrml_hazard_curves(self.input_xml)
+        imls = numpy.array(metadata['imls'])
+        target_poes = [0.9999, 0.5, 0.1, 0.02, 1E-8]
+        hazard_maps = compute_hazard_maps(imls, poes, target_poes)
+        self.assertEqual(hazard_maps.shape, (14, 5))
+        for i, curve in enumerate(poes):
+            expected = numpy.exp(numpy.interp(numpy.log(target_poes),
+                                              numpy.log(curve[::-1]),
+                                              numpy.log(imls[::-1])))
+            numpy.testing.assert_allclose(hazard_maps[i], expected)
+
+    def test_save_uhs_from_curves(self):
+        """
+        Tests that UHS are assembled from one curves file per IMT, sorted
+        by period
+        """
+        f = open(self.input_xml)
+        xml = f.read()
+        f.close()
+        f = open(self.sa_xml, 'w')
+        f.write(xml.replace('IMT="PGA"',
+                            'IMT="SA" saPeriod="1.0" saDamping="5.0"'))
+        f.close()
+        save_uhs_from_curves([self.sa_xml, self.input_xml], self.output_root,
+                             [0.1])
+        f = open('%s_poe0.1.csv' % self.output_root)
+        lines = f.readlines()
+        f.close()
+        self.assertTrue('poe=0.1' in lines[0])
+        self.assertEqual(lines[1].strip(), 'lon,lat,0.0,1.0')
+        values = numpy.loadtxt(lines[2:], delimiter=',')
+        self.assertEqual(values.shape, (14, 4))
+        numpy.testing.assert_allclose(values[:, 2], values[:, 3])
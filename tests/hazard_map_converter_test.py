@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import unittest
+import numpy
+
+from oq_output.hazard_map_converter import parse_nrml_hazard_map, \
+    save_hazard_map_to_csv, atkinson_kaka_2007_rsa2mmi
+from oq_output.utils import read_hazard_csv
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+
+HAZARD_MAP = '''<?xml version='1.0' encoding='UTF-8'?>
+<nrml xmlns:gml="http://www.opengis.net/gml" xmlns="http://openquake.org/xmlns/nrml/0.4">
+  <hazardMap sourceModelTreePath="b1" gsimTreePath="b1_b2_b3" IMT="PGA" investigationTime="50.0" poE="0.1">
+    <node lon="-124.45" lat="40.14" iml="0.46"/>
+    <node lon="-124.45" lat="40.23" iml="0.61"/>
+    <node lon="-124.35" lat="40.14" iml="0.05"/>
+  </hazardMap>
+</nrml>
+'''
+
+
+class TestHazardMapConverter(unittest.TestCase):
+    """
+    Tests the parsing and conversion of NRML hazard maps
+    """
+    def setUp(self):
+        self.input_xml = os.path.join(DATA_PATH, 'temp_hazard_map.xml')
+        self.output_root = os.path.join(DATA_PATH, 'temp_hazard_map')
+        f = open(self.input_xml, 'w')
+        f.write(HAZARD_MAP)
+        f.close()
+
+    def tearDown(self):
+        for fname in [self.input_xml, '%s.csv' % self.output_root]:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def test_parse_nrml_hazard_map(self):
+        """
+        Tests that the map is returned as an array of lon, lat, iml
+        """
+        metadata, values = parse_nrml_hazard_map(self.input_xml)
+        self.assertEqual(metadata['imt'], 'PGA')
+        self.assertEqual(metadata['poe'], '0.1')
+        numpy.testing.assert_array_equal(
+            values, [[-124.45, 40.14, 0.46], [-124.45, 40.23, 0.61],
+                     [-124.35, 40.14, 0.05]])
+
+    def test_save_hazard_map_to_csv_mmi(self):
+        """
+        Tests conversion of the imls to MMI in the .csv output
+        """
+        save_hazard_map_to_csv(self.input_xml, self.output_root, to_mmi=True)
+        _, columns, lons, _, values = read_hazard_csv(
+            '%s.csv' % self.output_root)
+        self.assertEqual(columns, ['mmi'])
+        mmi, _ = atkinson_kaka_2007_rsa2mmi(
+            'PGA', numpy.array([0.46, 0.61, 0.05]))
+        numpy.testing.assert_allclose(values[:, 0], mmi, rtol=1e-5)
+
+    def test_save_hazard_map_to_csv_mmi_sa(self):
+        """
+        Tests SA maps are converted to MMI whatever the format of the period
+        """
+        f = open(self.input_xml, 'w')
+        f.write(HAZARD_MAP.replace('IMT="PGA"',
+                                   'IMT="SA" saPeriod="1" saDamping="5"'))
+        f.close()
+        save_hazard_map_to_csv(self.input_xml, self.output_root, to_mmi=True)
+        _, columns, _, _, values = read_hazard_csv(
+            '%s.csv' % self.output_root)
+        self.assertEqual(columns, ['mmi'])
+        mmi, _ = atkinson_kaka_2007_rsa2mmi(
+            'SA(1.0)', numpy.array([0.46, 0.61, 0.05]))
+        numpy.testing.assert_allclose(values[:, 0], mmi, rtol=1e-5)
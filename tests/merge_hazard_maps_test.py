@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import unittest
+import numpy
+
+from oq_output.merge_hazard_maps import align_sites, get_column_labels, \
+    merge_hazard_maps
+from oq_output.binary_io import read_binary
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+
+HAZARD_MAP = '''<?xml version='1.0' encoding='UTF-8'?>
+<nrml xmlns:gml="http://www.opengis.net/gml" xmlns="http://openquake.org/xmlns/nrml/0.4">
+  <hazardMap sourceModelTreePath="b1" gsimTreePath="b1_b2_b3" IMT="%s" investigationTime="50.0" poE="%s">
+%s
+  </hazardMap>
+</nrml>
+'''
+
+
+class TestMergeHazardMaps(unittest.TestCase):
+    """
+    Tests the merge of hazard maps into a single site-aligned table
+    """
+    def setUp(self):
+        self.input_files = []
+        self.output_root = os.path.join(DATA_PATH, 'temp_merged_maps')
+        maps = [('PGA', '0.1', [(10., 45., 0.3), (10.1, 45., 0.4)]),
+                ('PGA', '0.02', [(10.1, 45.000000001, 0.8), (10., 45., 0.6),
+                                 (10.2, 45., 0.7)])]
+        for i, (imt, poe, nodes) in enumerate(maps):
+            fname = os.path.join(DATA_PATH, 'temp_hazard_map_%d.xml' % i)
+            f = open(fname, 'w')
+            f.write(HAZARD_MAP % (imt, poe, '\n'.join(
+                '<node lon="%s" lat="%s" iml="%s"/>' % node
+                for node in nodes)))
+            f.close()
+            self.input_files.append(fname)
+
+    def tearDown(self):
+        for fname in self.input_files + ['%s.npz' % self.output_root]:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def test_align_sites(self):
+        """
+        Tests sites are matched on rounded coordinates, in order of first
+        appearance
+        """
+        coords, indices = align_sites([
+            numpy.array([[1., 2.], [3., 4.]]),
+            numpy.array([[5., 6.], [1.000001, 2.]])])
+        numpy.testing.assert_array_equal(coords,
+                                         [[1., 2.], [3., 4.], [5., 6.]])
+        numpy.testing.assert_array_equal(indices[0], [0, 1])
+        numpy.testing.assert_array_equal(indices[1], [2, 0])
+
+    def test_column_labels(self):
+        """
+        Tests labels are built from IMT, poe and statistics
+        """
+        labels = get_column_labels([
+            {'imt': 'SA', 'sa_period': '1.0', 'poe': '0.1'},
+            {'imt': 'PGA', 'poe': '0.02', 'statistics': 'quantile',
+             'quantile_value': '0.85'}])
+        self.assertEqual(labels, ['SA(1.0)_poe0.1', 'PGA_poe0.02_quantile0.85'])
+        self.assertRaises(ValueError, get_column_labels,
+                          [{'imt': 'PGA', 'poe': '0.1'}] * 2)
+
+    def test_merge_hazard_maps(self):
+        """
+        Tests the merged binary table, with NaN for missing sites
+        """
+        merge_hazard_maps(self.input_files, self.output_root, 'npz', jobs=2)
+        metadata, columns, lons, lats, values = read_binary(
+            '%s.npz' % self.output_root)
+        self.assertEqual(list(columns), ['PGA_poe0.1', 'PGA_poe0.02'])
+        self.assertEqual(metadata['imt'], 'PGA')
+        self.assertNotIn('poe', metadata)
+        numpy.testing.assert_array_equal(lons, [10., 10.1, 10.2])
+        numpy.testing.assert_array_equal(
+            values, [[0.3, 0.6], [0.4, 0.8], [numpy.nan, 0.7]])
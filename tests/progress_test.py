@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import json
+import unittest
+from StringIO import StringIO
+
+from oq_output import progress as progress_module
+from oq_output.progress import Progress, ProgressFile
+from oq_output.gmfset_converter import iter_gmf_records
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+INPUT_FILE = os.path.join(DATA_PATH, 'gmf_collection.xml')
+
+
+class TestProgress(unittest.TestCase):
+    """
+    Tests the progress reporter and stage timer
+    """
+    def setUp(self):
+        self.json_file = os.path.join(DATA_PATH, 'progress.json')
+
+    def tearDown(self):
+        if os.path.exists(self.json_file):
+            os.remove(self.json_file)
+
+    def test_stage_measures(self):
+        """
+        Test the bytes read and items of each stage are recorded
+        """
+        progress = Progress()
+        with progress.stage('parse') as stage:
+            with progress.open(INPUT_FILE) as f:
+                self.assertTrue(isinstance(f, ProgressFile))
+                while f.read(100):
+                    progress.update()
+        size = os.path.getsize(INPUT_FILE)
+        self.assertEqual((stage.total_bytes, stage.bytes), (size, size))
+        self.assertEqual(stage.items, (size + 99) // 100)
+        with progress.stage('write', total_bytes=10):
+            # inputs are not counted when the total is given
+            with progress.open(INPUT_FILE) as f:
+                f.read()
+            with progress.paused():
+                progress.update()
+            progress.update(nbytes=5)
+
+        progress.save_json(self.json_file)
+        stages = json.load(open(self.json_file))['stages']
+        self.assertEqual([(s['name'], s['bytes'], s['items'])
+                          for s in stages],
+                         [('parse', size, stage.items), ('write', 5, 1)])
+        self.assertTrue(all(s['seconds'] >= 0 for s in stages))
+
+    def test_close(self):
+        """
+        Test files opened from a name are closed on leaving the with
+        statement, and file objects of the caller are left open
+        """
+        progress = Progress()
+        with progress.stage('parse'):
+            with progress.open(INPUT_FILE) as f:
+                f.read(10)
+            self.assertTrue(f._file.closed)
+            stream = open(INPUT_FILE, 'rb')
+            with progress.open(stream) as f:
+                self.assertEqual(f.read(10), open(INPUT_FILE).read(10))
+            self.assertFalse(stream.closed)
+            stream.close()
+        # file objects are not counted
+        self.assertEqual(progress.stages[0].bytes, 10)
+
+    def test_parser_closes_file(self):
+        """
+        Test a parser releases its input, also when it is not exhausted
+        """
+        opened = []
+        progress_file = progress_module.ProgressFile
+
+        def open_file(source, progress=None):
+            opened.append(progress_file(source, progress))
+            return opened[-1]
+        progress_module.ProgressFile = open_file
+        try:
+            records = iter_gmf_records(INPUT_FILE)
+            next(records)
+            self.assertFalse(opened[0]._file.closed)
+            records.close()
+            self.assertTrue(opened[0]._file.closed)
+            list(iter_gmf_records(INPUT_FILE))
+            self.assertTrue(opened[1]._file.closed)
+        finally:
+            progress_module.ProgressFile = progress_file
+
+    def test_throttled_report(self):
+        """
+        Test the progress line is not written more often than the interval
+        """
+        stream = StringIO()
+        progress = Progress(show=True, stream=stream, interval=3600)
+        with progress.stage('convert', total_bytes=100):
+            for _ in range(1000):
+                progress.update(nbytes=0.1)
+        lines = stream.getvalue().split('\r')[1:]
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('convert:   0.1% '))
+        self.assertTrue('ETA' in lines[0])
+        self.assertTrue(lines[1].startswith('convert: 100.0% '))
+        self.assertTrue('1000 items' in lines[1] and 'done in' in lines[1])
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from oq_output.eventset_converter import iter_ruptures, save_sess_to_txt
+from oq_output.rupture_index import load_index, query_ruptures, \
+    save_query_to_txt, get_source_id
+from oq_output.site_index import geodetic_distance
+
+SAMPLE_DATA_PATH = '%s/../sample_data/' % os.path.dirname(__file__)
+SES_FILE = os.path.join(SAMPLE_DATA_PATH, 'event_set.xml')
+
+
+class TestRuptureIndex(unittest.TestCase):
+    """
+    Tests the selection of converted ruptures with the rupture index
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        # ruptures are split in two sets in turns, so that sets are
+        # appended to their files in later chunks
+        ruptures = [(str(i % 2 + 1), rupture) for i, (_, rupture) in
+                    enumerate(iter_ruptures(SES_FILE))]
+        save_sess_to_txt(ruptures, self.output_dir, chunk_size=15,
+                         index=True)
+        self.lines = []
+        for file_name in ('ses_1.txt', 'ses_2.txt'):
+            lines = open(os.path.join(self.output_dir,
+                                      file_name)).read().splitlines()
+            self.header = lines[0]
+            self.lines.extend((file_name, line) for line in lines[1:])
+        self.index = load_index(self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _get_expected(self, selected):
+        """
+        Return the lines of the ruptures whose magnitude, centroid and
+        source id (read from the index) satisfy `selected`
+        """
+        return sorted(
+            line for i, line in enumerate(self._get_lines_by_index())
+            if selected(self.index.magnitudes[i], self.index.lons[i],
+                        self.index.lats[i],
+                        get_source_id(line[1].split('\t')[0])))
+
+    def _get_lines_by_index(self):
+        """
+        Return the lines of all the ruptures, in the order of the index
+        """
+        return self.index.read_lines(self.output_dir,
+                                     numpy.arange(len(self.index)))
+
+    def test_lines(self):
+        """
+        Test the index points to all the lines of the files
+        """
+        self.assertEqual(len(self.index), 199)
+        self.assertEqual(sorted(self._get_lines_by_index()),
+                         sorted(self.lines))
+
+    def test_query(self):
+        """
+        Test ruptures selected by magnitude, distance and source id
+        """
+        header, lines = query_ruptures(self.output_dir, min_mag=6.5)
+        self.assertEqual(header, self.header)
+        self.assertEqual(sorted(lines), self._get_expected(
+            lambda mag, lon, lat, src: mag >= 6.5))
+        self.assertTrue(len(lines) > 0)
+
+        _, lines = query_ruptures(self.output_dir, min_mag=6.,
+                                  lon=-117.7, lat=35.4, distance=150.)
+        self.assertEqual(sorted(lines), self._get_expected(
+            lambda mag, lon, lat, src: mag >= 6. and
+            geodetic_distance(-117.7, 35.4, lon, lat) <= 150.))
+        self.assertTrue(len(lines) > 0)
+
+        _, lines = query_ruptures(self.output_dir, source_id='1239')
+        self.assertEqual(sorted(lines), self._get_expected(
+            lambda mag, lon, lat, src: src == '1239'))
+        self.assertEqual(len(lines), 1)
+
+        _, lines = query_ruptures(self.output_dir, source_id='unknown')
+        self.assertEqual(lines, [])
+
+    def test_save_query_to_txt(self):
+        """
+        Test selected ruptures are saved with the name of their file
+        """
+        output_file = os.path.join(self.output_dir, 'query.txt')
+        n_ruptures = save_query_to_txt(self.output_dir, output_file,
+                                       max_mag=5.3)
+        lines = open(output_file).read().splitlines()
+        self.assertEqual(lines[0], 'ses_file\t' + self.header)
+        self.assertEqual(len(lines) - 1, n_ruptures)
+        self.assertTrue(n_ruptures > 0)
+        for line in lines[1:]:
+            self.assertIn(line.split('\t')[0], ('ses_1.txt', 'ses_2.txt'))
+            self.assertTrue(float(line.split('\t')[2]) <= 5.3)
+
+    def test_source_id(self):
+        """
+        Test source id is read from the src= token of the rupture id
+        """
+        self.assertEqual(
+            get_source_id('rlz=00|ses=0001|src=10138|i=0049-00'), '10138')
+        self.assertIsNone(get_source_id('rupture-1'))
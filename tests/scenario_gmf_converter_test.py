@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from oq_output.utils import SiteTable
+from oq_output.scenario_gmf_converter import GmfStatistics, \
+    parse_gmfs_file, save_gmf_statistics, save_gmfs_to_netcdf
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+
+
+class TestGmfStatistics(unittest.TestCase):
+    """
+    Tests the single-pass per-site statistics of scenario GMFs
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_exact_statistics(self):
+        """
+        Test statistics match numpy when the sample holds all the values
+        """
+        gmvs = numpy.random.RandomState(1).lognormal(-2., 0.6, (50, 3))
+        sites = SiteTable()
+        indices = sites.get_indices([1., 2., 3.], [0., 0., 0.])
+        stats = GmfStatistics(sites, (0.1, 0.5, 0.9), sample_size=50)
+        for field in gmvs:
+            stats.add(indices, field)
+        count, mean, std, minimum, maximum, quantiles = \
+            stats.get_statistics()
+        logs = numpy.log(gmvs)
+        numpy.testing.assert_equal(count, [50, 50, 50])
+        numpy.testing.assert_allclose(mean, logs.mean(axis=0))
+        numpy.testing.assert_allclose(std, logs.std(axis=0, ddof=1))
+        numpy.testing.assert_allclose(minimum, logs.min(axis=0))
+        numpy.testing.assert_allclose(maximum, logs.max(axis=0))
+        numpy.testing.assert_allclose(
+            quantiles, numpy.percentile(logs, [10, 50, 90], axis=0).T,
+            rtol=1e-6)
+
+    def test_sampled_quantiles(self):
+        """
+        Test quantiles estimated from a sample, and sites with few values
+        """
+        sites = SiteTable()
+        stats = GmfStatistics(sites, (0.5,), sample_size=200)
+        rng = numpy.random.RandomState(2)
+        indices = sites.get_indices([1., 2.], [0., 0.])
+        for _ in range(5000):
+            stats.add(indices, rng.lognormal(0., 1., 2))
+        # a site with a single value, and a non-positive value not counted
+        stats.add(sites.get_indices([3., 4.], [0., 0.]), [2., 0.])
+        count, mean, std, minimum, maximum, quantiles = \
+            stats.get_statistics()
+        numpy.testing.assert_equal(count, [5000, 5000, 1, 0])
+        numpy.testing.assert_allclose(quantiles[:2, 0], [0., 0.], atol=0.2)
+        numpy.testing.assert_allclose(
+            [mean[2], minimum[2], maximum[2], quantiles[2, 0]],
+            [numpy.log(2.)] * 4)
+        self.assertTrue(numpy.isnan(std[2:]).all())
+        self.assertTrue(numpy.isnan([mean[3], quantiles[3, 0]]).all())
+
+    def test_save_gmf_statistics(self):
+        """
+        Test a statistics file is written per IMT
+        """
+        gmf_file = os.path.join(DATA_PATH, 'scenario_gmfs.xml')
+        file_names = save_gmf_statistics(gmf_file, self.output_dir, (0.5,))
+        self.assertEqual([os.path.basename(f) for f in file_names],
+                         ['gmf_statistics_PGA.csv',
+                          'gmf_statistics_SA(1.0).csv'])
+        lines = open(file_names[0]).read().splitlines()
+        self.assertEqual(lines[:2], [
+            '# IMT=PGA, realizations=2',
+            'lon,lat,count,mean_ln_gmv,std_ln_gmv,min_ln_gmv,max_ln_gmv,'
+            'q0.5_ln_gmv'])
+        values = numpy.array(lines[2].split(','), dtype=float)
+        numpy.testing.assert_allclose(
+            values, [10., 45., 2, numpy.log(0.03) / 2,
+                     numpy.log(3.) / numpy.sqrt(2), numpy.log(0.1),
+                     numpy.log(0.3), numpy.log(0.03) / 2], rtol=1e-5)
+        # the fields parsed in memory are arrays
+        gmfs = parse_gmfs_file(gmf_file)
+        numpy.testing.assert_allclose(gmfs['PGA'][1],
+                                      [[10., 45., 0.3], [10.1, 45., 0.4]])
+
+
+class TestGmfRasters(unittest.TestCase):
+    """
+    Tests the conversion of scenario GMFs to rasters
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.gmfs = parse_gmfs_file(os.path.join(DATA_PATH,
+                                                 'scenario_gmfs.xml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_cleanup_argument(self):
+        """
+        Test the ignored cleanup argument is still accepted positionally
+        and by keyword, before magic
+        """
+        out_dir = os.path.join(self.output_dir, 'positional')
+        save_gmfs_to_netcdf(self.gmfs, out_dir, False, '10k', True, False,
+                            'geotiff')
+        self.assertEqual(sorted(os.listdir(os.path.join(out_dir,
+                                                        'GMFS_PGA'))),
+                         ['gmf_1.tif', 'gmf_2.tif'])
+        out_dir = os.path.join(self.output_dir, 'keyword')
+        save_gmfs_to_netcdf(self.gmfs, out_dir, resolution='10k',
+                            cleanup=True, output_format='geotiff')
+        self.assertEqual(sorted(os.listdir(os.path.join(out_dir,
+                                                        'GMFS_PGA'))),
+                         ['gmf_1.tif', 'gmf_2.tif'])
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from oq_output import site_index
+from oq_output.binary_io import save_binary
+from oq_output.utils import read_hazard_csv
+from oq_output.site_index import RegularGridIndex, KDTreeIndex, \
+    build_index, get_index, query_hazard_output, save_query_to_csv, \
+    geodetic_distance, cKDTree
+
+
+class TestSiteIndex(unittest.TestCase):
+    """
+    Tests the site index and the queries of hazard outputs
+    """
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        lons, lats = numpy.meshgrid(numpy.arange(10., 12.01, 0.5),
+                                    numpy.arange(40., 41.01, 0.5))
+        self.lons = lons.ravel()
+        self.lats = lats.ravel()
+        # values linear in the coordinates, so that bilinear interpolation
+        # is exact
+        values = self.lons * 100. + self.lats
+        self.values = numpy.column_stack((values, 2 * values))
+        self.csv_file = self._write_csv('map.csv', self.lons, self.lats,
+                                        self.values)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _write_csv(self, name, lons, lats, values):
+        """
+        Write hazard output .csv file in the output directory
+        """
+        file_name = os.path.join(self.output_dir, name)
+        f = open(file_name, 'w')
+        f.write('# imt=PGA,investigation_time=50.0\nlon,lat,0.1,0.02\n')
+        numpy.savetxt(f, numpy.column_stack((lons, lats, values)),
+                      delimiter=',', fmt='%.10g')
+        f.close()
+        return file_name
+
+    def test_read_hazard_csv(self):
+        """
+        Test metadata, column labels and values are read from .csv files
+        """
+        metadata, columns, lons, lats, values = read_hazard_csv(
+            self.csv_file)
+        self.assertEqual(metadata, {'imt': 'PGA',
+                                    'investigation_time': '50.0'})
+        numpy.testing.assert_array_equal(columns, [0.1, 0.02])
+        numpy.testing.assert_array_equal(lons, self.lons)
+        numpy.testing.assert_array_equal(lats, self.lats)
+        numpy.testing.assert_array_equal(values, self.values)
+
+    def test_regular_grid(self):
+        """
+        Test sites on a regular grid are indexed by a grid hash
+        """
+        index = build_index(self.lons, self.lats)
+        self.assertTrue(isinstance(index, RegularGridIndex))
+        self.assertEqual(index.grid.shape, (3, 5))
+        numpy.testing.assert_array_equal(
+            index.nearest([10.2, 11.9, 9., 10.76], [40.1, 40.9, 39., 40.5]),
+            [0, 14, 0, 7])
+
+    def test_nearest_query(self):
+        """
+        Test values and distances of the nearest sites, also where the
+        nearest grid node has no site
+        """
+        csv_file = self._write_csv('missing.csv', self.lons[1:],
+                                   self.lats[1:], self.values[1:])
+        _, columns, values, idx, distances = query_hazard_output(
+            csv_file, [10.1, 11.4], [40.1, 40.6])
+        numpy.testing.assert_array_equal(columns, [0.1, 0.02])
+        numpy.testing.assert_array_equal(idx, [0, 7])
+        numpy.testing.assert_array_equal(values, [[1090., 2180.],
+                                                  [1190.5, 2381.]])
+        self.assertAlmostEqual(distances[0],
+                               geodetic_distance(10.1, 40.1, 10.5, 40.))
+        self.assertAlmostEqual(distances[1],
+                               geodetic_distance(11.4, 40.6, 11.5, 40.5))
+
+    def test_nearest_across_hole(self):
+        """
+        Test the nearest site is found beyond a hole of empty grid nodes,
+        with and without the KD-tree
+        """
+        lons, lats = numpy.meshgrid(numpy.arange(0., 6.), numpy.arange(0., 6.))
+        lons, lats = lons.ravel(), lats.ravel()
+        # 3x3 hole of nodes without sites around (2, 2)
+        keep = ~((abs(lons - 2.) <= 1.) & (abs(lats - 2.) <= 1.))
+        lons, lats = lons[keep], lats[keep]
+        index = build_index(lons, lats)
+        self.assertTrue(isinstance(index, RegularGridIndex))
+        query_lons = numpy.array([2., 1.2, 2.8, 2.])
+        query_lats = numpy.array([2.1, 2., 3., 1.2])
+        expected = [(2., 4.), (0., 2.), (3., 4.), (2., 0.)]
+
+        original_kdtree = site_index.cKDTree
+        try:
+            for kdtree in set([original_kdtree, None]):
+                site_index.cKDTree = kdtree
+                idx = index.nearest(query_lons, query_lats)
+                self.assertEqual(zip(lons[idx], lats[idx]), expected)
+        finally:
+            site_index.cKDTree = original_kdtree
+
+    def test_bilinear_query(self):
+        """
+        Test bilinear interpolation of values linear in the coordinates
+        """
+        _, _, values, idx, distances = query_hazard_output(
+            self.csv_file, [10.25, 11.9, 12.], [40.25, 40.8, 41.],
+            'bilinear')
+        self.assertIsNone(idx)
+        self.assertIsNone(distances)
+        numpy.testing.assert_allclose(
+            values, [[1065.25, 2130.5], [1230.8, 2461.6], [1241., 2482.]])
+
+    @unittest.skipIf(cKDTree is None, 'scipy not available')
+    def test_scattered_sites(self):
+        """
+        Test scattered sites are indexed by a KD-tree, giving the nearest
+        site
+        """
+        lons = numpy.array([10., 10.3, 11.7, 12.5])
+        lats = numpy.array([45., 45.9, 44.2, 45.1])
+        index = build_index(lons, lats)
+        self.assertTrue(isinstance(index, KDTreeIndex))
+        numpy.testing.assert_array_equal(
+            index.nearest([10.1, 10.4, 12., 12.4], [45.1, 45.5, 44.5, 45.]),
+            [0, 1, 2, 3])
+        self.assertRaises(ValueError, index.bilinear, [10.], [45.])
+
+        csv_file = self._write_csv('scattered.csv', lons, lats,
+                                   numpy.column_stack((lons, lats)))
+        _, _, values, idx, _ = query_hazard_output(csv_file, [12.], [44.5])
+        numpy.testing.assert_array_equal(idx, [2])
+        numpy.testing.assert_array_equal(values, [[11.7, 44.2]])
+
+    def test_cached_index(self):
+        """
+        Test the saved index is reused, and rebuilt when older than the
+        hazard output
+        """
+        index_file = '%s.sidx' % self.csv_file
+        index = get_index(self.csv_file, self.lons, self.lats)
+        self.assertTrue(os.path.isfile(index_file))
+        # other sites are ignored while the index is up to date
+        cached = get_index(self.csv_file, self.lons[:6], self.lats[:6])
+        self.assertEqual(cached.grid.shape, index.grid.shape)
+
+        mtime = os.path.getmtime(self.csv_file)
+        os.utime(index_file, (mtime - 10, mtime - 10))
+        rebuilt = get_index(self.csv_file, self.lons[:6], self.lats[:6])
+        self.assertEqual(rebuilt.grid.shape, (2, 5))
+        self.assertTrue(os.path.getmtime(index_file) >= mtime)
+
+    def test_binary_input(self):
+        """
+        Test binary files give the same results as .csv files
+        """
+        binary_file = save_binary(
+            os.path.join(self.output_dir, 'map'), {'imt': 'PGA'},
+            [0.1, 0.02], self.lons, self.lats, self.values, 'npz')
+        expected = query_hazard_output(self.csv_file, [10.6, 11.1],
+                                       [40.4, 40.9])
+        result = query_hazard_output(binary_file, [10.6, 11.1],
+                                     [40.4, 40.9])
+        self.assertEqual(result[0], {'imt': 'PGA'})
+        for expected_array, array in zip(expected[1:], result[1:]):
+            numpy.testing.assert_array_equal(array, expected_array)
+
+    def test_save_query_to_csv(self):
+        """
+        Test query points are read from .csv file (with or without header)
+        and values saved with the nearest site
+        """
+        query_file = os.path.join(self.output_dir, 'points.csv')
+        open(query_file, 'w').write('lon,lat\n10.4,40.6\n11.,41.\n')
+        output_file = os.path.join(self.output_dir, 'query.csv')
+        save_query_to_csv(self.csv_file, query_file, output_file)
+        lines = open(output_file).read().splitlines()
+        self.assertEqual(sorted(lines[0][2:].split(',')),
+                         ['imt=PGA', 'investigation_time=50.0',
+                          'method=nearest'])
+        self.assertEqual(lines[1], 'lon,lat,site_index,distance,0.1,0.02')
+        self.assertEqual(lines[3].split(','), ['11', '41', '12', '0',
+                                               '1141', '2282'])
+        self.assertRaises(ValueError, save_query_to_csv, self.csv_file,
+                          query_file, output_file)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from oq_output.uhs_converter import parse_nrml_uhs_curves, save_uhs_to_csv, \
+    plot_uhs
+from oq_output.utils import read_hazard_csv
+
+DATA_PATH = '%s/data/' % os.path.dirname(__file__)
+SAMPLE_DATA_PATH = '%s/../sample_data/' % os.path.dirname(__file__)
+
+
+class TestUHSConverter(unittest.TestCase):
+    """
+    Tests the streaming conversion of uniform hazard spectra
+    """
+    def setUp(self):
+        self.input_xml = os.path.join(SAMPLE_DATA_PATH,
+                                      'uniform_hazard_spectra_short.xml')
+        self.output_root = os.path.join(DATA_PATH, 'temp_uhs_chunks')
+        self.temp_xml = os.path.join(DATA_PATH, 'temp_uhs.xml')
+
+    def tearDown(self):
+        for fname in ['%s.csv' % self.output_root, self.temp_xml]:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def _write_temp_xml(self, content):
+        f = open(self.temp_xml, 'w')
+        f.write(content)
+        f.close()
+        return self.temp_xml
+
+    def test_parse_nrml_uhs_curves(self):
+        """
+        Tests periods, site coordinates and IMLs of the first site
+        """
+        metadata, periods, values = parse_nrml_uhs_curves(self.input_xml)
+        self.assertEqual(metadata['poe'], '0.1')
+        self.assertEqual(periods, [0.0, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0])
+        self.assertEqual(values.shape, (9, 9))
+        numpy.testing.assert_allclose(
+            values[0], [-114.216857096, 34.3854225187, 0.0373854542045,
+                        0.046323083373, 0.0677192610315, 0.0905149452298,
+                        0.0732789481523, 0.049380503788, 0.0284434335487])
+
+    def test_save_uhs_to_csv_in_chunks(self):
+        """
+        Tests the .csv file written in chunks contains all the spectra
+        """
+        save_uhs_to_csv(self.input_xml, self.output_root, chunk_size=4)
+        _, periods, lons, lats, values = read_hazard_csv(
+            '%s.csv' % self.output_root)
+        _, _, expected = parse_nrml_uhs_curves(self.input_xml)
+        numpy.testing.assert_allclose(periods,
+                                      [0.0, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0])
+        numpy.testing.assert_allclose(
+            numpy.column_stack((lons, lats, values)), expected, rtol=1e-5)
+
+    def test_missing_periods(self):
+        """
+        Tests that files without periods before the spectra are rejected
+        naming the file
+        """
+        content = open(self.input_xml).read()
+        periods = content[content.index('    <periods>'):
+                          content.index('    <uhs>')]
+        input_xml = self._write_temp_xml(content.replace(periods, ''))
+        with self.assertRaises(ValueError) as ctx:
+            parse_nrml_uhs_curves(input_xml)
+        self.assertIn('Periods must precede', str(ctx.exception))
+        self.assertIn(input_xml, str(ctx.exception))
+
+        input_xml = self._write_temp_xml(
+            content.replace(periods, '').split('<uhs>')[0] +
+            '</uniformHazardSpectra></nrml>')
+        with self.assertRaises(ValueError) as ctx:
+            parse_nrml_uhs_curves(input_xml)
+        self.assertIn(input_xml, str(ctx.exception))
+
+    def test_save_uhs_without_spectra(self):
+        """
+        Tests the header is written for a file without spectra
+        """
+        content = open(self.input_xml).read()
+        input_xml = self._write_temp_xml(
+            content.split('<uhs>')[0] + '</uniformHazardSpectra></nrml>')
+        save_uhs_to_csv(input_xml, self.output_root, chunk_size=4)
+        lines = open('%s.csv' % self.output_root).read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue('poe=0.1' in lines[0])
+        self.assertEqual(lines[1], 'lon,lat,0.0,0.05,0.1,0.2,0.5,1.0,2.0')
+
+    def test_plot_uhs_keeps_metadata(self):
+        """
+        Tests plotting does not modify the metadata of the caller
+        """
+        metadata, periods, values = parse_nrml_uhs_curves(self.input_xml)
+        self.assertIsNone(metadata['statistics'])
+        output_dir = tempfile.mkdtemp()
+        try:
+            plot_uhs(os.path.join(output_dir, 'uhs'), values, periods,
+                     metadata, sites=[0])
+            self.assertEqual(len(os.listdir(output_dir)), 1)
+        finally:
+            shutil.rmtree(output_dir)
+        self.assertIsNone(metadata['statistics'])
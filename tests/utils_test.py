@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# LICENSE
+#
+# Copyright (c) 2014, GEM Foundation, G. Weatherill, M. Pagani, D. Monelli.
+#
+# The nrml_convertes is free software: you can redistribute
+# it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>
+#
+# DISCLAIMER
+#
+# The software nrml_convertes provided herein is released as a prototype
+# implementation on behalf of scientists and engineers working within the GEM
+# Foundation (Global Earthquake Model).
+#
+# It is distributed for the purpose of open collaboration and in the
+# hope that it will be useful to the scientific, engineering, disaster
+# risk and software design communities.
+#
+# The software is NOT distributed as part of GEM's OpenQuake suite
+# (http://www.globalquakemodel.org/openquake) and must be considered as a
+# separate entity. The software provided herein is designed and implemented
+# by scientific staff. It is not developed to the design standards, nor
+# subject to same level of critical review by professional software
+# developers, as GEM's OpenQuake software suite.
+#
+# Feedback and contribution to the software is welcome, and can be
+# directed to the hazard scientific staff of the GEM Model Facility
+# (hazard@globalquakemodel.org).
+#
+# The nrml_convertes is therefore distributed WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# The GEM Foundation, and the authors of the software, assume no liability for
+# use of the software.
+
+
+import unittest
+import numpy
+from StringIO import StringIO
+
+from oq_output.utils import savetxt
+
+
+class TestSavetxt(unittest.TestCase):
+    """
+    Tests the block-wise text writer against numpy.savetxt
+    """
+    def setUp(self):
+        numpy.random.seed(42)
+        self.values = numpy.random.uniform(-180., 180., (1001, 4))
+        self.values[0, 2] = numpy.nan
+
+    def _check(self, values, fmt, delimiter=' '):
+        expected = StringIO()
+        output = StringIO()
+        numpy.savetxt(expected, values, fmt=fmt, delimiter=delimiter)
+        savetxt(output, values, fmt=fmt, delimiter=delimiter, chunk_size=100)
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_float_formats(self):
+        """
+        Test %g and %5.2f formats on a float array written in several blocks
+        """
+        self._check(self.values, '%g', ',')
+        self._check(self.values, '%5.2f,%5.2f,%g,%g')
+        self._check(self.values[:, 0], '%g')
+
+    def test_object_array(self):
+        """
+        Test mixed string and float columns, as written for event sets
+        """
+        values = numpy.array([['1', 5.5, 10.123], ['2', 6.0, 1.5]],
+                             dtype=object)
+        self._check(values, '%s\t%2.1f\t%5.2f')